@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+ bench.py run RESULTS.json [-d DIR] [-t TRAILS] [-l MEAN-LENGTH] [-s SKEW] [-c CARD ...] [-m MASK-ARITY]
+                           [-r SEED] [-n REPEAT] [-b BENCHMARK ...]
+ bench.py compare BEFORE.json AFTER.json [-x THRESHOLD]
+
+ Time the hot paths of trpy on a synthetic TrailDB (see synth.py) and store the results as JSON.
+ Each benchmark runs in its own process, so that its peak RSS can be measured separately,
+ as the growth over the RSS the process starts with (which it shares with this one).
+ The best of REPEAT runs is kept, throughput is in units (events, trails, rows or sets) per second.
+ Compare reports the change in throughput between two runs, exiting non-zero on a regression.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from multiprocessing import cpu_count
+from trpy import TDB, FDB, where, export
+from synth import synthesize
+
+BENCHMARKS = []
+
+def benchmark(unit):
+    def register(fun):
+        fun.unit = unit
+        BENCHMARKS.append(fun)
+        return fun
+    return register
+
+def isolated(fun, *args, **kwds):
+    """
+    Call fun in a child process, returning its (JSON-serializable) result,
+    and how much the peak RSS of the child grew while calling it.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            result = {'result': fun(*args, **kwds),
+                      'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base}
+        except Exception, e:
+            result = {'error': '%s: %s' % (type(e).__name__, e)}
+        os.write(w, json.dumps(result))
+        os._exit(0)
+    os.close(w)
+    data = ''.join(iter(lambda: os.read(r, 65536), ''))
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+def timed(fun, env):
+    tdb = TDB(env['tdb'])
+    fdb = FDB.load(tdb, open(env['fdb']))
+    start = time.time()
+    units = fun(tdb, fdb, env)
+    return units, time.time() - start
+
+@benchmark('events')
+def scan(tdb, fdb, env):
+    return sum(1 for id, trail in tdb.match() for event in trail)
+
+@benchmark('events')
+def scan_lazy(tdb, fdb, env):
+    return sum(1 for id, trail in tdb.match(lazy=True) for event in trail)
+
+@benchmark('events')
+def scan_filter(tdb, fdb, env):
+    return sum(1 for id, trail in tdb.match(where(kind='m1')) for event in trail)
+
+@benchmark('events')
+def scan_expand(tdb, fdb, env):
+    return sum(1 for id, trail in tdb.match(expand=True) for event in trail)
+
+@benchmark('events')
+def scan_batch(tdb, fdb, env):
+    return sum(len(batch.id) for batch in tdb.match(batch=65536))
+
+@benchmark('events')
+def export_tsv(tdb, fdb, env):
+    return export.tsv(tdb, open(os.devnull, 'w'), expand=True)
+
+@benchmark('events')
+def export_npy(tdb, fdb, env):
+    path = tempfile.mkdtemp(prefix='trpy-bench-')
+    try:
+        return export.npy(tdb, path)
+    finally:
+        shutil.rmtree(path)
+
+@benchmark('trails')
+def trail(tdb, fdb, env):
+    rnd = random.Random(env['seed'])
+    ids = [rnd.randrange(tdb.num_trails) for i in xrange(1000)]
+    for id in ids:
+        list(tdb.trail(id))
+    return len(ids)
+
+def make(tdb, **kwds):
+    return FDB.make(tdb, keys=[(), ('k0',), ('k1',)], mask_field=tdb.field('kind'), **kwds)
+
+@benchmark('events')
+def fdb_make(tdb, fdb, env):
+    make(tdb)
+    return tdb.num_events
+
+@benchmark('events')
+def fdb_make_threads(tdb, fdb, env):
+    make(tdb, threads=cpu_count())
+    return tdb.num_events
+
+@benchmark('events')
+def fdb_make_single_pass(tdb, fdb, env):
+    make(tdb, single_pass=True)
+    return tdb.num_events
+
+@benchmark('sets')
+def count_dense(tdb, fdb, env):
+    sets = [fdb.funnel(0)] + [fdb.query('/%s' % kind) for kind in tdb.lexicon('kind')]
+    return sum(1 for i in xrange(10) for s in sets if len(s) >= 0)
+
+@benchmark('rows')
+def count_rows(tdb, fdb, env):
+    return sum(1 for id in xrange(len(fdb)) if len(fdb.funnel(id)) >= 0)
+
+@benchmark('rows')
+def count_family(tdb, fdb, env):
+    family = fdb.family(['', 'm1', 'm1,m2', '!m0', 'm0+m3'])
+    return sum(1 for key in fdb.keys() if family.counts(key))
+
+@benchmark('rows')
+def count_family_all(tdb, fdb, env):
+    family = fdb.family(['', 'm1', 'm1,m2', '!m0', 'm0+m3'])
+    return len(family.counts_all())
+
+def pairs(tdb, env, num=200):
+    rnd = random.Random(env['seed'])
+    k0, k1 = tdb.lexicon('k0'), tdb.lexicon('k1')
+    return [(rnd.choice(k0), rnd.choice(k1)) for i in xrange(num)]
+
+@benchmark('sets')
+def merge_and(tdb, fdb, env):
+    sets = [fdb.query('k0=%s & k1=%s' % pair) for pair in pairs(tdb, env)]
+    return sum(1 for s in sets if len(s) >= 0)
+
+@benchmark('sets')
+def merge_or(tdb, fdb, env):
+    sets = [fdb.query('k0=%s | k1=%s' % pair) for pair in pairs(tdb, env)]
+    return sum(1 for s in sets if len(s) >= 0)
+
+@benchmark('sets')
+def merge_small_and_dense(tdb, fdb, env):
+    sets = [fdb.query('k1=%s & /m0' % k1) for k0, k1 in pairs(tdb, env)]
+    return sum(1 for s in sets if len(s) >= 0)
+
+def run(path, opts):
+    names = set(opts.benchmark or [b.__name__ for b in BENCHMARKS])
+    work = opts.dir or tempfile.mkdtemp(prefix='trpy-bench-')
+    params = {'num_trails': opts.trails,
+              'mean_length': opts.mean_length,
+              'skew': opts.skew,
+              'cards': opts.card or [10, 1000],
+              'mask_arity': opts.mask_arity,
+              'seed': opts.seed}
+    env = {'tdb': os.path.join(work, 'synth'),
+           'fdb': os.path.join(work, 'synth.fdb'),
+           'seed': opts.seed}
+    start = time.time()
+    setup = isolated(synthesize, env['tdb'], **params)
+    if 'error' in setup:
+        sys.exit("Could not generate TrailDB: %s" % setup['error'])
+    setup = isolated(lambda: make(TDB(env['tdb'])).dump(open(env['fdb'], 'w')))
+    if 'error' in setup:
+        sys.exit("Could not build FunnelDB: %s" % setup['error'])
+    results = {'params': params,
+               'setup_seconds': time.time() - start,
+               'platform': platform.platform(),
+               'python': platform.python_version(),
+               'cpus': cpu_count(),
+               'time': time.time(),
+               'benchmarks': {}}
+    for fun in BENCHMARKS:
+        if fun.__name__ not in names:
+            continue
+        best = None
+        for i in xrange(opts.repeat):
+            out = isolated(timed, fun, env)
+            if 'error' in out:
+                best = {'error': out['error']}
+                break
+            units, seconds = out['result']
+            if best is None or seconds < best['seconds']:
+                best = {'unit': fun.unit,
+                        'units': units,
+                        'seconds': seconds,
+                        'rate': units / seconds if seconds else float('inf'),
+                        'peak_rss_kb': out['peak_rss_kb']}
+        results['benchmarks'][fun.__name__] = best
+        if 'error' in best:
+            print('%-24s %s' % (fun.__name__, best['error']))
+        else:
+            print('%-24s %12.0f %-6s/s %10.3fs %10d KB' %
+                  (fun.__name__, best['rate'], best['unit'], best['seconds'], best['peak_rss_kb']))
+    json.dump(results, open(path, 'w'), indent=2, sort_keys=True)
+
+def compare(before, after, opts):
+    a, b = json.load(open(before)), json.load(open(after))
+    if a['params'] != b['params']:
+        print('warning: runs used different parameters')
+    regressed = []
+    print('%-24s %14s %14s %8s' % ('benchmark', 'before', 'after', 'change'))
+    for name in sorted(set(a['benchmarks']) | set(b['benchmarks'])):
+        x, y = a['benchmarks'].get(name), b['benchmarks'].get(name)
+        if not x or not y or 'error' in x or 'error' in y:
+            print('%-24s %14s %14s' % (name, x and x.get('rate', '-'), y and y.get('rate', '-')))
+            continue
+        change = y['rate'] / x['rate'] - 1 if x['rate'] else 0
+        flag = ''
+        if change < -opts.threshold:
+            regressed.append(name)
+            flag = ' <-'
+        print('%-24s %14.0f %14.0f %+7.1f%%%s' % (name, x['rate'], y['rate'], 100 * change, flag))
+    if regressed:
+        sys.exit("Regressed: %s" % ', '.join(regressed))
+
+def main():
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('command')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('-d', '--dir')
+    parser.add_argument('-t', '--trails', type=int, default=100000)
+    parser.add_argument('-l', '--mean-length', type=int, default=20)
+    parser.add_argument('-s', '--skew', type=float, default=2.0)
+    parser.add_argument('-c', '--card', type=int, action='append')
+    parser.add_argument('-m', '--mask-arity', type=int, default=8)
+    parser.add_argument('-r', '--seed', type=int, default=0)
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('-b', '--benchmark', action='append')
+    parser.add_argument('-x', '--threshold', type=float, default=0.1)
+    opts = parser.parse_args()
+    if opts.command == 'run':
+        run(opts.paths[0], opts)
+    elif opts.command == 'compare' and len(opts.paths) == 2:
+        compare(opts.paths[0], opts.paths[1], opts)
+    else:
+        print(__doc__)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+ synth.py TRAILDB [-t TRAILS] [-l MEAN-LENGTH] [-s SKEW] [-c CARD ...] [-m MASK-ARITY] [-r SEED]
+
+ Generate a synthetic TrailDB with a mask field 'kind' and key fields 'k0', 'k1', ...
+ Trail lengths follow a Pareto distribution (a smaller skew gives longer tails),
+ key values are drawn with a heavy head, so FunnelDB rows range from dense to sparse.
+"""
+
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from trpy import TDBCons
+
+def fields(cards):
+    return ['kind'] + ['k%d' % i for i in xrange(len(cards))]
+
+def rows(num_trails=10000, mean_length=20, skew=2.0, cards=(10, 1000), mask_arity=8, seed=0):
+    """
+    Generate the (cookie, timestamp, values) rows of a synthetic TrailDB.
+    The same arguments always generate the same rows.
+    """
+    rnd = random.Random(seed)
+    scale = mean_length * (skew - 1) / skew if skew > 1 else mean_length
+    kinds = ['m%d' % i for i in xrange(mask_arity)]
+    for trail in xrange(num_trails):
+        cookie = '%032x' % rnd.getrandbits(128)
+        length = max(1, int(scale * rnd.paretovariate(skew)))
+        time = 1400000000 + rnd.randrange(86400 * 30)
+        for event in xrange(length):
+            time += rnd.randrange(600)
+            values = [kinds[int(mask_arity * rnd.random() ** 2)]]
+            values += ['v%d' % int(card * rnd.random() ** 3) for card in cards]
+            yield cookie, time, values
+
+def synthesize(path, cards=(10, 1000), **kwds):
+    """
+    Write a synthetic TrailDB to path, see rows for the parameters.
+    """
+    cons = TDBCons(path, fields(cards))
+    cons.add_rows(rows(cards=cards, **kwds))
+    cons.finalize()
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('path')
+    parser.add_argument('-t', '--trails', type=int, default=10000)
+    parser.add_argument('-l', '--mean-length', type=int, default=20)
+    parser.add_argument('-s', '--skew', type=float, default=2.0)
+    parser.add_argument('-c', '--card', type=int, action='append')
+    parser.add_argument('-m', '--mask-arity', type=int, default=8)
+    parser.add_argument('-r', '--seed', type=int, default=0)
+    opts = parser.parse_args()
+    synthesize(opts.path,
+               num_trails=opts.trails,
+               mean_length=opts.mean_length,
+               skew=opts.skew,
+               cards=opts.card or (10, 1000),
+               mask_arity=opts.mask_arity,
+               seed=opts.seed)
+
+if __name__ == '__main__':
+    main()
@@ -9,4 +9,5 @@ setup(name='trpy',
       scripts=['bin/trpy', 'bin/fnky'],
       cffi_modules=['trpy/__ffic__.py:ffic'],
       setup_requires=['cffi>=1.0.0'],
-      install_requires=['cffi>=1.0.0'])
+      install_requires=['cffi>=1.0.0'],
+      extras_require={'numpy': ['numpy']})
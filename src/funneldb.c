@@ -1,9 +1,12 @@
 #include <limits.h>
+#include <math.h>
+#include <pthread.h>
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
 #include <sys/mman.h>
 #include <sys/stat.h>
+#include <time.h>
 #include <unistd.h>
 #include <traildb.h>
 
@@ -16,31 +19,187 @@
 
 #define MIN(a, b) (a < b ? a : b)
 
+/* The number of possible mask values */
+#define FDB_NUM_MASKS (1 << (8 * sizeof(fdb_mask)))
+/* Rows shorter than this are counted one element at a time */
+#define FDB_SCAN_MIN 4096
+/* Dense rows with CNFs of up to this many clauses are counted word-wise */
+#define FDB_SWAR_MAX 8
+
+/* Every 16-bit lane of a word holds the same value */
+#define FDB_LANES(x) ((uint64_t)(x) * 0x0001000100010001LLU)
+
+/* The val of a value missing from a TrailDB */
+#define FDB_NO_VAL ((tdb_val)-1)
+
+/* Rows begin on 8 byte boundaries */
+#define FDB_ALIGN(x) (((x) + 7) & ~7LLU)
+
+#define fdb_funnel_data(db, funnel) ((uint8_t *)(db) + (db)->data_offs + (funnel)->offs)
+
+/* The bytes taken by the histogram or sketch after a row */
+#define fdb_hist_size(num_masks) (sizeof(fdb_hist) + (num_masks) * sizeof(fdb_tally))
+#define fdb_sketch_size(num_hashes) (sizeof(fdb_sketch) + (num_hashes) * (sizeof(uint64_t) + sizeof(fdb_mask)))
+
+/* The storage chosen for a row when packing */
+typedef struct {
+  uint8_t flags;
+  fdb_eid length;
+  fdb_eid num_chunks;
+  uint64_t size;
+} fdb_layout;
+
+static fdb *fdb_pack(fdb *db, uint64_t num_ids);
+static fdb *fdb_index(fdb *db, const fdb_opts *opts);
+
+/* Each worker folds over its own range of trails, with its own counters */
+typedef struct {
+  const tdb *tdb;
+  tdb_fold_fn probe;
+  uint64_t start;
+  uint64_t stop;
+  fdb_cons cons;
+  uint64_t num_events;
+  int replay;
+  pthread_t thread;
+  int running;
+} fdb_worker;
+
+/* Store the elements buffered by a single pass: first those spilled, then those still in memory */
+static
+void fdb_replay(fdb_cons *cons) {
+  fdb_elem elems[4096];
+  fdb_buffer *buffer;
+  fdb_fid funnel_id;
+  fdb_eid length, i, k, n;
+  if (cons->spill) {
+    rewind(cons->spill);
+    while (fread(&funnel_id, sizeof(fdb_fid), 1, cons->spill) == 1 &&
+           fread(&length, sizeof(fdb_eid), 1, cons->spill) == 1) {
+      for (k = 0; k < length; k += n) {
+        if (!(n = fread(elems, sizeof(fdb_elem), MIN(length - k, 4096), cons->spill))) {
+          perror("fread");
+          cons->error = 1;
+          return;
+        }
+        for (i = 0; i < n; i++)
+          fdb_detect(funnel_id, elems[i].id, elems[i].mask, cons);
+      }
+    }
+  }
+  for (funnel_id = 0; funnel_id < cons->num_funnels; funnel_id++) {
+    buffer = &cons->buffers[funnel_id];
+    for (i = 0; i < buffer->length; i++)
+      fdb_detect(funnel_id, buffer->elems[i].id, buffer->elems[i].mask, cons);
+    free(buffer->elems);
+    memset(buffer, 0, sizeof(fdb_buffer));
+  }
+}
+
+/* Count each event on its way to the real probe */
+static
+void *fdb_probe(const tdb *db, uint64_t id, const tdb_event *event, void *acc) {
+  fdb_worker *worker = (fdb_worker *)acc;
+  worker->num_events++;
+  worker->probe(db, id, event, &worker->cons);
+  return acc;
+}
+
+static
+void *fdb_work(void *arg) {
+  fdb_worker *worker = (fdb_worker *)arg;
+  if (worker->replay)
+    fdb_replay(&worker->cons);
+  else
+    tdb_fold_range(worker->tdb, NULL, worker->start, worker->stop, fdb_probe, worker);
+  return NULL;
+}
+
+/* Run all the workers to completion, the first one on the calling thread.
+   If a thread can't be started, its worker just runs on the calling thread too. */
+static
+void fdb_work_all(fdb_worker *workers, unsigned int num_workers) {
+  unsigned int t;
+  for (t = 1; t < num_workers; t++)
+    workers[t].running = !pthread_create(&workers[t].thread, NULL, fdb_work, &workers[t]);
+  fdb_work(&workers[0]);
+  for (t = 1; t < num_workers; t++) {
+    if (workers[t].running)
+      pthread_join(workers[t].thread, NULL);
+    else
+      fdb_work(&workers[t]);
+  }
+}
+
+static
+double fdb_clock(void) {
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return now.tv_sec + now.tv_nsec * 1e-9;
+}
+
 /* FunnelDB creation uses a probe to determine which funnels an event occurs in.
    The total number of funnels must be known in advance.
-   Params data is stored in the DB, but is limited to FDB_PARAMS bytes. */
-fdb *fdb_create(tdb *tdb, tdb_fold_fn probe, fdb_fid num_funnels, void *params) {
+   Params data is stored in the DB, but is limited to FDB_PARAMS bytes.
+   With multiple threads, each scans a contiguous range of trails,
+   so the probe must be safe to call concurrently (with different states).
+   In a single pass, elements are buffered instead of scanning the TrailDB twice,
+   the buffers get spilled to temporary files when they grow too large. */
+fdb *fdb_create(tdb *tdb, tdb_fold_fn probe, fdb_fid num_funnels, void *params, const fdb_opts *opts) {
+  unsigned int t, num_workers = opts && opts->num_threads ? opts->num_threads : 1;
+  int single_pass = opts && opts->single_pass, error = 0;
+  fdb_stats *stats = opts ? opts->stats : NULL;
+  double clock = fdb_clock(), scanned = 0, stored = 0;
+  uint64_t N = tdb_num_trails(tdb);
   fdb *db = NULL;
-  fdb_cons cons = {};
-  cons.counters = calloc(num_funnels, sizeof(fdb_counter));
-  cons.funnels = calloc(num_funnels, sizeof(fdb_funnel));
-  cons.params = params;
-  if (cons.counters == NULL || cons.funnels == NULL)
+  fdb_funnel *funnels = calloc(num_funnels, sizeof(fdb_funnel));
+  fdb_worker *workers = calloc(num_workers, sizeof(fdb_worker));
+  if (funnels == NULL || workers == NULL)
     goto done;
+  for (t = 0; t < num_workers; t++) {
+    workers[t].tdb = tdb;
+    workers[t].probe = probe;
+    workers[t].start = N * t / num_workers;
+    workers[t].stop = N * (t + 1) / num_workers;
+    workers[t].cons.funnels = funnels;
+    workers[t].cons.params = params;
+    workers[t].cons.num_funnels = num_funnels;
+    if ((workers[t].cons.counters = calloc(num_funnels, sizeof(fdb_counter))) == NULL)
+      goto done;
+    if (single_pass) {
+      workers[t].cons.phase = 2;
+      workers[t].cons.max_buffered = (opts->max_buffered + num_workers - 1) / num_workers;
+      if ((workers[t].cons.buffers = calloc(num_funnels, sizeof(fdb_buffer))) == NULL)
+        goto done;
+    }
+  }
 
   /* Run through the TrailDB once to figure out how much space is needed,
-     and whether each funnel is dense or sparse */
-  tdb_fold(tdb, NULL, probe, &cons);
+     and whether each funnel is dense or sparse (buffering the elements in a single pass) */
+  fdb_work_all(workers, num_workers);
+  for (t = 0; t < num_workers; t++)
+    error |= workers[t].cons.error;
+  if (error)
+    goto done;
+  scanned = fdb_clock();
 
-  uint64_t data_size = 0, N = tdb_num_trails(tdb), dense_size = N * sizeof(fdb_mask);
+  uint64_t data_size = 0, dense_size = N * sizeof(fdb_mask);
+  int64_t count, total;
   fdb_counter *counter;
   fdb_funnel *funnel;
   fdb_fid i;
   for (i = 0; i < num_funnels; i++) {
-    counter = &cons.counters[i];
-    funnel = &cons.funnels[i];
-    funnel->offs = data_size;
-    funnel->length = (fdb_eid)counter->count;
+    funnel = &funnels[i];
+    funnel->offs = data_size = FDB_ALIGN(data_size);
+    /* the elements of each range of trails go right after those of the previous range */
+    for (total = 0, t = 0; t < num_workers; t++) {
+      counter = &workers[t].cons.counters[i];
+      count = counter->count;
+      counter->count = total - 1;
+      counter->last = -1;
+      total += count;
+    }
+    funnel->length = (fdb_eid)total;
     if (funnel->length * sizeof(fdb_elem) > dense_size) {
       funnel->flags |= FDB_DENSE;
       funnel->length = (fdb_eid)N;
@@ -49,8 +208,6 @@ fdb *fdb_create(tdb *tdb, tdb_fold_fn probe, fdb_fid num_funnels, void *params)
       funnel->flags |= FDB_SPARSE;
       data_size += funnel->length * sizeof(fdb_elem);
     }
-    counter->count = -1;
-    counter->last = -1;
   }
 
   /* Allocate memory and copy the header + table of contents
@@ -67,19 +224,109 @@ fdb *fdb_create(tdb *tdb, tdb_fold_fn probe, fdb_fid num_funnels, void *params)
   if (params)
     memcpy(db->params, params, FDB_PARAMS);
   db->num_funnels = num_funnels;
-  memcpy(db->funnels, cons.funnels, num_funnels * sizeof(fdb_funnel));
+  db->version = FDB_VERSION;
+  memcpy(db->funnels, funnels, num_funnels * sizeof(fdb_funnel));
 
-  /* Run through the TrailDB again to actually store the funnel data */
-  cons.data = ((uint8_t *)db) + db->data_offs;
-  cons.phase = 1;
-  tdb_fold(tdb, NULL, probe, &cons);
+  /* Run through the TrailDB again (or the buffers) to actually store the funnel data */
+  for (t = 0; t < num_workers; t++) {
+    workers[t].cons.data = ((uint8_t *)db) + db->data_offs;
+    workers[t].cons.phase = 1;
+    workers[t].replay = single_pass;
+  }
+  fdb_work_all(workers, num_workers);
+  for (t = 0; t < num_workers; t++)
+    error |= workers[t].cons.error;
+  if (error) {
+    db = fdb_free(db);
+    goto done;
+  }
+  stored = fdb_clock();
+
+  /* Now that the contents of each row are known, store each in its smallest form */
+  db = fdb_pack(db, N);
+  if (opts && (opts->index || opts->sketch_size))
+    db = fdb_index(db, opts);
+
+  if (stats) {
+    memset(stats, 0, sizeof(fdb_stats));
+    stats->scan_time = scanned - clock;
+    stats->store_time = stored - scanned;
+    stats->pack_time = fdb_clock() - stored;
+    stats->num_trails = single_pass ? N : 2 * N;
+    for (t = 0; t < num_workers; t++) {
+      stats->num_events += workers[t].num_events;
+      stats->num_spilled += workers[t].cons.spilled;
+    }
+    fdb_get_stats(db, stats);
+  }
 
  done:
-  free(cons.counters);
-  free(cons.funnels);
+  if (workers) {
+    for (t = 0; t < num_workers; t++) {
+      fdb_cons *cons = &workers[t].cons;
+      if (cons->buffers) {
+        fdb_fid i;
+        for (i = 0; i < num_funnels; i++)
+          free(cons->buffers[i].elems);
+        free(cons->buffers);
+      }
+      if (cons->spill)
+        fclose(cons->spill);
+      free(cons->counters);
+    }
+  }
+  free(workers);
+  free(funnels);
   return db;
 }
 
+/* Write out all the buffered elements of a cons, and free the buffers.
+   Each spill is a sequence of (funnel id, length, elements) records. */
+static
+void fdb_spill(fdb_cons *cons) {
+  fdb_buffer *buffer;
+  fdb_fid i;
+  if (cons->spill == NULL && (cons->spill = tmpfile()) == NULL) {
+    perror("tmpfile");
+    cons->error = 1;
+    return;
+  }
+  for (i = 0; i < cons->num_funnels; i++) {
+    buffer = &cons->buffers[i];
+    if (buffer->length) {
+      if (fwrite(&i, sizeof(fdb_fid), 1, cons->spill) != 1 ||
+          fwrite(&buffer->length, sizeof(fdb_eid), 1, cons->spill) != 1 ||
+          fwrite(buffer->elems, sizeof(fdb_elem), buffer->length, cons->spill) != buffer->length) {
+        perror("fwrite");
+        cons->error = 1;
+      }
+      cons->spilled += sizeof(fdb_fid) + sizeof(fdb_eid) + buffer->length * sizeof(fdb_elem);
+    }
+    free(buffer->elems);
+    memset(buffer, 0, sizeof(fdb_buffer));
+  }
+  cons->buffered = 0;
+}
+
+static
+void fdb_buffer_add(fdb_cons *cons, fdb_buffer *buffer, fdb_eid id, fdb_mask bits) {
+  if (buffer->length == buffer->capacity) {
+    fdb_eid capacity = buffer->capacity ? 2 * buffer->capacity : 4;
+    fdb_elem *elems = realloc(buffer->elems, capacity * sizeof(fdb_elem));
+    if (elems == NULL) {
+      cons->error = 1;
+      return;
+    }
+    cons->buffered += (capacity - buffer->capacity) * sizeof(fdb_elem);
+    buffer->elems = elems;
+    buffer->capacity = capacity;
+  }
+  buffer->elems[buffer->length].id = id;
+  buffer->elems[buffer->length++].mask = bits;
+  if (cons->max_buffered && cons->buffered > cons->max_buffered)
+    fdb_spill(cons);
+}
+
 /* Probe functions call fdb_detect when they want to emit a funnel for an event.
    fdb_detect takes care of the details of how to store the info. */
 void fdb_detect(fdb_fid funnel_id, fdb_eid id, fdb_mask bits, fdb_cons *cons) {
@@ -89,7 +336,7 @@ void fdb_detect(fdb_fid funnel_id, fdb_eid id, fdb_mask bits, fdb_cons *cons) {
       counter->last = id;
       counter->count++;
     }
-  } else {                /* storage phase */
+  } else if (cons->phase == 1) { /* storage phase */
     fdb_funnel *funnel = &cons->funnels[funnel_id];
     if (funnel->flags & FDB_DENSE) {
       fdb_mask *mask = (fdb_mask *)&cons->data[funnel->offs];
@@ -100,6 +347,17 @@ void fdb_detect(fdb_fid funnel_id, fdb_eid id, fdb_mask bits, fdb_cons *cons) {
         elem[++counter->count].id = counter->last = id;
       elem[counter->count].mask |= bits;
     }
+  } else {                /* buffering phase: count like allocation, but keep the elements */
+    fdb_buffer *buffer = &cons->buffers[funnel_id];
+    if (counter->last < id || counter->count == 0) {
+      counter->last = id;
+      counter->count++;
+    } else if (buffer->length) {
+      buffer->elems[buffer->length - 1].mask |= bits;
+      return;
+    }
+    /* a new id, or one whose first element was spilled: they get merged on replay */
+    fdb_buffer_add(cons, buffer, id, bits);
   }
 }
 
@@ -107,30 +365,48 @@ void fdb_detect(fdb_fid funnel_id, fdb_eid id, fdb_mask bits, fdb_cons *cons) {
    The user specifies which fields (or combinations) they are interested in.
    Funnels are created for every possible value of those fields.
    The user also specifies which field to use for the mask.
-   The mask uses 1 bit for every possible value in the mask field. */
+   The mask uses 1 bit for every possible value in the mask field.
+   With layers, there is a copy of every funnel for each layer,
+   and the bits of each layer's mask are the vals in its range of its field.
+   With time buckets, there is a copy of all those for each bucket,
+   and events only go into the bucket their timestamp falls in. */
 static
 void *fdb_ezprobe(const tdb *db, uint64_t id, const tdb_event *event, void *acc) {
   fdb_cons *cons = (fdb_cons *)acc;
   fdb_ez *params = (fdb_ez *)cons->params;
-  fdb_mask mask = params->mask_field ? 1LLU << tdb_item_val(event->items[params->mask_field - 1]) : 1;
-  fdb_fid key, *O = params->key_offs;
+  fdb_mask mask = params->mask_field && !params->num_layers ? 1LLU << tdb_item_val(event->items[params->mask_field - 1]) : 1;
+  fdb_fid key, bucket = 0, *O = params->key_offs;
   tdb_field k, *K = params->key_fields;
-  unsigned int i, j = 0, N = params->num_keys;
+  tdb_val val;
+  unsigned int i, j = 0, l, N = params->num_keys;
+  if (params->num_buckets) {
+    uint64_t b = (event->timestamp - params->bucket_start) / params->bucket_width;
+    if (event->timestamp < params->bucket_start || b >= params->num_buckets)
+      return acc; /* outside of every bucket */
+    bucket = (fdb_fid)b * params->bucket_size;
+  }
   /* compute the funnel id: much like a 1-D index for N-D matrix elements */
   for (i = 0; i < N; i++) {
-    for (key = j ? O[j - 1] : 0; (k = K[j]); j++)
+    for (key = bucket + (j ? O[j - 1] : 0); (k = K[j]); j++)
       key += tdb_item_val(event->items[k - 1]) * O[j];
     j++;
-    fdb_detect(key, (fdb_eid)id, mask, cons); /* emit funnel + mask */
+    if (!params->num_layers) {
+      fdb_detect(key, (fdb_eid)id, mask, cons); /* emit funnel + mask */
+      continue;
+    }
+    for (l = 0; l < params->num_layers; l++) {
+      val = tdb_item_val(event->items[params->layer_fields[l] - 1]) - params->layer_bases[l];
+      if (val < 8 * sizeof(fdb_mask)) /* the val is in the layer (unsigned, so not below either) */
+        fdb_detect(l * params->layer_size + key, (fdb_eid)id, 1LLU << val, cons);
+    }
   }
   return acc;
 }
 
-/* The easy way to construct a FunnelDB using the fdb_ezprobe.
-   Every field (or combination) the user is interested in,
-   has number of funnels given by the product of the cardinality of the fields.
-   Compute total number of funnels, sanity check mask, and create the DB. */
-fdb *fdb_easy(tdb *tdb, fdb_ez *params) {
+/* Compute the offsets of the funnels for the fields of a TrailDB, and check the mask.
+   Returns the total number of funnels, or FDB_NO_FUNNEL if the params are no good. */
+static
+fdb_fid fdb_ez_init(const tdb *tdb, fdb_ez *params) {
   fdb_fid num_funnels = 0, size = 0, *O = params->key_offs;
   tdb_field k, *K = params->key_fields;
   unsigned int i, j = 0, N = params->num_keys;
@@ -141,11 +417,385 @@ fdb *fdb_easy(tdb *tdb, fdb_ez *params) {
     }
     O[j++] = num_funnels += size;
   }
-  if (params->mask_field && tdb_lexicon_size(tdb, params->mask_field) > 8 * sizeof(fdb_mask)) {
+  if (params->num_layers) {
+    if (params->num_layers > FDB_EZ_LAYERS || (uint64_t)num_funnels * params->num_layers >= FDB_NO_FUNNEL) {
+      fprintf(stderr, "fdb_easy: too many mask layers\n");
+      return FDB_NO_FUNNEL;
+    }
+    for (i = 0; i < params->num_layers; i++) {
+      if (!params->layer_fields[i] || params->layer_fields[i] >= tdb_num_fields(tdb)) {
+        fprintf(stderr, "fdb_easy: invalid mask layer field %u\n", params->layer_fields[i]);
+        return FDB_NO_FUNNEL;
+      }
+    }
+    params->layer_size = num_funnels;
+    num_funnels *= params->num_layers;
+  } else if (params->mask_field && tdb_lexicon_size(tdb, params->mask_field) > 8 * sizeof(fdb_mask)) {
     perror("mask field cardinality too high");
+    return FDB_NO_FUNNEL;
+  }
+  if (params->num_buckets) {
+    if (!params->bucket_width || (uint64_t)num_funnels * params->num_buckets >= FDB_NO_FUNNEL) {
+      fprintf(stderr, "fdb_easy: too many time buckets\n");
+      return FDB_NO_FUNNEL;
+    }
+    params->bucket_size = num_funnels;
+    num_funnels *= params->num_buckets;
+  }
+  return num_funnels;
+}
+
+/* The easy way to construct a FunnelDB using the fdb_ezprobe.
+   Every field (or combination) the user is interested in,
+   has number of funnels given by the product of the cardinality of the fields.
+   Compute total number of funnels, sanity check mask, and create the DB.
+   Layers repeat the funnels, so a wide mask field can be split over several,
+   and several mask fields can be built in the same scan. */
+fdb *fdb_easy(tdb *tdb, fdb_ez *params, const fdb_opts *opts) {
+  fdb_fid num_funnels = fdb_ez_init(tdb, params);
+  if (num_funnels == FDB_NO_FUNNEL)
+    return NULL;
+  return fdb_create(tdb, fdb_ezprobe, num_funnels, params, opts);
+}
+
+/* Map the vals of a field in one TrailDB to the vals of the same values in another.
+   Values the other TrailDB lacks map to FDB_NO_VAL. */
+static
+tdb_val *fdb_val_map(const tdb *other, const tdb *db, tdb_field field) {
+  uint64_t len, size = tdb_lexicon_size(other, field);
+  tdb_val val, *map = calloc(size ? size : 1, sizeof(tdb_val));
+  const char *value;
+  tdb_item item;
+  if (map == NULL)
+    return NULL;
+  for (val = 1; val < size; val++) {
+    map[val] = FDB_NO_VAL;
+    if ((value = tdb_get_value(other, field, val, &len)))
+      if ((item = tdb_get_item(db, field, value, len)))
+        map[val] = tdb_item_val(item);
+  }
+  return map;
+}
+
+/* The (layer, bit) of a val of a mask field, given the params of an easy FunnelDB.
+   Returns 0 if the val has no bit. */
+static
+int fdb_ez_bit(const fdb_ez *params, tdb_field field, tdb_val val, unsigned int *layer, uint8_t *bit) {
+  unsigned int l;
+  if (!params->num_layers) {
+    *layer = 0;
+    *bit = params->mask_field ? val : 0;
+    return params->mask_field == field && val < 8 * sizeof(fdb_mask);
+  }
+  for (l = 0; l < params->num_layers; l++) {
+    if (params->layer_fields[l] == field && val - params->layer_bases[l] < 8 * sizeof(fdb_mask)) {
+      *layer = l;
+      *bit = val - params->layer_bases[l];
+      return 1;
+    }
+  }
+  return 0;
+}
+
+/* Map each mask bit of each row of an easy FunnelDB built from other,
+   to a row and bit of one with the given params built from db.
+   Key vals and mask vals are translated through their values,
+   time buckets must have the same width, and line up with the new ones.
+   Returns non-zero if the params do not have the same fields. */
+static
+int fdb_ez_map(const fdb *src, const tdb *other, const tdb *db, const fdb_ez *params,
+               fdb_fid *funnels, uint8_t *bits) {
+  const fdb_ez *old = (const fdb_ez *)src->params;
+  const unsigned int B = 8 * sizeof(fdb_mask);
+  unsigned int l, layer, num_layers = old->num_layers ? old->num_layers : 1;
+  fdb_fid bucket_size = old->num_buckets ? old->bucket_size : src->num_funnels;
+  fdb_fid layer_size = old->num_layers ? old->layer_size : bucket_size;
+  fdb_fid f, r, key, row, base, new_base, bucket;
+  int64_t shift = 0;
+  tdb_field mask_field;
+  tdb_val val, **keys = calloc(FDB_EZ_MAX, sizeof(tdb_val *)), **masks = calloc(num_layers, sizeof(tdb_val *));
+  unsigned int i, j, b, first;
+  uint8_t bit;
+  int error = -1;
+  if (keys == NULL || masks == NULL)
+    goto done;
+  if (old->num_keys != params->num_keys || memcmp(old->key_fields, params->key_fields, sizeof(old->key_fields)))
+    goto done;
+  if (!old->num_buckets != !params->num_buckets)
+    goto done;
+  if (old->num_buckets) {
+    shift = (int64_t)old->bucket_start - (int64_t)params->bucket_start;
+    if (old->bucket_width != params->bucket_width || shift % (int64_t)params->bucket_width)
+      goto done;
+    shift /= (int64_t)params->bucket_width;
+  }
+  for (j = 0; j < FDB_EZ_MAX; j++)
+    if (old->key_fields[j] && !(keys[j] = fdb_val_map(other, db, old->key_fields[j])))
+      goto done;
+  for (l = 0; l < num_layers; l++) {
+    mask_field = old->num_layers ? old->layer_fields[l] : old->mask_field;
+    if (mask_field && !(masks[l] = fdb_val_map(other, db, mask_field)))
+      goto done;
+  }
+
+  for (f = 0; f < src->num_funnels; f++) {
+    /* find the key group of the row, and the row with the same key vals */
+    bucket = f / bucket_size;
+    l = f % bucket_size / layer_size;
+    key = f % bucket_size % layer_size;
+    row = FDB_NO_FUNNEL;
+    for (i = 0, j = 0, base = 0, new_base = 0; i < old->num_keys; i++, j++) {
+      for (first = j; old->key_fields[j]; j++)
+        ;
+      if (key < old->key_offs[j]) {
+        for (r = key - base, row = new_base; j-- > first; r %= old->key_offs[j]) {
+          val = keys[j][r / old->key_offs[j]];
+          if (val == FDB_NO_VAL) {
+            row = FDB_NO_FUNNEL;
+            break;
+          }
+          row += val * params->key_offs[j];
+        }
+        break;
+      }
+      base = old->key_offs[j];
+      new_base = params->key_offs[j];
+    }
+    /* in the bucket with the same times */
+    if (old->num_buckets && row != FDB_NO_FUNNEL) {
+      if (bucket + shift < 0 || bucket + shift >= params->num_buckets)
+        row = FDB_NO_FUNNEL;
+      else
+        row += (fdb_fid)(bucket + shift) * params->bucket_size;
+    }
+    /* then the layer and bit of the val of each mask bit */
+    mask_field = old->num_layers ? old->layer_fields[l] : old->mask_field;
+    for (b = 0; b < B; b++) {
+      funnels[(uint64_t)f * B + b] = FDB_NO_FUNNEL;
+      if (row == FDB_NO_FUNNEL)
+        continue;
+      if (!mask_field) {
+        if (!b)
+          funnels[(uint64_t)f * B] = row;
+        bits[(uint64_t)f * B] = 0;
+        continue;
+      }
+      val = (old->num_layers ? old->layer_bases[l] : 0) + b;
+      if (val >= tdb_lexicon_size(other, mask_field) || masks[l][val] == FDB_NO_VAL)
+        continue;
+      if (fdb_ez_bit(params, mask_field, masks[l][val], &layer, &bit)) {
+        funnels[(uint64_t)f * B + b] = layer * (params->num_layers ? params->layer_size : 0) + row;
+        bits[(uint64_t)f * B + b] = bit;
+      }
+    }
+  }
+  error = 0;
+
+ done:
+  if (keys)
+    for (j = 0; j < FDB_EZ_MAX; j++)
+      free(keys[j]);
+  if (masks)
+    for (l = 0; l < num_layers; l++)
+      free(masks[l]);
+  free(keys);
+  free(masks);
+  return error;
+}
+
+/* Merge easy FunnelDBs built from other TrailDBs (such as an old one and a delta),
+   into one for a TrailDB that contains them all, without scanning it.
+   The params give the fields, like for fdb_easy, and the funnels are laid out for the TrailDB.
+   Elements are matched up by cookie, rows and mask bits by the values of their fields. */
+fdb *fdb_easy_merge(tdb *db, fdb_ez *params, fdb **fdbs, tdb **tdbs, unsigned int num_fdbs, const fdb_opts *opts) {
+  const unsigned int B = 8 * sizeof(fdb_mask);
+  fdb_fid num_funnels = fdb_ez_init(db, params);
+  fdb_merge_src *srcs = calloc(num_fdbs, sizeof(fdb_merge_src));
+  uint64_t *ids, num_maps;
+  fdb_fid *funnels;
+  uint8_t *bits;
+  fdb *merged = NULL;
+  unsigned int s;
+  if (num_funnels == FDB_NO_FUNNEL || srcs == NULL)
+    goto done;
+  for (s = 0; s < num_fdbs; s++) {
+    num_maps = (uint64_t)fdbs[s]->num_funnels * B + 1;
+    srcs[s].db = fdbs[s];
+    srcs[s].ids = ids = malloc((tdb_num_trails(tdbs[s]) + 1) * sizeof(uint64_t));
+    srcs[s].funnels = funnels = malloc(num_maps * sizeof(fdb_fid));
+    srcs[s].bits = bits = calloc(num_maps, 1);
+    if (ids == NULL || funnels == NULL || bits == NULL)
+      goto done;
+    tdb_trail_map(tdbs[s], db, ids);
+    if (fdb_ez_map(fdbs[s], tdbs[s], db, params, funnels, bits)) {
+      fprintf(stderr, "fdb_easy_merge: FunnelDB %u has different fields\n", s);
+      goto done;
+    }
+  }
+  merged = fdb_merge(srcs, num_fdbs, num_funnels, tdb_num_trails(db), params, opts);
+
+ done:
+  if (srcs) {
+    for (s = 0; s < num_fdbs; s++) {
+      free((void *)srcs[s].ids);
+      free((void *)srcs[s].funnels);
+      free((void *)srcs[s].bits);
+    }
+  }
+  free(srcs);
+  return merged;
+}
+
+static
+int fdb_elem_cmp(const void *a, const void *b) {
+  fdb_eid x = ((const fdb_elem *)a)->id, y = ((const fdb_elem *)b)->id;
+  return x < y ? -1 : x > y;
+}
+
+/* Merge the rows of FunnelDBs into a new one, translating their elements, rows and mask bits.
+   Elements with the same id in the same row are combined, with the union of their masks.
+   Each new row is bounded by the rows that map into it, and starts out dense or sparse,
+   then rows are packed into their smallest form, just like when they are created. */
+fdb *fdb_merge(const fdb_merge_src *srcs,
+               unsigned int num_srcs,
+               fdb_fid num_funnels,
+               uint64_t num_ids,
+               const void *params,
+               const fdb_opts *opts) {
+  const unsigned int B = 8 * sizeof(fdb_mask);
+  fdb_stats *stats = opts ? opts->stats : NULL;
+  double clock = fdb_clock(), stored;
+  uint64_t *bounds = calloc(num_funnels ? num_funnels : 1, sizeof(uint64_t));
+  uint64_t data_size = 0, dense_size = num_ids * sizeof(fdb_mask), id;
+  fdb_fid targets[8 * sizeof(fdb_mask)], t, f, i;
+  fdb_mask masks[8 * sizeof(fdb_mask)];
+  unsigned int s, b, n, which[8 * sizeof(fdb_mask)];
+  fdb_funnel *funnel;
+  fdb_elem *next, *elems;
+  fdb_iter *iter;
+  fdb *db = NULL;
+  if (bounds == NULL)
     return NULL;
+
+  /* Bound the length of each new row by the lengths of the rows that map into it */
+  for (s = 0; s < num_srcs; s++) {
+    for (f = 0; f < srcs[s].db->num_funnels; f++) {
+      for (n = 0, b = 0; b < B; b++) {
+        t = srcs[s].funnels[(uint64_t)f * B + b];
+        for (i = 0; i < n && targets[i] != t; i++)
+          ;
+        if (t != FDB_NO_FUNNEL && i == n)
+          bounds[targets[n++] = t] += srcs[s].db->funnels[f].length;
+      }
+    }
+  }
+
+  size_t size = fdb_offs(num_funnels);
+  for (f = 0; f < num_funnels; f++)
+    size += FDB_ALIGN(MIN(bounds[f] * sizeof(fdb_elem), dense_size));
+  db = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_ANON | MAP_PRIVATE, -1, 0);
+  if (db == MAP_FAILED) {
+    perror("mmap");
+    db = NULL;
+    goto done;
   }
-  return fdb_create(tdb, fdb_ezprobe, num_funnels, params);
+  db->data_offs = fdb_offs(num_funnels);
+  if (params)
+    memcpy(db->params, params, FDB_PARAMS);
+  db->num_funnels = num_funnels;
+  db->version = FDB_VERSION;
+  for (f = 0; f < num_funnels; f++) {
+    funnel = &db->funnels[f];
+    funnel->offs = data_size = FDB_ALIGN(data_size);
+    if (bounds[f] * sizeof(fdb_elem) > dense_size) {
+      funnel->flags = FDB_DENSE;
+      funnel->length = (fdb_eid)num_ids;
+      data_size += dense_size;
+    } else {
+      funnel->flags = FDB_SPARSE;
+      data_size += bounds[f] * sizeof(fdb_elem);
+    }
+  }
+  db->data_size = FDB_ALIGN(data_size);
+
+  /* Scatter the elements of each source row into the new rows its bits map to */
+  for (s = 0; s < num_srcs; s++) {
+    const fdb_merge_src *src = &srcs[s];
+    for (f = 0; f < src->db->num_funnels; f++) {
+      for (n = 0, b = 0; b < B; b++) {
+        t = src->funnels[(uint64_t)f * B + b];
+        for (i = 0; i < n && targets[i] != t; i++)
+          ;
+        if (i == n)
+          targets[n++] = t;
+        which[b] = i;
+      }
+      fdb_set row_set = {
+        .flags = FDB_SIMPLE,
+        .simple = {.db = (fdb *)src->db, .funnel_id = f}
+      };
+      if ((iter = fdb_iter_new(&row_set)) == NULL) {
+        db = fdb_free(db);
+        goto done;
+      }
+      while ((next = fdb_iter_next(iter))) {
+        if ((id = src->ids ? src->ids[next->id] : next->id) >= num_ids)
+          continue;
+        memset(masks, 0, sizeof(masks));
+        for (b = 0; b < B; b++)
+          if (next->mask & (1 << b) && src->funnels[(uint64_t)f * B + b] != FDB_NO_FUNNEL)
+            masks[which[b]] |= 1 << src->bits[(uint64_t)f * B + b];
+        for (i = 0; i < n; i++) {
+          if (targets[i] == FDB_NO_FUNNEL || !masks[i])
+            continue;
+          funnel = &db->funnels[targets[i]];
+          if (funnel->flags & FDB_DENSE) {
+            ((fdb_mask *)fdb_funnel_data(db, funnel))[id] |= masks[i];
+          } else {
+            elems = (fdb_elem *)fdb_funnel_data(db, funnel);
+            elems[funnel->length].id = (fdb_eid)id;
+            elems[funnel->length++].mask = masks[i];
+          }
+        }
+      }
+      fdb_iter_free(iter);
+    }
+  }
+
+  /* Put the elements of each sparse row in order, combining those with the same id */
+  for (f = 0; f < num_funnels; f++) {
+    funnel = &db->funnels[f];
+    if (!(funnel->flags & FDB_SPARSE) || !funnel->length)
+      continue;
+    elems = (fdb_elem *)fdb_funnel_data(db, funnel);
+    for (i = 1; i < funnel->length && elems[i - 1].id <= elems[i].id; i++)
+      ;
+    if (i < funnel->length)
+      qsort(elems, funnel->length, sizeof(fdb_elem), fdb_elem_cmp);
+    for (n = 0, i = 1; i < funnel->length; i++) {
+      if (elems[i].id == elems[n].id)
+        elems[n].mask |= elems[i].mask;
+      else
+        elems[++n] = elems[i];
+    }
+    funnel->length = n + 1;
+  }
+  stored = fdb_clock();
+
+  db = fdb_pack(db, num_ids);
+  if (opts && (opts->index || opts->sketch_size))
+    db = fdb_index(db, opts);
+
+  if (stats) {
+    memset(stats, 0, sizeof(fdb_stats));
+    stats->store_time = stored - clock;
+    stats->pack_time = fdb_clock() - stored;
+    fdb_get_stats(db, stats);
+  }
+
+ done:
+  free(bounds);
+  return db;
 }
 
 fdb *fdb_dump(fdb *db, int fd) {
@@ -174,6 +824,11 @@ fdb *fdb_load(int fd) {
     perror("mmap");
     return NULL;
   }
+  if (db->version > FDB_VERSION) {
+    fprintf(stderr, "fdb_load: unsupported version %u\n", db->version);
+    munmap(db, (size_t)buf.st_size);
+    return NULL;
+  }
   return db;
 }
 
@@ -182,6 +837,248 @@ fdb *fdb_free(fdb *db) {
   return NULL;
 }
 
+/* Get the stored form of a row: its table of contents entry and a pointer to its data */
+const uint8_t *fdb_get_row(const fdb *db, fdb_fid funnel_id, fdb_funnel *funnel) {
+  if (funnel_id >= db->num_funnels)
+    return NULL;
+  *funnel = db->funnels[funnel_id];
+  return fdb_funnel_data(db, funnel);
+}
+
+/* The bytes taken by the entries of a chunk */
+static inline
+uint64_t fdb_chunk_size(const fdb_chunk *chunk) {
+  return chunk->size * (chunk->type == FDB_CHUNK_ARRAY ? sizeof(uint16_t) + sizeof(fdb_mask) :
+                        chunk->type == FDB_CHUNK_MASKS ? sizeof(fdb_mask) : sizeof(fdb_run));
+}
+
+/* The bytes taken by the data of a row (not counting its index) */
+static
+uint64_t fdb_row_size(const fdb *db, const fdb_funnel *funnel) {
+  const fdb_chunked *chunked;
+  if (funnel->flags & FDB_DENSE)
+    return funnel->length * sizeof(fdb_mask);
+  if (funnel->flags & FDB_SPARSE)
+    return funnel->length * sizeof(fdb_elem);
+  /* the entries of the last chunk end the row */
+  chunked = (fdb_chunked *)fdb_funnel_data(db, funnel);
+  if (chunked->num_chunks)
+    return chunked->chunks[chunked->num_chunks - 1].offs +
+      fdb_chunk_size(&chunked->chunks[chunked->num_chunks - 1]);
+  return sizeof(fdb_chunked);
+}
+
+/* The histogram stored after an indexed row */
+static inline
+const fdb_hist *fdb_row_hist(const fdb *db, const fdb_funnel *funnel) {
+  return (fdb_hist *)(fdb_funnel_data(db, funnel) + FDB_ALIGN(fdb_row_size(db, funnel)));
+}
+
+/* The sketch stored after a sketched row (and its histogram, if it has one) */
+static inline
+const fdb_sketch *fdb_row_sketch(const fdb *db, const fdb_funnel *funnel) {
+  const uint8_t *end = (uint8_t *)fdb_row_hist(db, funnel);
+  if (funnel->flags & FDB_INDEXED)
+    end += FDB_ALIGN(fdb_hist_size(((fdb_hist *)end)->num_masks));
+  return (fdb_sketch *)end;
+}
+
+/* Fill in the layout part of the stats: how many rows are stored in each form, and their bytes */
+void fdb_get_stats(const fdb *db, fdb_stats *stats) {
+  const fdb_funnel *funnel;
+  fdb_fid i;
+  stats->num_dense = stats->num_sparse = stats->num_chunked = 0;
+  stats->num_indexed = stats->num_sketched = 0;
+  stats->dense_size = stats->sparse_size = stats->chunked_size = 0;
+  stats->index_size = stats->sketch_size = 0;
+  for (i = 0; i < db->num_funnels; i++) {
+    funnel = &db->funnels[i];
+    if (funnel->flags & FDB_DENSE) {
+      stats->num_dense++;
+      stats->dense_size += fdb_row_size(db, funnel);
+    } else if (funnel->flags & FDB_SPARSE) {
+      stats->num_sparse++;
+      stats->sparse_size += fdb_row_size(db, funnel);
+    } else {
+      stats->num_chunked++;
+      stats->chunked_size += fdb_row_size(db, funnel);
+    }
+    if (funnel->flags & FDB_INDEXED) {
+      stats->num_indexed++;
+      stats->index_size += fdb_hist_size(fdb_row_hist(db, funnel)->num_masks);
+    }
+    if (funnel->flags & FDB_SKETCHED) {
+      stats->num_sketched++;
+      stats->sketch_size += fdb_sketch_size(fdb_row_sketch(db, funnel)->num_hashes);
+    }
+  }
+}
+
+/* Decide how a chunk should be stored, given the number of runs it has.
+   The chunk's size holds its span (the last low id + 1) until this point.
+   Returns the number of bytes the chunk takes up. */
+static
+uint64_t fdb_chunk_choose(fdb_chunk *chunk, fdb_eid num_runs) {
+  uint64_t array = chunk->length * (sizeof(uint16_t) + sizeof(fdb_mask));
+  uint64_t masks = chunk->size * sizeof(fdb_mask);
+  uint64_t runs = num_runs * sizeof(fdb_run);
+  if (runs < array && runs < masks) {
+    chunk->type = FDB_CHUNK_RUNS;
+    chunk->size = num_runs;
+    return runs;
+  }
+  if (array <= masks) {
+    chunk->type = FDB_CHUNK_ARRAY;
+    chunk->size = chunk->length;
+    return array;
+  }
+  chunk->type = FDB_CHUNK_MASKS;
+  return masks;
+}
+
+/* Look at the elements of a row to decide how to store it.
+   The chunks array must have room for one chunk per 2^16 ids. */
+static
+void fdb_layout_row(fdb_iter *iter, uint64_t num_ids, fdb_chunk *chunks, fdb_layout *layout) {
+  fdb_chunk *chunk = NULL;
+  fdb_elem *next, last = {};
+  fdb_eid num_runs = 0;
+  uint64_t sparse, dense = num_ids * sizeof(fdb_mask), chunked = 0;
+  layout->length = 0;
+  layout->num_chunks = 0;
+  while ((next = fdb_iter_next(iter))) {
+    if (!chunk || chunk->key != next->id >> FDB_CHUNK_BITS) {
+      if (chunk)
+        chunked += fdb_chunk_choose(chunk, num_runs);
+      chunk = &chunks[layout->num_chunks++];
+      memset(chunk, 0, sizeof(fdb_chunk));
+      chunk->key = next->id >> FDB_CHUNK_BITS;
+      num_runs = 0;
+    }
+    if (!chunk->length || next->id != last.id + 1 || next->mask != last.mask)
+      num_runs++;
+    chunk->length++;
+    chunk->size = (next->id & ((1 << FDB_CHUNK_BITS) - 1)) + 1;
+    layout->length++;
+    last = *next;
+  }
+  if (chunk)
+    chunked += fdb_chunk_choose(chunk, num_runs);
+  chunked += sizeof(fdb_chunked) + layout->num_chunks * sizeof(fdb_chunk);
+  sparse = layout->length * sizeof(fdb_elem);
+  if (chunked < sparse && chunked < dense) {
+    layout->flags = FDB_CHUNKED;
+    layout->size = chunked;
+  } else if (sparse <= dense) {
+    layout->flags = FDB_SPARSE;
+    layout->size = sparse;
+  } else {
+    layout->flags = FDB_DENSE;
+    layout->size = dense;
+  }
+}
+
+/* Write the elements of a row according to its layout.
+   The output must be zeroed and have room for layout->size bytes. */
+static
+void fdb_write_row(fdb_iter *iter, const fdb_layout *layout, fdb_chunk *chunks, uint8_t *out) {
+  fdb_elem *next, last = {};
+  fdb_eid c = 0, k = 0;
+  if (layout->flags & FDB_DENSE) {
+    fdb_mask *mask = (fdb_mask *)out;
+    while ((next = fdb_iter_next(iter)))
+      mask[next->id] = next->mask;
+  } else if (layout->flags & FDB_SPARSE) {
+    fdb_elem *elem = (fdb_elem *)out;
+    while ((next = fdb_iter_next(iter))) {
+      elem[k].id = next->id;
+      elem[k++].mask = next->mask;
+    }
+  } else {
+    fdb_chunked *chunked = (fdb_chunked *)out;
+    uint64_t offs = sizeof(fdb_chunked) + layout->num_chunks * sizeof(fdb_chunk);
+    chunked->num_chunks = layout->num_chunks;
+    for (c = 0; c < layout->num_chunks; c++) {
+      chunks[c].offs = offs;
+      offs += fdb_chunk_size(&chunks[c]);
+      memcpy(&chunked->chunks[c], &chunks[c], sizeof(fdb_chunk));
+    }
+    for (c = 0; (next = fdb_iter_next(iter)); last = *next) {
+      const fdb_chunk *chunk = &chunked->chunks[c];
+      uint16_t low = next->id & ((1 << FDB_CHUNK_BITS) - 1);
+      if (chunk->key != next->id >> FDB_CHUNK_BITS) {
+        chunk = &chunked->chunks[++c];
+        k = 0;
+      }
+      if (chunk->type == FDB_CHUNK_ARRAY) {
+        uint16_t *lows = (uint16_t *)(out + chunk->offs);
+        fdb_mask *mask = (fdb_mask *)(lows + chunk->size);
+        lows[k] = low;
+        mask[k++] = next->mask;
+      } else if (chunk->type == FDB_CHUNK_MASKS) {
+        fdb_mask *mask = (fdb_mask *)(out + chunk->offs);
+        mask[low] = next->mask;
+      } else {
+        fdb_run *run = (fdb_run *)(out + chunk->offs);
+        if (k && next->id == last.id + 1 && next->mask == last.mask) {
+          run[k - 1].more++;
+        } else {
+          run[k].low = low;
+          run[k++].mask = next->mask;
+        }
+      }
+    }
+  }
+}
+
+/* Store every row in whichever of dense, sparse or chunked takes the least space.
+   Rows start out dense or sparse, on aligned offsets, and never grow when packed,
+   so each row can be moved down in place as soon as it's been rewritten. */
+static
+fdb *fdb_pack(fdb *db, uint64_t num_ids) {
+  fdb_chunk *chunks = calloc((num_ids >> FDB_CHUNK_BITS) + 1, sizeof(fdb_chunk));
+  uint8_t *data = (uint8_t *)db + db->data_offs, *row;
+  uint64_t data_size = 0, page = sysconf(_SC_PAGESIZE);
+  size_t size = fdb_size(db->num_funnels, db->data_size), packed;
+  fdb_layout layout;
+  fdb_iter *iter;
+  fdb_fid i;
+  if (chunks == NULL)
+    return db;
+  for (i = 0; i < db->num_funnels; i++) {
+    fdb_set row_set = {
+      .flags = FDB_SIMPLE,
+      .simple = {.db = db, .funnel_id = i}
+    };
+    iter = fdb_iter_new(&row_set);
+    fdb_layout_row(iter, num_ids, chunks, &layout);
+    fdb_iter_free(iter);
+    if ((row = calloc(1, layout.size + 1)) == NULL)
+      break;
+    iter = fdb_iter_new(&row_set);
+    fdb_write_row(iter, &layout, chunks, row);
+    fdb_iter_free(iter);
+    memcpy(&data[data_size], row, layout.size);
+    memset(&data[data_size + layout.size], 0, FDB_ALIGN(layout.size) - layout.size);
+    free(row);
+    db->funnels[i].flags = layout.flags;
+    db->funnels[i].offs = data_size;
+    db->funnels[i].length = layout.flags & FDB_DENSE ? (fdb_eid)num_ids : layout.length;
+    data_size = FDB_ALIGN(data_size + layout.size);
+  }
+  if (i < db->num_funnels) {
+    /* out of memory: leave the remaining rows as they are */
+    free(chunks);
+    return db;
+  }
+  free(chunks);
+  db->data_size = data_size;
+  packed = (fdb_size(db->num_funnels, data_size) + page - 1) / page * page;
+  if (packed < size)
+    munmap((uint8_t *)db + packed, size - packed);
+  return db;
+}
+
 /* Apply a cnf filter to a particular mask.
    The mask just represents a set of variables which are present or absent. */
 static inline
@@ -207,11 +1104,74 @@ int fdb_required(unsigned int iid, const fdb_cnf *cnf) {
   return 0;
 }
 
+/* Record the elements scanned by a simple set, each is also filtered once */
+static inline
+void fdb_stat_scan(fdb_set_stats *stats, fdb_eid n) {
+  if (stats) {
+    stats->num_visited += n;
+    stats->num_filtered += n;
+  }
+}
+
+static inline
+fdb_elem *fdb_iter_next_chunked(fdb_iter *iter, uint8_t *row, const fdb_cnf *cnf) {
+  const fdb_chunked *chunked = (fdb_chunked *)row;
+  fdb_elem *next = &iter->next;
+  fdb_eid i, j, n = 0;
+  /* index is the position within the current chunk, sub the position within a run */
+  for (; iter->chunk < chunked->num_chunks; iter->chunk++, iter->index = iter->sub = 0) {
+    const fdb_chunk *chunk = &chunked->chunks[iter->chunk];
+    fdb_eid base = chunk->key << FDB_CHUNK_BITS;
+    uint8_t *payload = row + chunk->offs;
+    if (chunk->type == FDB_CHUNK_ARRAY) {
+      uint16_t *low = (uint16_t *)payload;
+      fdb_mask *mask = (fdb_mask *)(low + chunk->size);
+      for (i = iter->index; i < chunk->size; i++, n++) {
+        if (fdb_filter(mask[i], cnf)) {
+          next->id = base | low[i];
+          next->mask = mask[i];
+          iter->index = i + 1;
+          fdb_stat_scan(iter->set->stats, n + 1);
+          return next;
+        }
+      }
+    } else if (chunk->type == FDB_CHUNK_MASKS) {
+      fdb_mask *mask = (fdb_mask *)payload;
+      for (i = iter->index; i < chunk->size; i++, n++) {
+        if (fdb_filter(mask[i], cnf)) {
+          next->id = base | i;
+          next->mask = mask[i];
+          iter->index = i + 1;
+          fdb_stat_scan(iter->set->stats, n + 1);
+          return next;
+        }
+      }
+    } else {
+      fdb_run *run = (fdb_run *)payload;
+      for (i = iter->index; i < chunk->size; i++, n++, iter->sub = 0) {
+        if (fdb_filter(run[i].mask, cnf)) {
+          j = iter->sub;
+          if (j <= run[i].more) {
+            next->id = base | (run[i].low + j);
+            next->mask = run[i].mask;
+            iter->index = i;
+            iter->sub = j + 1;
+            fdb_stat_scan(iter->set->stats, n + 1);
+            return next;
+          }
+        }
+      }
+    }
+  }
+  fdb_stat_scan(iter->set->stats, n);
+  return NULL;
+}
+
 static inline
 fdb_elem *fdb_iter_next_simple(fdb_iter *iter) {
   const fdb_set_simple *s = &iter->set->simple;
   const fdb_funnel *funnel = &s->db->funnels[s->funnel_id];
-  fdb_eid i, *index = &iter->index;
+  fdb_eid i, start = iter->index, *index = &iter->index;
   fdb_elem *next = &iter->next;
   uint8_t *data = (uint8_t *)s->db + s->db->data_offs;
   if (funnel->flags & FDB_DENSE) {
@@ -222,10 +1182,11 @@ fdb_elem *fdb_iter_next_simple(fdb_iter *iter) {
         next->id = i;
         next->mask = mask[i];
         *index = i + 1;
+        fdb_stat_scan(iter->set->stats, *index - start);
         return next;
       }
     }
-  } else {
+  } else if (funnel->flags & FDB_SPARSE) {
    /* sparse: copy the element exactly as is */
     for (i = *index; i < funnel->length; i++) {
       fdb_elem *elem = (fdb_elem *)&data[funnel->offs];
@@ -233,55 +1194,290 @@ fdb_elem *fdb_iter_next_simple(fdb_iter *iter) {
         next->id = elem[i].id;
         next->mask = elem[i].mask;
         *index = i + 1;
+        fdb_stat_scan(iter->set->stats, *index - start);
         return next;
       }
     }
+  } else {
+    /* chunked: iterate within each chunk according to its type */
+    return fdb_iter_next_chunked(iter, &data[funnel->offs], s->cnf);
+  }
+  if (*index < funnel->length) {
+    fdb_stat_scan(iter->set->stats, funnel->length - *index);
+    *index = funnel->length;
   }
   return NULL;
 }
 
+/* Find the first position in [lo, hi) whose id is at least id.
+   Gallop forward from lo, then bisect, so short skips stay cheap. */
+static inline
+fdb_eid fdb_seek_elems(const fdb_elem *elem, fdb_eid lo, fdb_eid hi, fdb_eid id) {
+  uint64_t a = lo, b = hi, step = 1, mid;
+  if (a >= b || elem[a].id >= id)
+    return lo;
+  while (a + step < b && elem[a + step].id < id) {
+    a += step;
+    step <<= 1;
+  }
+  if (a + step < b)
+    b = a + step;
+  /* elem[a] is below id, elem[b] (if any) is not */
+  while (b - a > 1) {
+    mid = a + (b - a) / 2;
+    if (elem[mid].id < id)
+      a = mid;
+    else
+      b = mid;
+  }
+  return b;
+}
+
+/* The same search over the low bits of an array chunk. */
+static inline
+fdb_eid fdb_seek_lows(const uint16_t *low, fdb_eid lo, fdb_eid hi, fdb_eid id) {
+  fdb_eid a = lo, b = hi, step = 1, mid;
+  if (a >= b || low[a] >= id)
+    return lo;
+  while (a + step < b && low[a + step] < id) {
+    a += step;
+    step <<= 1;
+  }
+  if (a + step < b)
+    b = a + step;
+  while (b - a > 1) {
+    mid = a + (b - a) / 2;
+    if (low[mid] < id)
+      a = mid;
+    else
+      b = mid;
+  }
+  return b;
+}
+
+/* Find the first run in [lo, hi) which ends at or after id. */
+static inline
+fdb_eid fdb_seek_runs(const fdb_run *run, fdb_eid lo, fdb_eid hi, fdb_eid id) {
+  fdb_eid mid;
+  while (lo < hi) {
+    mid = lo + (hi - lo) / 2;
+    if (run[mid].low + run[mid].more < id)
+      lo = mid + 1;
+    else
+      hi = mid;
+  }
+  return lo;
+}
+
+/* Find the first chunk from lo with a key of at least key. */
+static inline
+fdb_eid fdb_seek_chunks(const fdb_chunked *chunked, fdb_eid lo, fdb_eid key) {
+  fdb_eid mid, hi = chunked->num_chunks;
+  while (lo < hi) {
+    mid = lo + (hi - lo) / 2;
+    if (chunked->chunks[mid].key < key)
+      lo = mid + 1;
+    else
+      hi = mid;
+  }
+  return lo;
+}
+
+static inline
+fdb_elem *fdb_iter_seek_chunked(fdb_iter *iter, uint8_t *row, const fdb_cnf *cnf, fdb_eid id) {
+  const fdb_chunked *chunked = (fdb_chunked *)row;
+  fdb_eid c, i, key = id >> FDB_CHUNK_BITS, low = id & ((1 << FDB_CHUNK_BITS) - 1);
+  /* skip whole chunks by key, then position within the chunk holding the id */
+  c = fdb_seek_chunks(chunked, iter->chunk, key);
+  if (c != iter->chunk) {
+    iter->chunk = c;
+    iter->index = iter->sub = 0;
+  }
+  if (c < chunked->num_chunks && chunked->chunks[c].key == key) {
+    const fdb_chunk *chunk = &chunked->chunks[c];
+    uint8_t *payload = row + chunk->offs;
+    if (chunk->type == FDB_CHUNK_ARRAY) {
+      iter->index = fdb_seek_lows((uint16_t *)payload, iter->index, chunk->size, low);
+    } else if (chunk->type == FDB_CHUNK_MASKS) {
+      if (iter->index < low)
+        iter->index = low;
+    } else {
+      fdb_run *run = (fdb_run *)payload;
+      i = fdb_seek_runs(run, iter->index, chunk->size, low);
+      if (i != iter->index) {
+        iter->index = i;
+        iter->sub = 0;
+      }
+      if (i < chunk->size && run[i].low + iter->sub < low)
+        iter->sub = low - run[i].low;
+    }
+  }
+  return fdb_iter_next_chunked(iter, row, cnf);
+}
+
+static inline
+fdb_elem *fdb_iter_seek_simple(fdb_iter *iter, fdb_eid id) {
+  const fdb_set_simple *s = &iter->set->simple;
+  if (iter->set->stats)
+    iter->set->stats->num_seeks++;
+  const fdb_funnel *funnel = &s->db->funnels[s->funnel_id];
+  uint8_t *data = (uint8_t *)s->db + s->db->data_offs;
+  if (funnel->flags & FDB_DENSE) {
+    /* dense: the id is the index */
+    if (iter->index < id)
+      iter->index = id;
+  } else if (funnel->flags & FDB_SPARSE) {
+    /* sparse: search the sorted elements */
+    fdb_elem *elem = (fdb_elem *)&data[funnel->offs];
+    iter->index = fdb_seek_elems(elem, iter->index, funnel->length, id);
+  } else {
+    return fdb_iter_seek_chunked(iter, &data[funnel->offs], s->cnf, id);
+  }
+  return fdb_iter_next_simple(iter);
+}
+
+/* Iterate a union of rows: take the smallest id of any row, with the masks of every row that has it,
+   the rows are few (one per time bucket) so they are simply scanned for the smallest. */
+static inline
+fdb_elem *fdb_iter_next_union(fdb_iter *iter) {
+  const fdb_set_simple *s = &iter->set->simple;
+  fdb_elem *next = &iter->next;
+  fdb_iter *row;
+  fdb_fid i;
+  int found;
+  while (1) {
+    for (found = 0, i = 0; i < s->num_rows; i++) {
+      if ((row = iter->iters[i]) && (!found || row->next.id < next->id)) {
+        next->id = row->next.id;
+        found = 1;
+      }
+    }
+    if (!found)
+      return NULL;
+    for (next->mask = 0, i = 0; i < s->num_rows; i++) {
+      if ((row = iter->iters[i]) && row->next.id == next->id) {
+        next->mask |= row->next.mask;
+        if (!fdb_iter_next(row))
+          iter->iters[i] = fdb_iter_free(row);
+        if (iter->set->stats)
+          iter->set->stats->num_visited++;
+      }
+    }
+    if (iter->set->stats)
+      iter->set->stats->num_filtered++;
+    if (fdb_filter(next->mask, s->cnf))
+      return next;
+  }
+}
+
+static inline
+fdb_elem *fdb_iter_seek_union(fdb_iter *iter, fdb_eid id) {
+  const fdb_set_simple *s = &iter->set->simple;
+  fdb_iter *row;
+  fdb_fid i;
+  if (iter->set->stats)
+    iter->set->stats->num_seeks++;
+  for (i = 0; i < s->num_rows; i++)
+    if ((row = iter->iters[i]) && row->next.id < id && !fdb_iter_seek(row, id))
+      iter->iters[i] = fdb_iter_free(row);
+  return fdb_iter_next_union(iter);
+}
+
+/* Mark a term as exhausted, exiting early if the cnf requires it. */
+static inline
+void fdb_iter_drop(fdb_iter *iter, unsigned int i) {
+  iter->empty |= 1LLU << i;
+  if (iter->num_left)
+    iter->num_left--;
+  if (iter->required & (1LLU << i)) {
+    iter->num_left = 0;
+    if (iter->set->stats)
+      iter->set->stats->num_exits++;
+  }
+}
+
+/* Leapfrog the terms until every required term holds the same id,
+   seeking the others there too, since nothing before it can pass the cnf. */
+static inline
+void fdb_iter_align(fdb_iter *iter) {
+  const fdb_set_complex *c = &iter->set->complex;
+  fdb_eid max = 0;
+  unsigned int i, N = c->num_sets, aligned = 0;
+  while (!aligned && iter->num_left) {
+    aligned = 1;
+    for (i = 0; i < N; i++)
+      if ((iter->required & (1LLU << i)) && iter->iters[i]->next.id > max)
+        max = iter->iters[i]->next.id;
+    for (i = 0; i < N && iter->num_left; i++) {
+      if (!(iter->empty & (1LLU << i)) && iter->iters[i]->next.id < max) {
+        if (!fdb_iter_seek(iter->iters[i], max))
+          fdb_iter_drop(iter, i);
+        else if ((iter->required & (1LLU << i)) && iter->iters[i]->next.id > max)
+          aligned = 0;
+      }
+    }
+  }
+}
+
 static inline
 fdb_elem *fdb_iter_next_complex(fdb_iter *iter) {
   const fdb_set_complex *c = &iter->set->complex;
   fdb_elem *next = &iter->next;
   fdb_eid min;
-  unsigned int i, N = c->num_sets, argmin = 0;
+  fdb_mask mask;
+  unsigned int i, N = c->num_sets;
   uint64_t membership;
   /* each term has an associated set, which we can iterate over in order
      we just merge these iterators to traverse the elements in order */
   while (iter->num_left) { /* as long as there are terms left */
+    /* when some terms are required, skip ahead to where they all agree */
+    if (iter->required) {
+      fdb_iter_align(iter);
+      if (!iter->num_left)
+        break;
+    }
     membership = 0;
     min = -1; /* unsigned, so begin with the largest possible value */
     for (i = 0; i < N; i++)
       if (!(iter->empty & (1LLU << i)) && iter->iters[i]->next.id < min)
-        min = iter->iters[argmin = i]->next.id; /* found a new minimum */
+        min = iter->iters[i]->next.id; /* found a new minimum */
     next->id = min;
     next->mask = 0;
     /* figure out all terms which contain the minimum */
     for (i = 0; i < N; i++) {
       if (!(iter->empty & (1LLU << i)) && iter->iters[i]->next.id == min) {
-        /* found one, pop it */
-        if (!fdb_iter_next(iter->iters[i])) {
-          /* this was the last element in the iterator */
-          iter->empty |= 1LLU << i;
-          if (iter->num_left)
-            iter->num_left--;
-          /* check if this term is required by the cnf, so we can exit early */
-          if (fdb_required(i, c->cnf))
-            iter->num_left = 0;
-        }
-        /* mark the term as a member of this set */
-        next->mask |= iter->iters[i]->next.mask;
+        /* found one, mark the term as a member of this set and pop it */
+        mask = iter->iters[i]->next.mask;
+        if (!fdb_iter_next(iter->iters[i]))
+          fdb_iter_drop(iter, i); /* this was the last element in the iterator */
+        next->mask |= mask;
         membership |= 1LLU << i;
       }
     }
     /* apply the cnf to our set membership mask */
+    if (iter->set->stats) {
+      iter->set->stats->num_visited += __builtin_popcountll(membership);
+      iter->set->stats->num_filtered++;
+    }
     if (fdb_filter(membership, c->cnf))
       return next; /* return the next one that passes the test */
   }
   return NULL;
 }
 
+static inline
+fdb_elem *fdb_iter_seek_complex(fdb_iter *iter, fdb_eid id) {
+  const fdb_set_complex *c = &iter->set->complex;
+  unsigned int i;
+  if (iter->set->stats)
+    iter->set->stats->num_seeks++;
+  for (i = 0; i < c->num_sets && iter->num_left; i++)
+    if (!(iter->empty & (1LLU << i)) && iter->iters[i]->next.id < id)
+      if (!fdb_iter_seek(iter->iters[i], id))
+        fdb_iter_drop(iter, i);
+  return fdb_iter_next_complex(iter);
+}
+
 fdb_iter *fdb_iter_new(const fdb_set *set) {
   fdb_iter *iter = calloc(1, sizeof(fdb_iter));
   if (iter == NULL)
@@ -296,17 +1492,37 @@ fdb_iter *fdb_iter_new(const fdb_set *set) {
     if (iter->iters == NULL || c->num_sets > 64)
       return fdb_iter_free(iter); /* memory error or too many terms */
 
-    /* load up the first element of each term, or mark it empty */
+    /* note which terms the cnf requires, so we can skip ahead and exit early */
     unsigned int i;
+    for (i = 0; i < c->num_sets; i++)
+      if (fdb_required(i, c->cnf))
+        iter->required |= 1LLU << i;
+
+    /* load up the first element of each term, or mark it empty */
     for (i = 0; i < c->num_sets; i++) {
       iter->iters[i] = fdb_iter_new(c->sets[i]);
-      if (!fdb_iter_next(iter->iters[i])) {
-        iter->empty |= 1LLU << i;
-        if (iter->num_left)
-          iter->num_left--;
-        if (fdb_required(i, c->cnf))
-          iter->num_left = 0;
-      }
+      if (!fdb_iter_next(iter->iters[i]))
+        fdb_iter_drop(iter, i);
+    }
+  } else if (set->simple.num_rows > 1) {
+    const fdb_set_simple *s = &iter->set->simple;
+    iter->iters = calloc(s->num_rows, sizeof(fdb_iter *));
+    iter->rows = calloc(s->num_rows, sizeof(fdb_set));
+    if (iter->iters == NULL || iter->rows == NULL)
+      return fdb_iter_free(iter);
+
+    /* load up the first element of each row (unfiltered), or leave it out */
+    fdb_fid i;
+    for (i = 0; i < s->num_rows; i++) {
+      iter->rows[i].flags = FDB_SIMPLE;
+      iter->rows[i].simple.db = s->db;
+      iter->rows[i].simple.funnel_id = s->funnel_id + i * s->stride;
+      if (iter->rows[i].simple.funnel_id >= s->db->num_funnels)
+        continue;
+      if ((iter->iters[i] = fdb_iter_new(&iter->rows[i])) == NULL)
+        return fdb_iter_free(iter);
+      if (!fdb_iter_next(iter->iters[i]))
+        iter->iters[i] = fdb_iter_free(iter->iters[i]);
     }
   }
   return iter;
@@ -314,24 +1530,371 @@ fdb_iter *fdb_iter_new(const fdb_set *set) {
 
 fdb_elem *fdb_iter_next(fdb_iter *iter) {
   if (iter->set->flags & FDB_SIMPLE)
-    return fdb_iter_next_simple(iter);
+    return iter->set->simple.num_rows > 1 ? fdb_iter_next_union(iter) : fdb_iter_next_simple(iter);
   return fdb_iter_next_complex(iter);
 }
 
-fdb_iter *fdb_iter_free(fdb_iter *iter) {
-  if (iter->set->flags & FDB_COMPLEX) {
-    unsigned int i;
-    for (i = 0; i < iter->set->complex.num_sets; i++)
-      fdb_iter_free(iter->iters[i]);
+/* Advance to the next element whose id is at least id. */
+fdb_elem *fdb_iter_seek(fdb_iter *iter, fdb_eid id) {
+  if (iter->set->flags & FDB_SIMPLE)
+    return iter->set->simple.num_rows > 1 ? fdb_iter_seek_union(iter, id) : fdb_iter_seek_simple(iter, id);
+  return fdb_iter_seek_complex(iter, id);
+}
+
+/* Copy up to max elements from the iterator into ids (and masks, unless NULL).
+   Returns the number copied, which is less than max only once the iterator is exhausted. */
+fdb_eid fdb_iter_fill(fdb_iter *iter, fdb_eid max, fdb_eid *ids, fdb_mask *masks) {
+  fdb_elem *next;
+  fdb_eid n;
+  for (n = 0; n < max && (next = fdb_iter_next(iter)); n++) {
+    ids[n] = next->id;
+    if (masks)
+      masks[n] = next->mask;
   }
+  return n;
+}
+
+fdb_iter *fdb_iter_free(fdb_iter *iter) {
+  uint64_t i, n = iter->set->flags & FDB_COMPLEX ? iter->set->complex.num_sets : iter->set->simple.num_rows;
+  if (iter->iters)
+    for (i = 0; i < n; i++)
+      if (iter->iters[i])
+        fdb_iter_free(iter->iters[i]);
   free(iter->iters);
+  free(iter->rows);
   free(iter);
   return NULL;
 }
 
+/* Set the high bit of every 16-bit lane of a word which is non-zero */
+static inline
+uint64_t fdb_nonzero_lanes(uint64_t word) {
+  return (((word & FDB_LANES(0x7FFF)) + FDB_LANES(0x7FFF)) | word) & FDB_LANES(0x8000);
+}
+
+/* Build a table of which masks are accepted by a cnf */
+static
+uint8_t *fdb_accept_table(const fdb_cnf *cnf) {
+  uint8_t *accept = malloc(FDB_NUM_MASKS);
+  uint64_t m;
+  if (accept)
+    for (m = 0; m < FDB_NUM_MASKS; m++)
+      accept[m] = fdb_filter(m, cnf);
+  return accept;
+}
+
+/* Count the masks of a dense row that pass a cnf, 4 masks to a word.
+   Each clause is applied to all the lanes of a word at once,
+   the loop is simple enough for the compiler to vectorize further. */
+static
+fdb_eid fdb_count_dense_swar(const fdb_mask *masks, fdb_eid length, const fdb_cnf *cnf) {
+  uint64_t word, pass, T[FDB_SWAR_MAX], N[FDB_SWAR_MAX];
+  unsigned int j, k = 0;
+  fdb_eid i, count = 0;
+  if (cnf) {
+    for (j = 0; j < cnf->num_clauses; j++) {
+      if (cnf->clauses[j].nterms >> (8 * sizeof(fdb_mask)))
+        continue; /* the clause is always true for a mask this size */
+      T[k] = FDB_LANES(cnf->clauses[j].terms & (FDB_NUM_MASKS - 1));
+      N[k] = FDB_LANES(cnf->clauses[j].nterms & (FDB_NUM_MASKS - 1));
+      k++;
+    }
+  }
+  for (i = 0; i + 4 <= length; i += 4) {
+    memcpy(&word, &masks[i], sizeof(word)); /* rows are not necessarily aligned */
+    pass = fdb_nonzero_lanes(word);
+    for (j = 0; j < k; j++)
+      pass &= fdb_nonzero_lanes((word & T[j]) | (~word & N[j]));
+    count += __builtin_popcountll(pass);
+  }
+  for (; i < length; i++)
+    count += fdb_filter(masks[i], cnf);
+  return count;
+}
+
+/* Count the masks of a dense row that pass a cnf, using a table lookup per mask */
+static
+fdb_eid fdb_count_dense_table(const fdb_mask *masks, fdb_eid length, const uint8_t *accept) {
+  fdb_eid i, c0 = 0, c1 = 0, c2 = 0, c3 = 0;
+  for (i = 0; i + 4 <= length; i += 4) {
+    c0 += accept[masks[i + 0]];
+    c1 += accept[masks[i + 1]];
+    c2 += accept[masks[i + 2]];
+    c3 += accept[masks[i + 3]];
+  }
+  for (; i < length; i++)
+    c0 += accept[masks[i]];
+  return c0 + c1 + c2 + c3;
+}
+
+/* Count the elements of a sparse row that pass a cnf, using a table lookup per mask */
+static
+fdb_eid fdb_count_sparse_table(const fdb_elem *elem, fdb_eid length, const uint8_t *accept) {
+  fdb_eid i, count = 0;
+  for (i = 0; i < length; i++)
+    count += accept[elem[i].mask];
+  return count;
+}
+
+/* Count the elements of a chunked row that pass a cnf, chunk by chunk */
+static
+fdb_eid fdb_count_chunked_table(const uint8_t *row, const uint8_t *accept) {
+  const fdb_chunked *chunked = (fdb_chunked *)row;
+  fdb_eid c, i, count = 0;
+  for (c = 0; c < chunked->num_chunks; c++) {
+    const fdb_chunk *chunk = &chunked->chunks[c];
+    const uint8_t *payload = row + chunk->offs;
+    if (chunk->type == FDB_CHUNK_ARRAY) {
+      count += fdb_count_dense_table((fdb_mask *)payload + chunk->size, chunk->size, accept);
+    } else if (chunk->type == FDB_CHUNK_MASKS) {
+      count += fdb_count_dense_table((fdb_mask *)payload, chunk->size, accept);
+    } else {
+      const fdb_run *run = (fdb_run *)payload;
+      for (i = 0; i < chunk->size; i++)
+        count += accept[run[i].mask] * (run[i].more + 1);
+    }
+  }
+  return count;
+}
+
+/* Count a simple set without iterating when the row is large enough to make it worthwhile.
+   Returns 0 if the row was counted, otherwise the caller should fall back to iterating. */
+static
+int fdb_count_simple(const fdb_set_simple *s, fdb_eid *count) {
+  const fdb_funnel *funnel = &s->db->funnels[s->funnel_id];
+  uint8_t *data = fdb_funnel_data(s->db, funnel), *accept;
+  if (funnel->flags & FDB_INDEXED) {
+    const fdb_hist *hist = fdb_row_hist(s->db, funnel);
+    fdb_eid m;
+    for (*count = 0, m = 0; m < hist->num_masks; m++)
+      if (fdb_filter(hist->tallies[m].mask, s->cnf))
+        *count += hist->tallies[m].count;
+    return 0;
+  }
+  if (funnel->length < FDB_SCAN_MIN)
+    return -1;
+  if (funnel->flags & FDB_DENSE && (!s->cnf || s->cnf->num_clauses <= FDB_SWAR_MAX)) {
+    *count = fdb_count_dense_swar((fdb_mask *)data, funnel->length, s->cnf);
+    return 0;
+  }
+  if ((accept = fdb_accept_table(s->cnf)) == NULL)
+    return -1;
+  if (funnel->flags & FDB_DENSE)
+    *count = fdb_count_dense_table((fdb_mask *)data, funnel->length, accept);
+  else if (funnel->flags & FDB_SPARSE)
+    *count = fdb_count_sparse_table((fdb_elem *)data, funnel->length, accept);
+  else
+    *count = fdb_count_chunked_table(data, accept);
+  free(accept);
+  return 0;
+}
+
+/* Count how many elements of a row have each mask value */
+static
+void fdb_histogram(const fdb *db, const fdb_funnel *funnel, fdb_eid *hist) {
+  uint8_t *data = fdb_funnel_data(db, funnel);
+  fdb_eid i;
+  if (funnel->flags & FDB_DENSE) {
+    fdb_mask *mask = (fdb_mask *)data;
+    for (i = 0; i < funnel->length; i++)
+      hist[mask[i]]++;
+  } else if (funnel->flags & FDB_SPARSE) {
+    fdb_elem *elem = (fdb_elem *)data;
+    for (i = 0; i < funnel->length; i++)
+      hist[elem[i].mask]++;
+  } else {
+    const fdb_chunked *chunked = (fdb_chunked *)data;
+    fdb_eid c;
+    for (c = 0; c < chunked->num_chunks; c++) {
+      const fdb_chunk *chunk = &chunked->chunks[c];
+      const uint8_t *payload = data + chunk->offs;
+      if (chunk->type == FDB_CHUNK_RUNS) {
+        const fdb_run *run = (fdb_run *)payload;
+        for (i = 0; i < chunk->size; i++)
+          hist[run[i].mask] += run[i].more + 1;
+      } else {
+        const fdb_mask *mask = (fdb_mask *)payload + (chunk->type == FDB_CHUNK_ARRAY ? chunk->size : 0);
+        for (i = 0; i < chunk->size; i++)
+          hist[mask[i]]++;
+      }
+    }
+  }
+}
+
+/* A well mixed hash of an element id (the splitmix64 finalizer), the same in every FunnelDB.
+   Distinct ids always have distinct hashes. */
+static inline
+uint64_t fdb_hash(fdb_eid id) {
+  uint64_t x = id + 0x9E3779B97F4A7C15LLU;
+  x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9LLU;
+  x = (x ^ (x >> 27)) * 0x94D049BB133111EBLLU;
+  return x ^ (x >> 31);
+}
+
+/* An element of a sample: its hash, and its mask (or the terms of a complex set it's in) */
+typedef struct {
+  uint64_t hash;
+  uint64_t bits;
+} fdb_tagged;
+
+static
+int fdb_tagged_cmp(const void *a, const void *b) {
+  uint64_t x = ((const fdb_tagged *)a)->hash, y = ((const fdb_tagged *)b)->hash;
+  return x < y ? -1 : x > y;
+}
+
+/* Sample the elements of a row with the max smallest hashes, returning how many were taken.
+   The sample is kept as a max-heap while scanning, then left in hash order. */
+static
+uint64_t fdb_sample_row(const fdb *db, fdb_fid funnel_id, fdb_tagged *sample, uint64_t max) {
+  fdb_set row = {
+    .flags = FDB_SIMPLE,
+    .simple = {.db = (fdb *)db, .funnel_id = funnel_id}
+  };
+  fdb_iter *iter = fdb_iter_new(&row);
+  fdb_tagged next;
+  fdb_elem *elem;
+  uint64_t n = 0, k, c;
+  while ((elem = fdb_iter_next(iter))) {
+    next.hash = fdb_hash(elem->id);
+    next.bits = elem->mask;
+    if (n < max) {
+      for (k = n++; k && sample[(k - 1) / 2].hash < next.hash; k = (k - 1) / 2)
+        sample[k] = sample[(k - 1) / 2];
+    } else if (next.hash < sample[0].hash) {
+      for (k = 0; (c = 2 * k + 1) < n; k = c) {
+        if (c + 1 < n && sample[c + 1].hash > sample[c].hash)
+          c++;
+        if (sample[c].hash <= next.hash)
+          break;
+        sample[k] = sample[c];
+      }
+    } else {
+      continue;
+    }
+    sample[k] = next;
+  }
+  fdb_iter_free(iter);
+  qsort(sample, n, sizeof(fdb_tagged), fdb_tagged_cmp);
+  return n;
+}
+
+/* Index the masks of each large row, with a histogram stored right after the row,
+   and sketch each row of more than opts->sketch_size elements, with a sample after that.
+   Rows are moved up to make room, starting from the last, so that no row is overwritten
+   before it has moved, or into a new mapping if the current one is too small
+   (or some row would have to move down, if packing was cut short).
+   If memory runs out, the FunnelDB is left as it was. */
+static
+fdb *fdb_index(fdb *db, const fdb_opts *opts) {
+  uint64_t K = opts->sketch_size, *offs = NULL, data_size = 0, m, count, page = sysconf(_SC_PAGESIZE);
+  size_t size = (fdb_size(db->num_funnels, db->data_size) + page - 1) / page * page, indexed;
+  fdb_eid *hist = calloc(FDB_NUM_MASKS, sizeof(fdb_eid)), *num_masks = NULL;
+  fdb_tagged *sample = K ? calloc(K + 1, sizeof(fdb_tagged)) : NULL;
+  uint8_t *sketched = NULL;
+  const fdb_funnel *funnel;
+  fdb_hist *out;
+  fdb_sketch *sketch;
+  fdb *dst = db;
+  fdb_fid i;
+  int down = 0;
+  if (hist == NULL || (K && sample == NULL) ||
+      (num_masks = calloc(db->num_funnels + 1, sizeof(fdb_eid))) == NULL ||
+      (sketched = calloc(db->num_funnels + 1, sizeof(uint8_t))) == NULL ||
+      (offs = calloc(db->num_funnels + 1, sizeof(uint64_t))) == NULL)
+    goto done;
+
+  /* find where each row will go, how many distinct masks the large ones have,
+     and which have enough elements to sketch */
+  for (i = 0; i < db->num_funnels; i++) {
+    funnel = &db->funnels[i];
+    offs[i] = data_size;
+    down |= offs[i] < funnel->offs;
+    data_size = FDB_ALIGN(data_size + fdb_row_size(db, funnel));
+    if (!(opts->index && funnel->length >= FDB_SCAN_MIN) && !(K && funnel->length > K))
+      continue;
+    fdb_histogram(db, funnel, hist);
+    for (hist[0] = count = 0, m = 1; m < FDB_NUM_MASKS; m++) {
+      num_masks[i] += hist[m] > 0;
+      count += hist[m];
+      hist[m] = 0;
+    }
+    if (!(opts->index && funnel->length >= FDB_SCAN_MIN))
+      num_masks[i] = 0;
+    if (num_masks[i])
+      data_size = FDB_ALIGN(data_size + fdb_hist_size(num_masks[i]));
+    if ((sketched[i] = K && count > K))
+      data_size = FDB_ALIGN(data_size + fdb_sketch_size(K));
+  }
+  offs[i] = data_size;
+  indexed = fdb_size(db->num_funnels, data_size);
+  if (indexed > size || down) {
+    dst = mmap(NULL, indexed, PROT_READ | PROT_WRITE, MAP_ANON | MAP_PRIVATE, -1, 0);
+    if (dst == MAP_FAILED) {
+      perror("mmap");
+      dst = db;
+      goto done;
+    }
+    memcpy(dst, db, db->data_offs);
+  }
+
+  /* move each row, then write its histogram and sketch after it */
+  for (i = db->num_funnels; i-- > 0; ) {
+    funnel = &db->funnels[i];
+    uint64_t row_size = fdb_row_size(db, funnel), end = FDB_ALIGN(row_size);
+    uint8_t *row = (uint8_t *)dst + dst->data_offs + offs[i];
+    if (num_masks[i])
+      fdb_histogram(db, funnel, hist);
+    if (sketched[i])
+      fdb_sample_row(db, i, sample, K + 1);
+    memmove(row, fdb_funnel_data(db, funnel), row_size);
+    memset(row + row_size, 0, offs[i + 1] - offs[i] - row_size);
+    dst->funnels[i].offs = offs[i];
+    if (num_masks[i]) {
+      out = (fdb_hist *)(row + end);
+      for (hist[0] = 0, m = 1; m < FDB_NUM_MASKS; m++) {
+        if (hist[m]) {
+          out->tallies[out->num_masks].count = hist[m];
+          out->tallies[out->num_masks++].mask = (fdb_mask)m;
+          hist[m] = 0;
+        }
+      }
+      dst->funnels[i].flags |= FDB_INDEXED;
+      end = FDB_ALIGN(end + fdb_hist_size(num_masks[i]));
+    }
+    if (sketched[i]) {
+      /* keep the K smallest hashes, every other element hashes above them */
+      sketch = (fdb_sketch *)(row + end);
+      sketch->theta = sample[K].hash - 1;
+      sketch->num_hashes = K;
+      for (m = 0; m < K; m++) {
+        sketch->hashes[m] = sample[m].hash;
+        ((fdb_mask *)(sketch->hashes + K))[m] = (fdb_mask)sample[m].bits;
+      }
+      dst->funnels[i].flags |= FDB_SKETCHED;
+    }
+  }
+  dst->data_size = data_size;
+  if (dst != db)
+    munmap(db, size);
+
+ done:
+  free(hist);
+  free(sample);
+  free(num_masks);
+  free(sketched);
+  free(offs);
+  return dst;
+}
+
 /* Straightforward counting of the number of elements in any set */
 int fdb_count_set(const fdb_set *set, fdb_eid *count) {
   int k;
+  if (set->flags & FDB_SIMPLE && set->simple.num_rows <= 1 && !fdb_count_simple(&set->simple, count)) {
+    if (set->stats)
+      set->stats->num_counted++;
+    return 0;
+  }
   fdb_iter *iter = fdb_iter_new(set);
   *count = 0;
   for (k = 0; fdb_iter_next(iter); k++)
@@ -340,21 +1903,193 @@ int fdb_count_set(const fdb_set *set, fdb_eid *count) {
   return 0;
 }
 
-/* Efficient counting of a family of related sets
-   (i.e. multiple queries on the same row) */
-int fdb_count_family(const fdb_family *family, fdb_eid *counts) {
-  int i, k;
+/* A sample of a set: its elements with a hash of at most theta, in hash order */
+typedef struct {
+  uint64_t theta;
+  uint64_t length;
+  fdb_tagged *elems;
+} fdb_theta;
+
+/* Reduce tagged elements (in any order) to a sample with the given theta,
+   combining the bits of elements with the same hash, and keeping those which pass the cnf.
+   The sample takes over the elements. */
+static
+void fdb_theta_reduce(fdb_theta *out, fdb_tagged *elems, uint64_t n, uint64_t theta, const fdb_cnf *cnf) {
+  uint64_t i, j, k = 0, bits;
+  qsort(elems, n, sizeof(fdb_tagged), fdb_tagged_cmp);
+  for (i = 0; i < n; i = j) {
+    for (bits = elems[i].bits, j = i + 1; j < n && elems[j].hash == elems[i].hash; j++)
+      bits |= elems[j].bits;
+    if (elems[i].hash <= theta && fdb_filter(bits, cnf)) {
+      elems[k].hash = elems[i].hash;
+      elems[k++].bits = bits;
+    }
+  }
+  out->theta = theta;
+  out->length = k;
+  out->elems = elems;
+}
+
+/* Sample a set, using the sketches of its rows, or all of the elements of rows without one.
+   The sample of a complex set is the sample of the terms, with theta the least of theirs,
+   each element tagged by the terms it's in, so the cnf applies just like when iterating. */
+static
+int fdb_theta_set(const fdb_set *set, fdb_theta *out) {
+  fdb_tagged *elems = NULL, *more;
+  uint64_t theta = UINT64_MAX, n = 0, i, k;
+  if (set->flags & FDB_COMPLEX) {
+    const fdb_set_complex *s = &set->complex;
+    fdb_theta *terms = calloc(s->num_sets + 1, sizeof(fdb_theta));
+    int error = terms == NULL;
+    for (k = 0; !error && k < s->num_sets; k++) {
+      error = fdb_theta_set(s->sets[k], &terms[k]);
+      theta = MIN(theta, terms[k].theta);
+      n += terms[k].length;
+    }
+    if (!error && (elems = malloc((n + 1) * sizeof(fdb_tagged))) == NULL)
+      error = 1;
+    for (n = 0, k = 0; terms && k < s->num_sets; k++) {
+      for (i = 0; !error && i < terms[k].length && terms[k].elems[i].hash <= theta; i++) {
+        elems[n].hash = terms[k].elems[i].hash;
+        elems[n++].bits = 1LLU << k;
+      }
+      free(terms[k].elems);
+    }
+    free(terms);
+    if (error)
+      return -1;
+    fdb_theta_reduce(out, elems, n, theta, s->cnf);
+  } else {
+    const fdb_set_simple *s = &set->simple;
+    const fdb_funnel *funnel;
+    const fdb_sketch *sketch;
+    fdb_fid r, funnel_id, num_rows = s->num_rows > 1 ? s->num_rows : 1;
+    for (r = 0; r < num_rows; r++) {
+      funnel_id = s->funnel_id + r * s->stride;
+      if (funnel_id >= s->db->num_funnels)
+        continue;
+      funnel = &s->db->funnels[funnel_id];
+      sketch = funnel->flags & FDB_SKETCHED ? fdb_row_sketch(s->db, funnel) : NULL;
+      if ((more = realloc(elems, (n + (sketch ? sketch->num_hashes : funnel->length) + 1) *
+                          sizeof(fdb_tagged))) == NULL) {
+        free(elems);
+        return -1;
+      }
+      elems = more;
+      if (sketch) {
+        const fdb_mask *masks = (fdb_mask *)(sketch->hashes + sketch->num_hashes);
+        for (i = 0; i < sketch->num_hashes; i++) {
+          elems[n].hash = sketch->hashes[i];
+          elems[n++].bits = masks[i];
+        }
+        theta = MIN(theta, sketch->theta);
+      } else {
+        n += fdb_sample_row(s->db, funnel_id, elems + n, funnel->length);
+      }
+    }
+    fdb_theta_reduce(out, elems ? elems : malloc(sizeof(fdb_tagged)), n, theta, s->cnf);
+    if (out->elems == NULL)
+      return -1;
+  }
+  return 0;
+}
+
+/* Estimate the size of a set from the sketches of its rows, without iterating over it.
+   The error is the standard error of the estimate, which is exact (error 0)
+   if none of the rows involved are sketched. */
+int fdb_estimate_set(const fdb_set *set, double *estimate, double *error) {
+  fdb_theta sample;
+  double p;
+  if (fdb_theta_set(set, &sample))
+    return -1;
+  p = ((double)sample.theta + 1) / 18446744073709551616.0; /* the fraction of hashes sampled */
+  *estimate = sample.length / p;
+  *error = sqrt(sample.length * (1 - p)) / p;
+  free(sample.elems);
+  if (set->stats)
+    set->stats->num_counted++;
+  return 0;
+}
+
+/* Count a family on one row, hist is scratch space for large rows (zeroed, left zeroed) */
+static
+void fdb_count_row(const fdb_family *family, fdb_fid funnel_id, fdb_eid *counts, fdb_eid *hist) {
+  unsigned int i;
+  const fdb_funnel *funnel = &family->db->funnels[funnel_id];
   fdb_set all = {
     .flags = FDB_SIMPLE,
-    .simple = {.db = family->db, .funnel_id = family->funnel_id}
+    .simple = {.db = family->db, .funnel_id = funnel_id, .num_rows = family->num_rows, .stride = family->stride}
   };
-  fdb_iter *iter = fdb_iter_new(&all); /* an iterator over the entire row */
+  fdb_iter *iter;
   fdb_elem *next;
   memset(counts, 0, family->num_sets * sizeof(fdb_eid));
-  for (k = 0; (next = fdb_iter_next(iter)); k++) /* look at each element once */
+  if (funnel->flags & FDB_INDEXED && family->num_rows <= 1) {
+    /* indexed rows: evaluate each query once per distinct mask in the histogram */
+    const fdb_hist *index = fdb_row_hist(family->db, funnel);
+    fdb_eid m;
+    for (m = 0; m < index->num_masks; m++)
+      for (i = 0; i < family->num_sets; i++)
+        if (fdb_filter(index->tallies[m].mask, family->cnfs[i]))
+          counts[i] += index->tallies[m].count;
+    return;
+  }
+  if ((funnel->length >= FDB_SCAN_MIN || family->num_rows > 1) && hist) {
+    /* large rows (or unions of rows): look at each element once to build a histogram of the masks,
+       then evaluate each query once per distinct mask */
+    uint64_t m;
+    if (family->num_rows > 1) {
+      iter = fdb_iter_new(&all);
+      while ((next = fdb_iter_next(iter)))
+        hist[next->mask]++;
+      fdb_iter_free(iter);
+    } else {
+      fdb_histogram(family->db, funnel, hist);
+    }
+    for (m = 1; m < FDB_NUM_MASKS; m++) {
+      if (hist[m])
+        for (i = 0; i < family->num_sets; i++)
+          if (fdb_filter(m, family->cnfs[i]))
+            counts[i] += hist[m];
+      hist[m] = 0;
+    }
+    hist[0] = 0;
+    return;
+  }
+  iter = fdb_iter_new(&all); /* an iterator over the entire row */
+  while ((next = fdb_iter_next(iter))) /* look at each element once */
     for (i = 0; i < family->num_sets; i++)
       if (fdb_filter(next->mask, family->cnfs[i])) /* evaluate each query */
         counts[i]++;
   fdb_iter_free(iter);
+}
+
+/* Efficient counting of a family of related sets
+   (i.e. multiple queries on the same row) */
+int fdb_count_family(const fdb_family *family, fdb_eid *counts) {
+  const fdb_funnel *funnel = &family->db->funnels[family->funnel_id];
+  int large = (funnel->length >= FDB_SCAN_MIN && !(funnel->flags & FDB_INDEXED)) || family->num_rows > 1;
+  fdb_eid *hist = large ? calloc(FDB_NUM_MASKS, sizeof(fdb_eid)) : NULL;
+  fdb_count_row(family, family->funnel_id, counts, hist);
+  free(hist);
+  return 0;
+}
+
+/* Count a family over many rows at once, into a num_funnels x num_sets matrix of counts.
+   The rows are given by funnel_ids, or if it's NULL, the rows following family->funnel_id.
+   Rows which are FDB_NO_FUNNEL (or otherwise out of range) count as empty. */
+int fdb_count_families(const fdb_family *family,
+                       const fdb_fid *funnel_ids,
+                       fdb_fid num_funnels,
+                       fdb_eid *counts) {
+  fdb_eid *hist = calloc(FDB_NUM_MASKS, sizeof(fdb_eid));
+  fdb_fid k, funnel_id;
+  for (k = 0; k < num_funnels; k++) {
+    funnel_id = funnel_ids ? funnel_ids[k] : family->funnel_id + k;
+    if (funnel_id < family->db->num_funnels)
+      fdb_count_row(family, funnel_id, counts + (uint64_t)k * family->num_sets, hist);
+    else
+      memset(counts + (uint64_t)k * family->num_sets, 0, family->num_sets * sizeof(fdb_eid));
+  }
+  free(hist);
   return 0;
 }
@@ -27,26 +27,61 @@
  *  - the presence of an impression served to the cookie (within a row)
  * etc.
  *
- * Finally, rows can be either dense or sparse.
+ * Finally, rows can be either dense, sparse or chunked.
  * Each sparse row is an ordered lists of integers (+ mask).
  * Each dense row is an array of masks.
+ * Each chunked row splits the ids into blocks of 2^16, each stored as either:
+ *  - an array of the low 16 bits of the ids (+ masks)
+ *  - an array of masks, like a small dense row
+ *  - runs of consecutive ids with the same mask
+ * Large rows may also be indexed, by a histogram of their masks stored after the row,
+ * which answers counts without looking at the elements.
+ * They may also be sketched, by a sample of the ids with the smallest hashes (and their masks),
+ * from which the size of any set can be estimated, with a known error.
  * However, these are implementation details not exposed by the interface.
  * FunnelDB automatically determines the most efficient way to store each row.
+ *
+ * The easy interface (fdb_easy) makes a row for every value of each group of key fields.
+ * A mask holds only 16 bits, so given several mask fields (or one with more than 16 values)
+ * the rows are repeated in layers, one per field and block of 16 of its values,
+ * all built in the same pass. Given time buckets, the rows of every layer are repeated
+ * again for each bucket, holding only the events in its range. So the funnel id of a row is
+ *   layer * layer_size + bucket * bucket_size + the id of its key.
+ * A mask query on the bits of one layer is answered by its rows alone,
+ * otherwise (or if it negates a field spanning several layers) by combining them,
+ * and a time range by the union of the rows of its buckets.
+ * Rows can be built on several threads, or in a single pass (buffering, and spilling if needed),
+ * and can be indexed or sketched as they are stored (see fdb_opts).
  */
 
 #include <stdint.h>
+#include <stdio.h>
 #include <traildb.h>
 
 #include "tdb_iter.h"
 
+#define FDB_VERSION 1
+
 #define FDB_DENSE   1
 #define FDB_SPARSE  2
+#define FDB_CHUNKED 4
+#define FDB_INDEXED 8  /* the row is followed by an fdb_hist */
+#define FDB_SKETCHED 16 /* the row is followed (after any fdb_hist) by an fdb_sketch */
+
+#define FDB_CHUNK_ARRAY 1
+#define FDB_CHUNK_MASKS 2
+#define FDB_CHUNK_RUNS  3
+
+#define FDB_CHUNK_BITS 16
 
 #define FDB_SIMPLE  1
 #define FDB_COMPLEX 2
 
+#define FDB_NO_FUNNEL ((fdb_fid)-1)
+
 #define FDB_PARAMS 4096
 #define FDB_EZ_MAX 128
+#define FDB_EZ_LAYERS 64
 
 /* The offset after the header + table of contents */
 #define fdb_offs(N) (sizeof(fdb) + N * sizeof(fdb_funnel))
@@ -68,24 +103,113 @@ typedef struct {
   fdb_eid length;
 } fdb_funnel;
 
+typedef struct {
+  uint16_t low;
+  uint16_t more;   /* the number of ids in the run after the first */
+  fdb_mask mask;
+} fdb_run;
+
+typedef struct {
+  fdb_eid key;     /* the ids in the chunk are (key << FDB_CHUNK_BITS) | low */
+  uint8_t type;
+  fdb_eid length;  /* the number of elements in the chunk */
+  fdb_eid size;    /* the number of entries stored (ids, masks or runs) */
+  uint64_t offs;   /* relative to the start of the row */
+} fdb_chunk;
+
+typedef struct {
+  fdb_eid num_chunks;
+  fdb_chunk chunks[];
+} fdb_chunked;
+
+typedef struct {
+  fdb_eid count;   /* the number of elements with the mask */
+  fdb_mask mask;
+} fdb_tally;
+
+typedef struct {
+  fdb_eid num_masks;   /* only the masks which occur in the row, in order */
+  fdb_tally tallies[];
+} fdb_hist;
+
+typedef struct {
+  uint64_t theta;      /* every element with a hash of at most theta is in the sketch */
+  fdb_eid num_hashes;
+  uint64_t hashes[];   /* in order, followed by the mask of each element */
+} fdb_sketch;
+
 typedef struct {
   int64_t count;
   int64_t last;
 } fdb_counter;
 
+typedef struct {
+  fdb_elem *elems;
+  fdb_eid length;
+  fdb_eid capacity;
+} fdb_buffer;
+
 typedef struct {
   int phase;
   fdb_counter *counters;
   fdb_funnel *funnels;
   uint8_t *data;
   void *params;
+  /* single pass: elements are buffered per funnel, then spilled to disk */
+  fdb_fid num_funnels;
+  fdb_buffer *buffers;
+  uint64_t buffered;
+  uint64_t max_buffered;
+  FILE *spill;
+  uint64_t spilled;
+  int error;
 } fdb_cons;
 
+typedef struct {
+  /* building: the time spent in each phase, in seconds */
+  double scan_time;         /* counting (and buffering) */
+  double store_time;        /* storing (scanning again or replaying the buffers) */
+  double pack_time;         /* choosing the layout of each row */
+  uint64_t num_trails;      /* trails visited, over all scans */
+  uint64_t num_events;      /* events decoded, over all scans */
+  uint64_t num_spilled;     /* bytes spilled by a single pass */
+  /* layout: the number of rows of each kind, and the bytes they take */
+  fdb_fid num_dense;
+  fdb_fid num_sparse;
+  fdb_fid num_chunked;
+  uint64_t dense_size;
+  uint64_t sparse_size;
+  uint64_t chunked_size;
+  fdb_fid num_indexed;
+  uint64_t index_size;
+  fdb_fid num_sketched;
+  uint64_t sketch_size;
+} fdb_stats;
+
+typedef struct {
+  unsigned int num_threads; /* 0 or 1 to build on the calling thread only */
+  unsigned int single_pass; /* scan the TrailDB once, buffering elements */
+  uint64_t max_buffered;    /* bytes buffered (in total) before spilling, 0 for no limit */
+  fdb_stats *stats;         /* if not NULL, filled in by the build */
+  unsigned int index;       /* store a histogram of the masks of each large row */
+  fdb_eid sketch_size;      /* sketch each row of more elements, keeping this many */
+} fdb_opts;
+
 typedef struct {
   unsigned int num_keys;
   fdb_fid key_offs[FDB_EZ_MAX];
   tdb_field key_fields[FDB_EZ_MAX];
   tdb_field mask_field;
+  /* each mask layer covers the vals [base, base + 16) of a field, with rows for every key */
+  unsigned int num_layers;             /* 0 for just the mask field */
+  fdb_fid layer_size;                  /* the number of rows in a layer */
+  tdb_field layer_fields[FDB_EZ_LAYERS];
+  tdb_val layer_bases[FDB_EZ_LAYERS];
+  /* each time bucket has its own copy of the rows (of every layer), for the events in its range */
+  unsigned int num_buckets;            /* 0 to ignore the timestamps */
+  fdb_fid bucket_size;                 /* the number of rows in a bucket */
+  uint64_t bucket_start;               /* the timestamp where the first bucket begins */
+  uint64_t bucket_width;
   uint8_t padded[FDB_PARAMS];
 } fdb_ez;
 
@@ -94,9 +218,18 @@ typedef struct {
   uint64_t data_size;
   uint8_t params[FDB_PARAMS];
   fdb_fid num_funnels;
+  uint32_t version; /* files from before versioning have zero padding here */
   fdb_funnel funnels[];
 } fdb;
 
+/* A FunnelDB to merge into a new one, with a map of its elements and rows into the new one */
+typedef struct {
+  const fdb *db;
+  const uint64_t *ids;    /* the new id of each element id, or NULL to keep the ids the same */
+  const fdb_fid *funnels; /* the new row of each mask bit of each row, or FDB_NO_FUNNEL to drop it */
+  const uint8_t *bits;    /* the new mask bit of each mask bit of each row */
+} fdb_merge_src;
+
 typedef struct {
   uint64_t terms;   /* supports up to 64 vars */
   uint64_t nterms;
@@ -110,10 +243,20 @@ typedef struct {
 typedef struct _fdb_set fdb_set;
 typedef struct _fdb_iter fdb_iter;
 
+typedef struct {
+  uint64_t num_visited;  /* elements read from the row, or taken from the terms */
+  uint64_t num_filtered; /* cnf evaluations */
+  uint64_t num_seeks;    /* skips ahead */
+  uint64_t num_exits;    /* early exits, when a required term runs out */
+  uint64_t num_counted;  /* counts made without iterating */
+} fdb_set_stats;
+
 typedef struct _fdb_set_simple {
   fdb *db;
   fdb_fid funnel_id;
   fdb_cnf *cnf;
+  fdb_fid num_rows; /* if more than 1, the union of the rows funnel_id + k * stride (masks or'd) */
+  fdb_fid stride;
 } fdb_set_simple;
 
 typedef struct _fdb_set_complex {
@@ -128,6 +271,8 @@ typedef struct _fdb_family {
   unsigned int num_sets;
   fdb_fid funnel_id;
   fdb_cnf **cnfs;
+  fdb_fid num_rows; /* if more than 1, count the union of rows, like a simple set */
+  fdb_fid stride;
 } fdb_family;
 
 struct _fdb_set {
@@ -136,30 +281,51 @@ struct _fdb_set {
     fdb_set_simple simple;
     fdb_set_complex complex;
   };
+  fdb_set_stats *stats; /* if not NULL, iterators over the set count what they do */
 };
 
 struct _fdb_iter {
   const fdb_set *set;
   unsigned int num_left;
   uint64_t empty;
+  uint64_t required;
   fdb_eid index;
+  fdb_eid chunk;
+  fdb_eid sub;
   fdb_elem next;
   fdb_iter **iters;
+  fdb_set *rows;
 };
 
-fdb *fdb_create(tdb *tdb, tdb_fold_fn probe, fdb_fid num_funnels, void *params);
+fdb *fdb_create(tdb *tdb, tdb_fold_fn probe, fdb_fid num_funnels, void *params, const fdb_opts *opts);
 void fdb_detect(fdb_fid funnel_id, fdb_eid id, fdb_mask bits, fdb_cons *state);
 
-fdb *fdb_easy(tdb *tdb, fdb_ez *params);
+fdb *fdb_easy(tdb *tdb, fdb_ez *params, const fdb_opts *opts);
+fdb *fdb_easy_merge(tdb *db, fdb_ez *params, fdb **fdbs, tdb **tdbs, unsigned int num_fdbs, const fdb_opts *opts);
+fdb *fdb_merge(const fdb_merge_src *srcs,
+               unsigned int num_srcs,
+               fdb_fid num_funnels,
+               uint64_t num_ids,
+               const void *params,
+               const fdb_opts *opts);
 fdb *fdb_dump(fdb *db, int fd);
 fdb *fdb_load(int fd);
 fdb *fdb_free(fdb *db);
+void fdb_get_stats(const fdb *db, fdb_stats *stats);
+const uint8_t *fdb_get_row(const fdb *db, fdb_fid funnel_id, fdb_funnel *funnel);
 
 fdb_iter *fdb_iter_new(const fdb_set *set);
 fdb_elem *fdb_iter_next(fdb_iter *iter);
+fdb_elem *fdb_iter_seek(fdb_iter *iter, fdb_eid id);
+fdb_eid fdb_iter_fill(fdb_iter *iter, fdb_eid max, fdb_eid *ids, fdb_mask *masks);
 fdb_iter *fdb_iter_free(fdb_iter *iter);
 
 int fdb_count_set(const fdb_set *set, fdb_eid *count);
+int fdb_estimate_set(const fdb_set *set, double *estimate, double *error);
 int fdb_count_family(const fdb_family *family, fdb_eid *counts);
+int fdb_count_families(const fdb_family *family,
+                       const fdb_fid *funnel_ids,
+                       fdb_fid num_funnels,
+                       fdb_eid *counts);
 
 #endif /* __FUNNELDB_H__ */
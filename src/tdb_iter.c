@@ -1,3 +1,7 @@
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
 #include "tdb_iter.h"
 
 tdb_iter *tdb_iter_new(const tdb *db, const struct tdb_event_filter *filter) {
@@ -8,6 +12,8 @@ tdb_iter *tdb_iter_new(const tdb *db, const struct tdb_event_filter *filter) {
     free(iter);
     return NULL;
   }
+  iter->stop = tdb_num_trails(db);
+  iter->tmax = UINT64_MAX;
   if (filter)
     if (tdb_cursor_set_event_filter(iter->cursor, filter) != TDB_ERR_OK) {
       tdb_iter_free(iter);
@@ -16,26 +22,377 @@ tdb_iter *tdb_iter_new(const tdb *db, const struct tdb_event_filter *filter) {
   return iter;
 }
 
+/* Restrict the iterator to the trail ids in [start, stop) */
+tdb_iter *tdb_iter_range(tdb_iter *iter, uint64_t start, uint64_t stop) {
+  uint64_t N = tdb_num_trails(iter->cursor->state->db);
+  iter->stop = stop < N ? stop : N;
+  iter->start = iter->marker = start < iter->stop ? start : iter->stop;
+  return iter;
+}
+
+/* Restrict the iterator to the events with timestamps in [tmin, tmax).
+   The events of each trail before tmin are still decoded (and dropped),
+   but decoding stops at the first one past tmax, since each trail is in time order.
+   The iterator is emptied if the whole TrailDB misses the window (so call this after tdb_iter_range). */
+tdb_iter *tdb_iter_window(tdb_iter *iter, uint64_t tmin, uint64_t tmax) {
+  const tdb *db = iter->cursor->state->db;
+  iter->tmin = tmin;
+  iter->tmax = tmax;
+  if (tmin >= tmax || tmin > tdb_max_timestamp(db) || tmax <= tdb_min_timestamp(db))
+    iter->stop = iter->marker;
+  return iter;
+}
+
 tdb_iter *tdb_iter_next(tdb_iter *restrict iter) {
-  while (iter->marker++ < tdb_num_trails(iter->cursor->state->db)) {
-    if (tdb_get_trail(iter->cursor, iter->marker - 1) == TDB_ERR_OK)
-      if (tdb_cursor_peek(iter->cursor))
+  const tdb_event *event;
+  while (iter->marker++ < iter->stop) {
+    if (tdb_get_trail(iter->cursor, iter->marker - 1) == TDB_ERR_OK) {
+      while ((event = tdb_cursor_peek(iter->cursor)) && event->timestamp < iter->tmin)
+        tdb_cursor_next(iter->cursor);
+      if (event && event->timestamp < iter->tmax)
         return iter;
+    }
   }
   return NULL;
 }
 
+/* The next event of the current trail within the window, or NULL when there are no more */
+const tdb_event *tdb_iter_event(tdb_iter *restrict iter) {
+  const tdb_event *event = tdb_cursor_peek(iter->cursor);
+  if (event && event->timestamp < iter->tmax)
+    return tdb_cursor_next(iter->cursor);
+  return NULL;
+}
+
 void tdb_iter_free(tdb_iter *iter) {
   free(iter->cursor);
   free(iter);
 }
 
+/* Add events in bulk: uuids are 16 bytes each, values are packed back to back,
+   num_values (one per field) for every event, with their lengths in lengths.
+   Stops at the first error, num_added tells how many events were added. */
+tdb_error tdb_cons_add_many(tdb_cons *cons,
+                            uint64_t num_events,
+                            uint64_t num_values,
+                            const uint8_t *uuids,
+                            const uint64_t *timestamps,
+                            const char *values,
+                            const uint64_t *lengths,
+                            uint64_t *num_added) {
+  const char **ptrs = calloc(num_values + 1, sizeof(char *));
+  tdb_error err = TDB_ERR_OK;
+  uint64_t i, n;
+  if (ptrs == NULL)
+    return TDB_ERR_NOMEM;
+  for (n = 0; n < num_events; n++) {
+    for (i = 0; i < num_values; i++) {
+      ptrs[i] = values;
+      values += lengths[n * num_values + i];
+    }
+    if ((err = tdb_cons_add(cons, uuids + 16 * n, timestamps[n], ptrs, lengths + n * num_values)))
+      break;
+  }
+  *num_added = n;
+  free(ptrs);
+  return err;
+}
+
+/* Copy every value of a field into buf back to back, including the empty val 0.
+   offs[val] is where each value begins and offs[lexicon_size] where the last ends.
+   Pass a NULL buf to compute just the offsets and the number of bytes needed,
+   or NULL offs as well to compute only the number of bytes. */
+uint64_t tdb_lexicon_read(const tdb *db, tdb_field field, char *buf, uint64_t *offs) {
+  uint64_t len, total = 0, val, size = tdb_lexicon_size(db, field);
+  const char *value;
+  for (val = 0; val < size; val++) {
+    if (offs)
+      offs[val] = total;
+    if ((value = tdb_get_value(db, field, val, &len))) {
+      if (buf)
+        memcpy(buf + total, value, len);
+      total += len;
+    }
+  }
+  if (offs)
+    offs[size] = total;
+  return total;
+}
+
+/* Find the id in db of each trail of other, by cookie: ids[t] is UINT64_MAX where there is none.
+   Returns the number of trails found. */
+uint64_t tdb_trail_map(const tdb *other, const tdb *db, uint64_t *ids) {
+  uint64_t t, found = 0, N = tdb_num_trails(other);
+  const uint8_t *uuid;
+  for (t = 0; t < N; t++) {
+    if ((uuid = tdb_get_uuid(other, t)) && tdb_get_trail_id(db, uuid, &ids[t]) == TDB_ERR_OK)
+      found++;
+    else
+      ids[t] = UINT64_MAX;
+  }
+  return found;
+}
+
+/* Copy the uuid of each trail id into uuids, 16 bytes each.
+   Stops at the first id out of range, returns the number of uuids copied. */
+uint64_t tdb_get_uuids(const tdb *db, const uint64_t *trail_ids, uint64_t num_ids, uint8_t *uuids) {
+  const uint8_t *uuid;
+  uint64_t n;
+  for (n = 0; n < num_ids && (uuid = tdb_get_uuid(db, trail_ids[n])); n++)
+    memcpy(uuids + 16 * n, uuid, 16);
+  return n;
+}
+
+/* Find the trail id of each uuid (16 bytes each): trail_ids[n] is UINT64_MAX where there is none.
+   Returns the number of trails found. */
+uint64_t tdb_get_trail_ids(const tdb *db, const uint8_t *uuids, uint64_t num_uuids, uint64_t *trail_ids) {
+  uint64_t n, found = 0;
+  for (n = 0; n < num_uuids; n++) {
+    if (tdb_get_trail_id(db, uuids + 16 * n, &trail_ids[n]) == TDB_ERR_OK)
+      found++;
+    else
+      trail_ids[n] = UINT64_MAX;
+  }
+  return found;
+}
+
+/* Decode up to max_events before tmax from the cursor into columns */
+static
+uint64_t tdb_cursor_batch_until(tdb_cursor *cursor,
+                                uint64_t tmax,
+                                uint64_t max_events,
+                                uint64_t *timestamps,
+                                tdb_val *vals,
+                                uint64_t stride) {
+  const tdb_event *event;
+  uint64_t i, n;
+  for (n = 0; n < max_events && (event = tdb_cursor_peek(cursor)) && event->timestamp < tmax; n++) {
+    tdb_cursor_next(cursor);
+    timestamps[n] = event->timestamp;
+    for (i = 0; i < event->num_items; i++)
+      vals[i * stride + n] = tdb_item_val(event->items[i]);
+  }
+  return n;
+}
+
+/* Decode up to max_events from the cursor into columns:
+   vals[i * stride + n] is the val of item i (field i + 1) of event n. */
+uint64_t tdb_cursor_batch(tdb_cursor *cursor,
+                          uint64_t max_events,
+                          uint64_t *timestamps,
+                          tdb_val *vals,
+                          uint64_t stride) {
+  return tdb_cursor_batch_until(cursor, UINT64_MAX, max_events, timestamps, vals, stride);
+}
+
+/* Fill the columns with events from as many trails as fit (stride is max_events).
+   A trail may be split across batches, the next call picks up where this one stopped. */
+uint64_t tdb_iter_batch(tdb_iter *iter,
+                        uint64_t max_events,
+                        uint64_t *trail_ids,
+                        uint64_t *timestamps,
+                        tdb_val *vals) {
+  uint64_t id, k, n = 0;
+  if (iter->marker == iter->start && !tdb_iter_next(iter))
+    return 0;
+  if (iter->marker > iter->stop)
+    return 0;
+  while (n < max_events) {
+    k = tdb_cursor_batch_until(iter->cursor, iter->tmax, max_events - n, timestamps + n, vals + n, max_events);
+    for (id = iter->marker - 1; k; k--)
+      trail_ids[n++] = id;
+    if (n < max_events && !tdb_iter_next(iter))
+      break;
+  }
+  return n;
+}
+
 void *tdb_fold(const tdb *db, const struct tdb_event_filter *filter, tdb_fold_fn fun, void *acc) {
+  return tdb_fold_range(db, filter, 0, tdb_num_trails(db), fun, acc);
+}
+
+void *tdb_fold_range(const tdb *db,
+                     const struct tdb_event_filter *filter,
+                     uint64_t start,
+                     uint64_t stop,
+                     tdb_fold_fn fun,
+                     void *acc) {
   tdb_iter *iter = tdb_iter_new(db, filter);
   const tdb_event *event;
+  if (iter == NULL)
+    return acc;
+  tdb_iter_range(iter, start, stop);
   while (tdb_iter_next(iter))
-    while ((event = tdb_cursor_next(iter->cursor)))
+    while ((event = tdb_iter_event(iter)))
       acc = fun(db, iter->marker - 1, event, acc);
   tdb_iter_free(iter);
   return acc;
 }
+
+/* Count the last trail seen by an aggregate fold */
+static
+void tdb_agg_trail(tdb_agg *agg) {
+  if (agg->trail_events) {
+    agg->num_trails++;
+    if (agg->lengths)
+      agg->lengths[agg->trail_events < agg->num_lengths ? agg->trail_events : agg->num_lengths - 1]++;
+  }
+  agg->trail_events = 0;
+}
+
+static
+void *tdb_agg_event(const tdb *db, uint64_t id, const tdb_event *event, void *acc) {
+  tdb_agg *agg = (tdb_agg *)acc;
+  uint64_t t = event->timestamp;
+  tdb_val val;
+  if (id != agg->trail_id) {
+    tdb_agg_trail(agg);
+    agg->trail_id = id;
+  }
+  agg->trail_events++;
+  agg->num_events++;
+  if (agg->times && t >= agg->time_start && (t - agg->time_start) / agg->time_width < agg->num_times)
+    agg->times[(t - agg->time_start) / agg->time_width]++;
+  if (agg->field) {
+    val = tdb_item_val(event->items[agg->field - 1]);
+    if (agg->value_events)
+      agg->value_events[val]++;
+    if (agg->value_trails && agg->marks[val] != id + 1) {
+      agg->marks[val] = id + 1;
+      agg->value_trails[val]++;
+    }
+    if (agg->first_seen && t < agg->first_seen[val])
+      agg->first_seen[val] = t;
+    if (agg->last_seen && t > agg->last_seen[val])
+      agg->last_seen[val] = t;
+  }
+  return agg;
+}
+
+/* Compute the aggregates over the rest of the events of the iterator.
+   The arrays per val need room for the lexicon size of the field, they are cleared first. */
+tdb_error tdb_aggregate(tdb_iter *iter, tdb_agg *agg) {
+  const tdb *db = iter->cursor->state->db;
+  const tdb_event *event;
+  uint64_t val, size = agg->field ? tdb_lexicon_size(db, agg->field) : 0;
+  if (agg->value_events || agg->value_trails || agg->first_seen || agg->last_seen) {
+    if (!agg->field || agg->field >= tdb_num_fields(db))
+      return TDB_ERR_UNKNOWN_FIELD;
+  } else {
+    agg->field = 0;
+  }
+  if ((agg->times && !agg->time_width) || (agg->lengths && !agg->num_lengths))
+    return TDB_ERR_INVALID_OPTION_VALUE;
+  if (agg->value_trails && (agg->marks = calloc(size + 1, sizeof(uint64_t))) == NULL)
+    return TDB_ERR_NOMEM;
+  for (val = 0; val < size; val++) {
+    if (agg->value_events)
+      agg->value_events[val] = 0;
+    if (agg->value_trails)
+      agg->value_trails[val] = 0;
+    if (agg->first_seen)
+      agg->first_seen[val] = UINT64_MAX;
+    if (agg->last_seen)
+      agg->last_seen[val] = 0;
+  }
+  if (agg->lengths)
+    memset(agg->lengths, 0, agg->num_lengths * sizeof(uint64_t));
+  if (agg->times)
+    memset(agg->times, 0, agg->num_times * sizeof(uint64_t));
+  agg->num_trails = agg->num_events = agg->trail_events = 0;
+  agg->trail_id = UINT64_MAX;
+  while (tdb_iter_next(iter))
+    while ((event = tdb_iter_event(iter)))
+      tdb_agg_event(db, iter->marker - 1, event, agg);
+  tdb_agg_trail(agg);
+  free(agg->marks);
+  agg->marks = NULL;
+  return TDB_ERR_OK;
+}
+
+static
+char *tdb_tsv_uint(char *p, uint64_t x) {
+  char digits[20];
+  int n = 0;
+  do {
+    digits[n++] = '0' + x % 10;
+  } while ((x /= 10));
+  while (n)
+    *p++ = digits[--n];
+  return p;
+}
+
+/* Format events as lines of tab separated values into buf, the same as trpy match prints them.
+   Stops before the first line which does not fit, num_formatted tells how many events were.
+   Returns the number of bytes written. */
+uint64_t tdb_tsv_format(const tdb *db,
+                        const tdb_tsv_opts *opts,
+                        uint64_t num_events,
+                        const uint64_t *trail_ids,
+                        const uint64_t *timestamps,
+                        const tdb_val **columns,
+                        char *buf,
+                        uint64_t size,
+                        uint64_t *num_formatted) {
+  static const char hex[] = "0123456789abcdef";
+  char *p = buf, stamp[32];
+  uint64_t i, k, n, len, need, stamp_len = 0, last_time = UINT64_MAX;
+  const uint8_t *uuid;
+  const char *value;
+  struct tm tm;
+  time_t t;
+  for (n = 0; n < num_events; n++) {
+    need = 32 + 1 + sizeof(stamp) + 1;
+    for (k = 0; k < opts->num_fields; k++) {
+      if (opts->expand && tdb_get_value(db, opts->fields[k], columns[k][n], &len))
+        need += len + 1;
+      else
+        need += 20 + 1;
+    }
+    if (need > size - (p - buf))
+      break;
+
+    if (opts->cookies && (uuid = tdb_get_uuid(db, trail_ids[n]))) {
+      for (i = 0; i < 16; i++) {
+        *p++ = hex[uuid[i] >> 4];
+        *p++ = hex[uuid[i] & 15];
+      }
+    } else {
+      p = tdb_tsv_uint(p, trail_ids[n] + opts->id_offset);
+    }
+    *p++ = '\t';
+
+    if (timestamps[n] != last_time) {
+      last_time = timestamps[n];
+      if (opts->raw_timestamps) {
+        stamp_len = tdb_tsv_uint(stamp, last_time) - stamp;
+        if (stamp_len < 19) {
+          memmove(stamp + 19 - stamp_len, stamp, stamp_len);
+          memset(stamp, ' ', 19 - stamp_len);
+          stamp_len = 19;
+        }
+      } else {
+        t = (time_t)last_time;
+        gmtime_r(&t, &tm);
+        stamp_len = strftime(stamp, sizeof(stamp), "%Y-%m-%d %H:%M:%S", &tm);
+      }
+    }
+    memcpy(p, stamp, stamp_len);
+    p += stamp_len;
+
+    for (k = 0; k < opts->num_fields; k++) {
+      *p++ = '\t';
+      if (opts->expand) {
+        if ((value = tdb_get_value(db, opts->fields[k], columns[k][n], &len))) {
+          memcpy(p, value, len);
+          p += len;
+        }
+      } else {
+        p = tdb_tsv_uint(p, columns[k][n]);
+      }
+    }
+    *p++ = '\n';
+  }
+  *num_formatted = n;
+  return p - buf;
+}
@@ -7,14 +7,96 @@
 typedef struct {
   uint64_t marker;
   tdb_cursor *cursor;
+  uint64_t start;
+  uint64_t stop;
+  uint64_t tmin;
+  uint64_t tmax;
 } tdb_iter;
 
 tdb_iter *tdb_iter_new(const tdb *db, const struct tdb_event_filter *filter);
+tdb_iter *tdb_iter_range(tdb_iter *iter, uint64_t start, uint64_t stop);
+tdb_iter *tdb_iter_window(tdb_iter *iter, uint64_t tmin, uint64_t tmax);
 tdb_iter *tdb_iter_next(tdb_iter *iter);
+const tdb_event *tdb_iter_event(tdb_iter *iter);
 void tdb_iter_free(tdb_iter *iter);
 
+tdb_error tdb_cons_add_many(tdb_cons *cons,
+                            uint64_t num_events,
+                            uint64_t num_values,
+                            const uint8_t *uuids,
+                            const uint64_t *timestamps,
+                            const char *values,
+                            const uint64_t *lengths,
+                            uint64_t *num_added);
+
+uint64_t tdb_lexicon_read(const tdb *db, tdb_field field, char *buf, uint64_t *offs);
+uint64_t tdb_trail_map(const tdb *other, const tdb *db, uint64_t *ids);
+uint64_t tdb_get_uuids(const tdb *db, const uint64_t *trail_ids, uint64_t num_ids, uint8_t *uuids);
+uint64_t tdb_get_trail_ids(const tdb *db, const uint8_t *uuids, uint64_t num_uuids, uint64_t *trail_ids);
+
+uint64_t tdb_cursor_batch(tdb_cursor *cursor,
+                          uint64_t max_events,
+                          uint64_t *timestamps,
+                          tdb_val *vals,
+                          uint64_t stride);
+uint64_t tdb_iter_batch(tdb_iter *iter,
+                        uint64_t max_events,
+                        uint64_t *trail_ids,
+                        uint64_t *timestamps,
+                        tdb_val *vals);
+
 typedef void *(*tdb_fold_fn)(const tdb *, uint64_t, const tdb_event *, void *);
 void *tdb_fold(const tdb *db, const struct tdb_event_filter *filter, tdb_fold_fn fun, void *acc);
+void *tdb_fold_range(const tdb *db,
+                     const struct tdb_event_filter *filter,
+                     uint64_t start,
+                     uint64_t stop,
+                     tdb_fold_fn fun,
+                     void *acc);
+
+/* Aggregates computed in a single fold over the (filtered) events of a TrailDB.
+   Only the arrays which are not NULL are filled in. */
+typedef struct {
+  tdb_field field;          /* the field of the aggregates per val */
+  uint64_t *value_events;   /* the number of events with each val */
+  uint64_t *value_trails;   /* the number of trails with each val */
+  uint64_t *first_seen;     /* the first timestamp of each val, UINT64_MAX if never seen */
+  uint64_t *last_seen;      /* the last timestamp of each val, 0 if never seen */
+  uint64_t *lengths;        /* the number of trails with each number of events (the last, or more) */
+  uint64_t num_lengths;
+  uint64_t *times;          /* the number of events in each time bucket (others are not counted) */
+  uint64_t num_times;
+  uint64_t time_start;
+  uint64_t time_width;
+  uint64_t num_trails;      /* the trails with any events */
+  uint64_t num_events;
+  /* the state of the fold */
+  uint64_t *marks;          /* the last trail (+ 1) counted for each val */
+  uint64_t trail_id;
+  uint64_t trail_events;
+} tdb_agg;
+
+tdb_error tdb_aggregate(tdb_iter *iter, tdb_agg *agg);
+
+/* How to format events as lines of tab separated values: id, time, then the fields */
+typedef struct {
+  const tdb_field *fields;  /* the fields to write, columns[k] holds the vals of fields[k] */
+  uint64_t num_fields;
+  uint64_t id_offset;       /* added to the trail ids written (but not those looked up) */
+  int cookies;              /* write the cookie of each trail instead of its id */
+  int expand;               /* write values instead of vals */
+  int raw_timestamps;       /* write timestamps as numbers instead of UTC times */
+} tdb_tsv_opts;
+
+uint64_t tdb_tsv_format(const tdb *db,
+                        const tdb_tsv_opts *opts,
+                        uint64_t num_events,
+                        const uint64_t *trail_ids,
+                        const uint64_t *timestamps,
+                        const tdb_val **columns,
+                        char *buf,
+                        uint64_t size,
+                        uint64_t *num_formatted);
 
 struct tdb_decode_state {
   const tdb *db;
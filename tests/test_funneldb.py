@@ -0,0 +1,393 @@
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from trpy import TDBCons, FDB, FDBError, Q, oneOf, where, whereNot
+from trpy.__trpy__ import ffi, lib
+from trpy.funneldb import FDBCache, FDB_DENSE, FDB_SPARSE, FDB_CHUNKED, FDB_VERSION
+
+FDB_CHUNK_ARRAY, FDB_CHUNK_MASKS, FDB_CHUNK_RUNS = 1, 2, 3
+CHUNK = 1 << 16
+
+class FDBTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(0)
+        self.dir = tempfile.mkdtemp(prefix='trpy-test-')
+        cons = TDBCons(os.path.join(self.dir, 'tiny'), ['kind', 'k'])
+        for t in xrange(200):
+            cookie = '%032x' % t
+            for n in xrange(rnd.randrange(1, 6)):
+                cons.add(cookie, 1000 + 10 * t + n, ['m%d' % rnd.randrange(4), 'k%d' % rnd.randrange(3)])
+        self.tdb = cons.finalize()
+        self.fdb = FDB.make(self.tdb, keys=[(), ('k', )], mask_field='kind')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def sets(self):
+        fdb = self.fdb
+        return [fdb.funnel(id) for id in xrange(len(fdb))] + \
+               [fdb.query(q) for q in ('/m1', 'k=k0', 'k=k0 & k=k1', 'k=k1 | k=k2', 'k=k2 & /m0', '/m0 - /m1')]
+
+    def test_sets(self):
+        for set in self.sets():
+            ids = [id for id, mask in set]
+            self.assertEqual(len(set), len(ids))
+            self.assertEqual(list(set.ids()), ids)
+            self.assertEqual(ids, sorted(ids))
+
+    def test_rows(self):
+        fdb, tdb = self.fdb, self.tdb
+        self.assertEqual(len(fdb.funnel(0)), tdb.num_trails)
+        for k in tdb.lexicon('k'):
+            trails = sum(1 for id, trail in tdb.match(expand=True) if any(e.k == k for e in trail))
+            self.assertEqual(len(fdb.query('k=%s' % k)), trails)
+
+class FDBBuildTest(unittest.TestCase):
+    """
+    Ways of building a FunnelDB, which should all give the same rows.
+    """
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(1)
+        cls.dir = tempfile.mkdtemp(prefix='trpy-test-')
+        cls.rows = rows = []
+        for t in xrange(3000):
+            cookie = '%032x' % t
+            for n in xrange(rnd.randrange(1, 8)):
+                time = 1000 + rnd.randrange(30000)
+                # the latest events bring a new kind, as a delta would
+                rows.append((cookie, time, ('m%d' % rnd.randrange(6 if time < 25000 else 7),
+                                            'k%d' % rnd.randrange(20))))
+        cls.tdb = cls.cons('build', rows)
+        cls.keys = [(), ('k', )]
+
+    @classmethod
+    def cons(cls, name, rows):
+        cons = TDBCons(os.path.join(cls.dir, name), ['kind', 'k'])
+        cons.add_rows(rows)
+        return cons.finalize()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def dumped(self, fdb):
+        with tempfile.TemporaryFile() as file:
+            fdb.dump(file)
+            file.seek(0)
+            return file.read()
+
+    def test_threads(self):
+        tdb = self.tdb
+        serial = self.dumped(FDB.make(tdb, keys=self.keys, mask_field='kind'))
+        for threads in (2, 3, 8, tdb.num_trails + 5):
+            fdb = FDB.make(tdb, keys=self.keys, mask_field='kind', threads=threads)
+            self.assertEqual(self.dumped(fdb), serial, "threads=%d" % threads)
+
+    def assertSameRows(self, fdb, other):
+        self.assertEqual(len(fdb), len(other))
+        for id in xrange(len(fdb)):
+            self.assertEqual(list(fdb.funnel(id)), list(other.funnel(id)), "row %d" % id)
+
+    def test_single_pass(self):
+        tdb = self.tdb
+        fdb = FDB.make(tdb, keys=self.keys, mask_field='kind')
+        for threads in (1, 3):
+            buffered = FDB.make(tdb, keys=self.keys, mask_field='kind', threads=threads, single_pass=True)
+            self.assertEqual(buffered.stats['num_spilled'], 0)
+            self.assertSameRows(buffered, fdb)
+            spilled = FDB.make(tdb, keys=self.keys, mask_field='kind', threads=threads,
+                               single_pass=True, max_buffered=4096)
+            self.assertGreater(spilled.stats['num_spilled'], 0)
+            self.assertSameRows(spilled, fdb)
+
+    def test_merge(self):
+        tdb = self.tdb
+        history = self.cons('history', [r for r in self.rows if r[1] < 21000])
+        delta = self.cons('delta', [r for r in self.rows if r[1] >= 21000])
+        for opts in ({}, {'buckets': 3600}):
+            fdbs = [FDB.make(db, keys=self.keys, mask_field='kind', **opts) for db in (history, delta)]
+            merged = FDB.merge(tdb, fdbs)
+            self.assertSameRows(merged, FDB.make(tdb, keys=self.keys, mask_field='kind', **opts))
+        self.assertRaises(FDBError, FDB.merge, tdb, [])
+
+    def test_buckets(self):
+        tdb, queries = self.tdb, ['', 'm1', 'm2,m3', '!m0', 'm1+m5']
+        keys = [{}] + [{'k': k} for k in tdb.lexicon('k')]
+        fdb = FDB.make(tdb, keys=self.keys, mask_field='kind', buckets=1000)
+        start, width, num = fdb.bucketing
+        end = start + num * width
+        for lo, hi in ((start + 3 * width, start + 7 * width), (start - width // 2, start + 2 * width),
+                       (end - 4 * width, end + 3 * width), (None, start + 5 * width), (start + width, None),
+                       (None, None), (start - width // 4, end + 2 * width)):
+            rows = [r for r in self.rows if (lo is None or r[1] >= lo) and (hi is None or r[1] < hi)]
+            part = FDB.make(self.cons('part-%s-%s' % (lo, hi), rows), keys=self.keys, mask_field='kind')
+            self.assertEqual(fdb.family(queries, (lo, hi)).counts_all(keys).tolist(),
+                             part.family(queries).counts_all(keys).tolist(), (lo, hi))
+            self.assertEqual(len(fdb.select(k='k3', kind=where('m1'), time=(lo, hi))),
+                             len(part.select(k='k3', kind=where('m1'))), (lo, hi))
+        self.assertEqual(fdb.buckets((end, end + width)), (num, 0))
+        self.assertFalse(fdb.family(queries, (end, end + width)).counts_all(keys).any())
+
+    def test_cache(self):
+        # the same funnel ids and queries mean different rows in each file
+        tdb, paths = self.tdb, []
+        for name, keys in (('all.fdb', [(), ('k', )]), ('k.fdb', [('k', ), ()])):
+            paths.append(os.path.join(self.dir, name))
+            with open(paths[-1], 'w') as file:
+                FDB.make(tdb, keys=keys, mask_field='kind').dump(file)
+        fdbs = [FDB.load(tdb, open(path)) for path in paths]
+        queries = ['k=k%d' % i for i in xrange(5)] + ['k=k1 | k=k2', 'k=k3 & /m0', '/m1']
+        expected = [[len(fdb.funnel(id)) for id in xrange(5)] + [len(fdb.query(q)) for q in queries]
+                    for fdb in fdbs]
+        self.assertNotEqual(expected[0][:5], expected[1][:5])
+        cache = FDBCache(ids=True)
+        for n in xrange(2):
+            for path, counts in zip(paths, expected):
+                fdb = FDB.load(tdb, open(path), cache=cache)
+                for k in xrange(2):
+                    self.assertEqual([len(fdb.funnel(id)) for id in xrange(5)] +
+                                     [len(fdb.query(q)) for q in queries], counts)
+                    self.assertEqual([len(fdb.query(q).ids()) for q in queries], counts[5:])
+        self.assertGreater(cache.stats['hits'], 0)
+
+class FDBLayersTest(unittest.TestCase):
+    """
+    A mask field of more than 16 values, and another mask field, in three layers.
+    """
+    # (family query, select query, whether the kinds and srcs of a trail match)
+    queries = [('m3', {'kind': where('m3')}, lambda kinds, srcs: 'm3' in kinds),
+               ('m18', {'kind': where('m18')}, lambda kinds, srcs: 'm18' in kinds),
+               ('m3,m18', {'kind': where('m3', 'm18')}, lambda kinds, srcs: {'m3', 'm18'} <= kinds),
+               ('m3+m18', {'kind': oneOf('m3', 'm18')}, lambda kinds, srcs: bool({'m3', 'm18'} & kinds)),
+               ('!m18', {'kind': whereNot('m18')}, lambda kinds, srcs: 'm18' not in kinds),
+               ('src=s1', {'src': where('s1')}, lambda kinds, srcs: 's1' in srcs),
+               ('m18,src=s1', {'kind': where('m18'), 'src': where('s1')},
+                lambda kinds, srcs: 'm18' in kinds and 's1' in srcs),
+               ('!m3,!src=s2', {'kind': whereNot('m3'), 'src': whereNot('s2')},
+                lambda kinds, srcs: 'm3' not in kinds and 's2' not in srcs)]
+
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(2)
+        cls.dir = tempfile.mkdtemp(prefix='trpy-test-')
+        cons = TDBCons(os.path.join(cls.dir, 'layers'), ['kind', 'src', 'k'])
+        for t in xrange(400):
+            cookie = '%032x' % t
+            for n in xrange(rnd.randrange(1, 8)):
+                cons.add(cookie, 1000 + 10 * t + n,
+                         ['m%d' % rnd.randrange(20), 's%d' % rnd.randrange(3), 'k%d' % rnd.randrange(4)])
+        cls.tdb = tdb = cons.finalize()
+        cls.fdb = FDB.make(tdb, keys=[(), ('k', )], mask_field=['kind', 'src'])
+        cls.keys = [{}] + [{'k': k} for k in tdb.lexicon('k')]
+        cls.trails = trails = dict((repr(key), {}) for key in cls.keys)
+        for id, trail in tdb.match(expand=True):
+            for e in trail:
+                for key in ({}, {'k': e.k}):
+                    kinds, srcs = trails[repr(key)].setdefault(id, (set(), set()))
+                    kinds.add(e.kind)
+                    srcs.add(e.src)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def reference(self, key, match):
+        return sorted(id for id, (kinds, srcs) in self.trails[repr(key)].items() if match(kinds, srcs))
+
+    def test_layers(self):
+        fdb, tdb = self.fdb, self.tdb
+        self.assertGreater(tdb.lexicon_size('kind'), 17)
+        self.assertEqual(fdb.masks, ['kind', 'src'])
+        self.assertEqual(len(fdb.layers), 3)
+        for value in tdb.lexicon('kind'):
+            val = tdb.lexicon_val('kind', value)
+            self.assertEqual(fdb.mask_bit(value), (val // 16, val % 16))
+        self.assertEqual(fdb.mask_bit('src=s1'), (2, tdb.lexicon_val('src', 's1')))
+
+    def test_select(self):
+        for key in self.keys:
+            for family, select, match in self.queries:
+                set = self.fdb.select(**dict(key, **select))
+                expected = self.reference(key, match)
+                self.assertEqual([id for id, mask in set], expected, (key, family))
+                self.assertEqual(len(set), len(expected), (key, family))
+
+    def test_family(self):
+        family = self.fdb.family([q for q, select, match in self.queries])
+        expected = [[len(self.reference(key, match)) for q, select, match in self.queries]
+                    for key in self.keys]
+        self.assertEqual(family.counts_all(self.keys).tolist(), expected)
+        self.assertEqual([family.counts(key) for key in self.keys], map(tuple, expected))
+
+class FDBStorageTest(unittest.TestCase):
+    """
+    Rows spanning several chunks of 2^16 ids, laid out to be stored in each kind of chunk.
+    """
+    N = 3 * CHUNK + 1000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix='trpy-test-')
+        rows = []
+        def add(t, k, kind):
+            rows.append(('%032x' % t, 1000 + t, (k, kind)))
+        for t in xrange(cls.N):
+            add(t, 'base', 'a' if t % 5 else 'b')
+            if CHUNK - 5000 <= t < CHUNK + 5000:
+                add(t, 'runs', 'c')
+            if 2 * CHUNK <= t < 2 * CHUNK + 40000 and t % 4:
+                add(t, 'masks', 'a' if t % 2 else 'b')
+            if t % 7 == 0:
+                add(t, 'array', 'abc'[t % 3])
+        cons = TDBCons(os.path.join(cls.dir, 'chunky'), ['k', 'kind'])
+        cons.add_rows(rows)
+        cls.tdb = cons.finalize()
+        cls.fdb = FDB.make(cls.tdb, keys=[('k', )], mask_field='kind')
+        cls.expected = expected = {}
+        for cookie, time, (k, kind) in rows:
+            t = int(cookie, 16)
+            expected.setdefault(k, {})
+            expected[k][t] = expected[k].get(t, 0) | 1 << cls.tdb.lexicon_val('kind', kind)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def chunk_types(self, fdb, id):
+        funnel = ffi.new('fdb_funnel *')
+        data = lib.fdb_get_row(fdb._db, id, funnel)
+        if not funnel.flags & FDB_CHUNKED:
+            return None
+        num_chunks = ffi.cast('fdb_eid *', data)[0]
+        # an fdb_chunk is (key, type, length, size, offs), after the 8 byte aligned count
+        return [ord(ffi.buffer(data + 8 + 24 * c + 4, 1)[0]) for c in xrange(num_chunks)]
+
+    def reference(self, k):
+        return sorted(self.expected[k].items())
+
+    def assertRows(self, fdb):
+        for k in self.expected:
+            set = fdb.select(k=k)
+            self.assertEqual(list(set), self.reference(k))
+            self.assertEqual(len(set), len(self.expected[k]))
+
+    def test_chunks(self):
+        fdb = self.fdb
+        self.assertEqual(self.chunk_types(fdb, fdb.funnel_id({'k': 'runs'})), [FDB_CHUNK_RUNS] * 2)
+        self.assertEqual(self.chunk_types(fdb, fdb.funnel_id({'k': 'masks'})), [FDB_CHUNK_MASKS])
+        self.assertEqual(self.chunk_types(fdb, fdb.funnel_id({'k': 'array'})), [FDB_CHUNK_ARRAY] * 4)
+        self.assertIsNone(self.chunk_types(fdb, fdb.funnel_id({'k': 'base'})))
+        self.assertRows(fdb)
+
+    def test_seek(self):
+        fdb = self.fdb
+        for a, b in (('runs', 'array'), ('masks', 'array'), ('base', 'runs'), ('array', 'masks')):
+            both = sorted(set(self.expected[a]) & set(self.expected[b]))
+            self.assertEqual([id for id, mask in fdb.select(k=a) & fdb.select(k=b)], both)
+            self.assertEqual(len(fdb.select(k=a) & fdb.select(k=b)), len(both))
+        ids = [id for id, mask in fdb.select(k='array') & fdb.select(k='array', kind=where('c'))]
+        c = 1 << self.tdb.lexicon_val('kind', 'c')
+        self.assertEqual(ids, [id for id, mask in self.reference('array') if mask & c])
+
+    def test_gather(self):
+        fdb = self.fdb
+        sets = [fdb.select(k='base'), fdb.select(k='runs', kind=where('c')),
+                fdb.select(k='base') & fdb.select(k='runs'), fdb.select(k='masks') | fdb.select(k='array')]
+        for set in sets:
+            elems = list(set)
+            self.assertEqual(list(set.ids()), [id for id, mask in elems])
+            try:
+                import numpy
+            except ImportError:
+                continue
+            self.assertEqual(set.numpy().tolist(), [id for id, mask in elems])
+            self.assertEqual(set.numpy(masks=True)[['id', 'mask']].tolist(), elems)
+
+    def test_index(self):
+        fdb, indexed = self.fdb, FDB.make(self.tdb, keys=[('k', )], mask_field='kind', index=True)
+        self.assertEqual(indexed.stats['num_indexed'], len(self.expected))
+        queries = ['', 'a', 'b', 'c', 'a,b', 'a+c', '!a', '!b,!c']
+        keys = [{'k': k} for k in self.expected]
+        self.assertEqual(indexed.family(queries).counts_all(keys).tolist(),
+                         fdb.family(queries).counts_all(keys).tolist())
+        for key in keys:
+            self.assertEqual(indexed.family(queries).counts(key), fdb.family(queries).counts(key))
+            for q in queries:
+                kind = Q.parse(q, ext=True)
+                self.assertEqual(len(indexed.select(kind=kind, **key)), len(fdb.select(kind=kind, **key)))
+        self.assertRows(indexed)
+
+    def test_estimate(self):
+        sketched = FDB.make(self.tdb, keys=[('k', )], mask_field='kind', sketch=1024)
+        self.assertEqual(sketched.stats['num_sketched'], len(self.expected))
+        for fdb in (self.fdb, sketched):
+            base, runs, masks, array = [fdb.select(k=k) for k in ('base', 'runs', 'masks', 'array')]
+            for set in (base & runs, masks | array, base - array, runs ^ array, base & masks - array,
+                        fdb.select(k='base', kind=where('b')) | array):
+                exact, (estimate, error) = len(set), set.estimate()
+                if fdb is sketched:
+                    self.assertGreater(error, 0)
+                    self.assertLessEqual(abs(estimate - exact), 4 * error, (estimate, error, exact))
+                else:
+                    self.assertEqual((estimate, error), (exact, 0))
+
+    def test_dump(self):
+        path = os.path.join(self.dir, 'chunky.fdb')
+        with open(path, 'w') as file:
+            self.fdb.dump(file)
+        self.assertRows(FDB.load(self.tdb, open(path)))
+
+    def test_counted(self):
+        path = os.path.join(self.dir, 'counted.fdb')
+        with open(path, 'w') as file:
+            self.fdb.dump(file)
+        fdb = FDB.load(self.tdb, open(path), stats=True)
+        for set in (fdb.select(k='base'), fdb.select(k='base', kind=where('b'))):
+            len(set)
+            self.assertEqual(set.stats['num_counted'], 1)
+            self.assertEqual(set.stats['num_visited'], 0)
+
+    def test_unversioned(self):
+        # a FunnelDB from before versioning stored every row dense or sparse,
+        # and had zero padding where the version is now
+        fdb, num_ids = self.fdb, self.N
+        toc, data, offs = [], [], 0
+        for id in xrange(len(fdb)):
+            row = list(fdb.funnel(id))
+            if id == fdb.funnel_id({'k': 'base'}):
+                masks = [0] * num_ids
+                for i, mask in row:
+                    masks[i] = mask
+                flags, length, blob = FDB_DENSE, num_ids, struct.pack('=%dH' % num_ids, *masks)
+            else:
+                flags, length, blob = FDB_SPARSE, len(row), ''.join(struct.pack('=IH2x', *e) for e in row)
+            blob += '\0' * (-len(blob) % 8)
+            toc.append(struct.pack('=B7xQI4x', flags, offs, length))
+            data.append(blob)
+            offs += len(blob)
+        header = struct.pack('=QQ', ffi.sizeof('fdb') + len(toc) * ffi.sizeof('fdb_funnel'), offs)
+        header += ffi.buffer(fdb._db.params)[:] + struct.pack('=II', len(fdb), 0)
+        self.assertEqual(len(header), ffi.sizeof('fdb'))
+        path = os.path.join(self.dir, 'unversioned.fdb')
+        with open(path, 'w') as file:
+            file.write(header + ''.join(toc) + ''.join(data))
+        old = FDB.load(self.tdb, open(path))
+        self.assertEqual(old._db.version, 0)
+        self.assertRows(old)
+
+    def test_newer(self):
+        path = os.path.join(self.dir, 'newer.fdb')
+        with open(path, 'w') as file:
+            self.fdb.dump(file)
+        with open(path, 'r+') as file:
+            file.seek(ffi.offsetof('fdb', 'version'))
+            file.write(struct.pack('=I', FDB_VERSION + 1))
+        self.assertRaises(FDBError, FDB.load, self.tdb, open(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from trpy import TDBCons, TDB, TDBError, TDBSet, during, where
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def trpy(*args):
+    """
+    Run the trpy command with args, returning its exit status, output and errors.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bin', 'trpy')] + list(args),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    return proc.returncode, out, err
+
+class TDBTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(0)
+        cls.dir = tempfile.mkdtemp(prefix='trpy-test-')
+        cls.path = os.path.join(cls.dir, 'small')
+        cons = TDBCons(cls.path, ['kind', 'k'])
+        for t in xrange(300):
+            cookie = '%032x' % t
+            for n in xrange(rnd.randrange(1, 6)):
+                cons.add(cookie, 1000 + 10 * t + n, ['m%d' % rnd.randrange(4), 'k%d' % rnd.randrange(5)])
+        cls.tdb = cons.finalize()
+        cls.bare = os.path.join(cls.dir, 'bare')
+        cons = TDBCons(cls.bare, [])
+        for t in xrange(20):
+            cons.add('%032x' % t, 1000 + t, [])
+        cons.finalize()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_aggregate_stats(self):
+        tdb = TDB(self.path, stats=True)
+        result = tdb.aggregate(query=during(1500, 2000))
+        self.assertEqual(tdb.stats, {'trails': tdb.num_trails,
+                                     'matched': result['num_trails'],
+                                     'events': result['num_events']})
+        tdb = TDB(self.path, stats=True)
+        result = tdb.aggregate(query=during(5000, 6000))
+        self.assertEqual(result['num_trails'], 0)
+        self.assertEqual(tdb.stats, {'trails': 0, 'matched': 0, 'events': 0})
+
+    def events(self, start=None, end=None, kind=None):
+        return [(id, e) for id, trail in self.tdb.match(expand=True) for e in trail
+                if (start is None or e.time >= start) and (end is None or e.time < end)
+                and (kind is None or e.kind == kind)]
+
+    def test_during(self):
+        tdb = self.tdb
+        for start, end in ((1500, 2000), (None, 1800), (2500, None), (1500, 1500), (5000, 6000), (0, 500)):
+            found = [(id, e) for id, trail in tdb.match(query=during(start, end), expand=True) for e in trail]
+            self.assertEqual(found, self.events(start, end), (start, end))
+            found = [(id, e) for id, trail in tdb.match(query=during(start, end) & where(kind='m1'), expand=True)
+                     for e in trail]
+            self.assertEqual(found, self.events(start, end, 'm1'), (start, end))
+        for query in (~during(1500, 2000), during(1500, 2000) | where(kind='m1')):
+            self.assertRaises(TDBError, tdb.match, query=query)
+
+    def test_since_until(self):
+        def lines(*args):
+            status, out, err = trpy('match', self.path, '-T', '-e', *args)
+            self.assertEqual(status, 0, err)
+            return out.splitlines()
+        def expected(*window):
+            return ['%s\t%19d\t%s\t%s' % (id, e.time, e.kind, e.k) for id, e in self.events(*window)]
+        self.assertEqual(lines('--since', '1500', '--until', '2000'), expected(1500, 2000))
+        self.assertEqual(lines('--since', '1970-01-01T00:25', '--until', '1970-01-01 00:33:20'),
+                         expected(1500, 2000))
+        self.assertEqual(lines('-q', 'time=1500:2000'), expected(1500, 2000))
+        self.assertEqual(lines('--since', '2500'), lines('-q', 'time=2500:'))
+        self.assertEqual(lines('-q', 'kind=m1', '--until', '1800'), expected(None, 1800, 'm1'))
+        for query in ('~time=1500:2000', 'time=1500:2000 | kind=m1'):
+            status, out, err = trpy('match', self.path, '-q', query)
+            self.assertNotEqual(status, 0)
+            self.assertIn('Time ranges must be and-ed with the rest of the query', err)
+        status, out, err = trpy('match', self.path, '--since', 'yesterday')
+        self.assertNotEqual(status, 0)
+        self.assertIn("not a timestamp or UTC date: 'yesterday'", err)
+
+    def test_export_tsv(self):
+        for path, query in ((self.path, ['-q', 'kind=m2', '--since', '2000']), (self.bare, ['--since', '1010'])):
+            for args in ([], ['-e'], ['-c'], ['-T'], ['-e', '-c', '-T', '-H'], query):
+                status, matched, err = trpy('match', path, *args)
+                self.assertEqual(status, 0, err)
+                status, exported, err = trpy('export', path, '-F', 'tsv', *args)
+                self.assertEqual(status, 0, err)
+                self.assertEqual(exported, matched, (path, args))
+                self.assertTrue(matched)
+        status, out, err = trpy('match', self.bare, '-T', '-n', '1')
+        self.assertEqual(out, '0\t%19d\n' % 1000)
+
+    def test_aggregate_seen(self):
+        tdb = self.tdb
+        seen = {}
+        for id, trail in tdb.match(expand=True):
+            for e in trail:
+                first, last = seen.get(e.kind, (e.time, e.time))
+                seen[e.kind] = min(first, e.time), max(last, e.time)
+        result = tdb.aggregate('kind', seen=True)
+        for value in tdb.lexicon('kind'):
+            val = tdb.lexicon_val('kind', value)
+            self.assertEqual((result['first_seen'][val], result['last_seen'][val]), seen[value])
+        self.assertEqual((result['first_seen'][0], result['last_seen'][0]), (None, None))
+        for kwds in ({'seen': True}, {'values': True}, {'trails': True}):
+            self.assertRaises(TDBError, tdb.aggregate, **kwds)
+            self.assertRaises(TDBError, TDBSet([self.path]).aggregate, **kwds)
+
+class TDBSetTest(unittest.TestCase):
+    """
+    Two shards, with some cookies in both and some values only in the second,
+    viewed as one TDBSet and compared to the same events in one TrailDB.
+    """
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(3)
+        cls.dir = tempfile.mkdtemp(prefix='trpy-test-')
+        fields = ['kind', 'k']
+        shards = [TDBCons(os.path.join(cls.dir, 'shard%d' % s), fields) for s in xrange(2)]
+        merged = TDBCons(os.path.join(cls.dir, 'merged'), fields)
+        for t in xrange(300):
+            cookie = '%032x' % rnd.randrange(1 << 128)
+            for s in (0, 1) if t % 3 == 0 else (t % 3 - 1, ):
+                for n in xrange(rnd.randrange(1, 5)):
+                    time = 10000 * s + 10 * t + n
+                    values = ['m%d' % rnd.randrange(4 + 4 * s), 'k%d' % rnd.randrange(3)]
+                    shards[s].add(cookie, time, values)
+                    merged.add(cookie, time, values)
+        cls.shards = [cons.finalize() for cons in shards]
+        cls.merged = merged.finalize()
+        cls.tdbs = TDBSet([db.path for db in cls.shards])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_ids(self):
+        tdbs, shards = self.tdbs, self.shards
+        self.assertEqual(tdbs.num_trails, sum(db.num_trails for db in shards))
+        self.assertEqual(tdbs.num_events, self.merged.num_events)
+        ids = []
+        for s, db in enumerate(shards):
+            for i in xrange(db.num_trails):
+                ids.append(len(ids))
+                self.assertEqual(tdbs.locate(ids[-1]), (s, i))
+                self.assertEqual(tdbs.cookie(ids[-1]), db.cookie(i))
+                self.assertEqual(tdbs.trail(ids[-1], expand=True), db.trail(i, expand=True))
+        self.assertEqual([id for id, trail in tdbs.match()], ids)
+        self.assertEqual(tdbs.cookies(ids[::-1]), [tdbs.cookie(id) for id in ids[::-1]])
+        self.assertRaises(IndexError, tdbs.locate, len(ids))
+
+    def test_lexicon_map(self):
+        tdbs, shards = self.tdbs, self.shards
+        for field in ('kind', 'k'):
+            words, vals, maps = tdbs.lexicon_map(field)
+            self.assertEqual(sorted(words[1:]), sorted(self.merged.lexicon(field)))
+            self.assertEqual(words[:shards[0].lexicon_size(field)], [''] + list(shards[0].lexicon(field)))
+            for s, db in enumerate(shards):
+                self.assertEqual([words[v] for v in maps[s][1:]], list(db.lexicon(field)))
+            for word in words[1:]:
+                self.assertEqual(tdbs.lexicon_word(field, tdbs.lexicon_val(field, word)), word)
+        self.assertGreater(tdbs.lexicon_size('kind'), shards[0].lexicon_size('kind'))
+
+    def test_vals(self):
+        tdbs = self.tdbs
+        expanded = dict(tdbs.match(expand=True))
+        for id, trail in tdbs.match():
+            self.assertEqual([(e.time, tdbs.lexicon_word('kind', e.kind), tdbs.lexicon_word('k', e.k))
+                              for e in trail], expanded[id])
+
+    def test_cookies(self):
+        tdbs, merged = self.tdbs, self.merged
+        for id in xrange(merged.num_trails):
+            cookie = merged.cookie(id)
+            self.assertEqual(tdbs.trail(cookie, expand=True), merged.trail(id, expand=True))
+            found = tdbs.trail_ids(cookie)
+            self.assertEqual(len(found), len(tdbs.find(cookie)))
+            self.assertEqual(tdbs.cookie_id(cookie), found[0])
+            self.assertEqual(set(tdbs.cookie(i) for i in found), set([cookie]))
+        self.assertEqual(sum(len(tdbs.trail_ids(c)) for c in merged.cookies(range(merged.num_trails))),
+                         tdbs.num_trails)
+
+    def test_match(self):
+        tdbs, merged = self.tdbs, self.merged
+        for query in (where(kind='m1'), where(kind='m6'), where(kind='m2', k='k0'), during(2000, 12000)):
+            found = {}
+            for id, trail in tdbs.match(query=query, expand=True):
+                found.setdefault(tdbs.cookie(id), []).extend(trail)
+            expected = dict((merged.cookie(id), trail) for id, trail in merged.match(query=query, expand=True))
+            self.assertEqual(dict((c, sorted(t)) for c, t in found.items()), expected, query)
+
+if __name__ == '__main__':
+    unittest.main()
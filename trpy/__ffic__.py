@@ -9,8 +9,9 @@ ffic.set_source('trpy.__trpy__', '''
 ''', sources=['src/tdb_iter.c',
               'src/funneldb.c'],
      include_dirs=['src'],
-     libraries=['traildb'],
-     extra_compile_args=['-std=c99', '-D_DEFAULT_SOURCE'])
+     libraries=['traildb', 'm'],
+     extra_compile_args=['-std=c99', '-D_DEFAULT_SOURCE', '-pthread'],
+     extra_link_args=['-pthread'])
 
 ffic.cdef('''
    typedef struct tdb_cons tdb_cons;
@@ -43,6 +44,10 @@ ffic.cdef('''
    struct tdb_iter {
        uint64_t marker;
        struct tdb_cursor *cursor;
+       uint64_t start;
+       uint64_t stop;
+       uint64_t tmin;
+       uint64_t tmax;
        ...;
    };
 
@@ -117,13 +122,80 @@ ffic.cdef('''
                                          const struct tdb_event_filter *filter);
 
    tdb_iter *tdb_iter_new(const tdb *db, const struct tdb_event_filter *filter);
+   tdb_iter *tdb_iter_range(tdb_iter *iter, uint64_t start, uint64_t stop);
+   tdb_iter *tdb_iter_window(tdb_iter *iter, uint64_t tmin, uint64_t tmax);
    tdb_iter *tdb_iter_next(tdb_iter *iter);
+   const tdb_event *tdb_iter_event(tdb_iter *iter);
    void tdb_iter_free(tdb_iter *iter);
+
+   tdb_error tdb_cons_add_many(tdb_cons *cons,
+                               uint64_t num_events,
+                               uint64_t num_values,
+                               const uint8_t *uuids,
+                               const uint64_t *timestamps,
+                               const char *values,
+                               const uint64_t *lengths,
+                               uint64_t *num_added);
+
+   uint64_t tdb_lexicon_read(const tdb *db, tdb_field field, char *buf, uint64_t *offs);
+   uint64_t tdb_trail_map(const tdb *other, const tdb *db, uint64_t *ids);
+   uint64_t tdb_get_uuids(const tdb *db, const uint64_t *trail_ids, uint64_t num_ids, uint8_t *uuids);
+   uint64_t tdb_get_trail_ids(const tdb *db, const uint8_t *uuids, uint64_t num_uuids, uint64_t *trail_ids);
+
+   uint64_t tdb_cursor_batch(tdb_cursor *cursor,
+                             uint64_t max_events,
+                             uint64_t *timestamps,
+                             tdb_val *vals,
+                             uint64_t stride);
+   uint64_t tdb_iter_batch(tdb_iter *iter,
+                           uint64_t max_events,
+                           uint64_t *trail_ids,
+                           uint64_t *timestamps,
+                           tdb_val *vals);
    typedef void *(*tdb_fold_fn)(const tdb *, uint64_t, const tdb_event *, void *);
+
+   typedef struct {
+     tdb_field field;
+     uint64_t *value_events;
+     uint64_t *value_trails;
+     uint64_t *first_seen;
+     uint64_t *last_seen;
+     uint64_t *lengths;
+     uint64_t num_lengths;
+     uint64_t *times;
+     uint64_t num_times;
+     uint64_t time_start;
+     uint64_t time_width;
+     uint64_t num_trails;
+     uint64_t num_events;
+     ...;
+   } tdb_agg;
+
+   tdb_error tdb_aggregate(tdb_iter *iter, tdb_agg *agg);
+
+   typedef struct {
+     const tdb_field *fields;
+     uint64_t num_fields;
+     uint64_t id_offset;
+     int cookies;
+     int expand;
+     int raw_timestamps;
+   } tdb_tsv_opts;
+
+   uint64_t tdb_tsv_format(const tdb *db,
+                           const tdb_tsv_opts *opts,
+                           uint64_t num_events,
+                           const uint64_t *trail_ids,
+                           const uint64_t *timestamps,
+                           const tdb_val **columns,
+                           char *buf,
+                           uint64_t size,
+                           uint64_t *num_formatted);
 ''')
 
 FDB_PARAMS = 4096
 FDB_EZ_MAX = 128
+FDB_EZ_LAYERS = 64
 
 ffic.cdef('''
    typedef uint32_t fdb_eid;
@@ -145,11 +217,47 @@ ffic.cdef('''
      fdb_eid length;
    } fdb_funnel;
 
+   typedef struct {
+     double scan_time;
+     double store_time;
+     double pack_time;
+     uint64_t num_trails;
+     uint64_t num_events;
+     uint64_t num_spilled;
+     fdb_fid num_dense;
+     fdb_fid num_sparse;
+     fdb_fid num_chunked;
+     uint64_t dense_size;
+     uint64_t sparse_size;
+     uint64_t chunked_size;
+     fdb_fid num_indexed;
+     uint64_t index_size;
+     fdb_fid num_sketched;
+     uint64_t sketch_size;
+   } fdb_stats;
+
+   typedef struct {
+     unsigned int num_threads;
+     unsigned int single_pass;
+     uint64_t max_buffered;
+     fdb_stats *stats;
+     unsigned int index;
+     fdb_eid sketch_size;
+   } fdb_opts;
+
    typedef struct {
      unsigned int num_keys;
      fdb_fid key_offs[%d];
      tdb_field key_fields[%d];
      tdb_field mask_field;
+     unsigned int num_layers;
+     fdb_fid layer_size;
+     tdb_field layer_fields[%d];
+     tdb_val layer_bases[%d];
+     unsigned int num_buckets;
+     fdb_fid bucket_size;
+     uint64_t bucket_start;
+     uint64_t bucket_width;
      ...;
    } fdb_ez;
 
@@ -158,9 +266,17 @@ ffic.cdef('''
      uint64_t data_size;
      uint8_t params[%d];
      fdb_fid num_funnels;
+     uint32_t version;
      ...;
    } fdb;
 
+   typedef struct {
+     const fdb *db;
+     const uint64_t *ids;
+     const fdb_fid *funnels;
+     const uint8_t *bits;
+   } fdb_merge_src;
+
    typedef struct {
      uint64_t terms;
      uint64_t nterms;
@@ -171,10 +287,20 @@ ffic.cdef('''
      fdb_clause *clauses;
    } fdb_cnf;
 
+   typedef struct {
+     uint64_t num_visited;
+     uint64_t num_filtered;
+     uint64_t num_seeks;
+     uint64_t num_exits;
+     uint64_t num_counted;
+   } fdb_set_stats;
+
    typedef struct _fdb_set_simple {
      fdb *db;
      fdb_fid funnel_id;
      fdb_cnf *cnf;
+     fdb_fid num_rows;
+     fdb_fid stride;
    } fdb_set_simple;
 
    typedef struct _fdb_set_complex {
@@ -189,6 +315,8 @@ ffic.cdef('''
      unsigned int num_sets;
      fdb_fid funnel_id;
      fdb_cnf **cnfs;
+     fdb_fid num_rows;
+     fdb_fid stride;
    } fdb_family;
 
    struct _fdb_set {
@@ -197,23 +325,40 @@ ffic.cdef('''
        fdb_set_simple simple;
        fdb_set_complex complex;
      };
+     fdb_set_stats *stats;
    };
 
-   fdb *fdb_create(tdb *tdb, tdb_fold_fn probe, fdb_fid num_funnels, void *params);
+   fdb *fdb_create(tdb *tdb, tdb_fold_fn probe, fdb_fid num_funnels, void *params, const fdb_opts *opts);
    void fdb_detect(fdb_fid funnel_id, fdb_eid id, fdb_mask bits, fdb_cons *state);
 
-   fdb *fdb_easy(tdb *tdb, fdb_ez *params);
+   fdb *fdb_easy(tdb *tdb, fdb_ez *params, const fdb_opts *opts);
+   fdb *fdb_easy_merge(tdb *db, fdb_ez *params, fdb **fdbs, tdb **tdbs, unsigned int num_fdbs, const fdb_opts *opts);
+   fdb *fdb_merge(const fdb_merge_src *srcs,
+                  unsigned int num_srcs,
+                  fdb_fid num_funnels,
+                  uint64_t num_ids,
+                  const void *params,
+                  const fdb_opts *opts);
    fdb *fdb_dump(fdb *db, int fd);
    fdb *fdb_load(int fd);
    fdb *fdb_free(fdb *db);
+   void fdb_get_stats(const fdb *db, fdb_stats *stats);
+   const uint8_t *fdb_get_row(const fdb *db, fdb_fid funnel_id, fdb_funnel *funnel);
 
    fdb_iter *fdb_iter_new(const fdb_set *set);
    fdb_elem *fdb_iter_next(fdb_iter *iter);
+   fdb_elem *fdb_iter_seek(fdb_iter *iter, fdb_eid id);
+   fdb_eid fdb_iter_fill(fdb_iter *iter, fdb_eid max, fdb_eid *ids, fdb_mask *masks);
    fdb_iter *fdb_iter_free(fdb_iter *iter);
 
    int fdb_count_set(const fdb_set *set, fdb_eid *count);
+   int fdb_estimate_set(const fdb_set *set, double *estimate, double *error);
    int fdb_count_family(const fdb_family *family, fdb_eid *counts);
-''' % (FDB_EZ_MAX, FDB_EZ_MAX, FDB_PARAMS))
+   int fdb_count_families(const fdb_family *family,
+                          const fdb_fid *funnel_ids,
+                          fdb_fid num_funnels,
+                          fdb_eid *counts);
+''' % (FDB_EZ_MAX, FDB_EZ_MAX, FDB_EZ_LAYERS, FDB_EZ_LAYERS, FDB_PARAMS))
 
 if __name__ == '__main__':
     ffic.compile(verbose=True)
@@ -1,3 +1,3 @@
-from .traildb import TDBError, TDBCons, TDB
+from .traildb import TDBError, TDBCons, TDB, TDBSet
 from .funneldb import FDBError, FDB
-from .cnf import noneOf, oneOf, where, whereNot, Q
+from .cnf import noneOf, oneOf, where, whereNot, during, Q
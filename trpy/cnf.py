@@ -16,6 +16,9 @@ def whereNot(*args, **kwds):
     return Q([Clause([Literal(i, True)]) for i in kwds.items()] +
              [Clause([Literal(a, True)]) for a in args])
 
+def during(start=None, end=None, field='time'):
+    return where(**{field: (start, end)})
+
 class Q(object):
     def __init__(self, clauses):
         self.clauses = frozenset(c for c in clauses if c.literals)
@@ -118,5 +121,8 @@ class Literal(object):
 
     def __str__(self):
         if isinstance(self.term, tuple) and len(self.term) == 2:
-            return '%s%s%s' % (self.term[0], '!=' if self.negated else '=', self.term[1])
+            value = self.term[1]
+            if isinstance(value, tuple):
+                value = ':'.join('' if t is None else '%s' % t for t in value)
+            return '%s%s%s' % (self.term[0], '!=' if self.negated else '=', value)
         return '%s%s' % ('!' if self.negated else '', self.term)
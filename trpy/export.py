@@ -0,0 +1,111 @@
+from .__trpy__ import ffi, lib
+from .traildb import BATCH_SIZE, pointer, possible
+
+from itertools import izip
+import os
+import struct
+
+CHUNK_SIZE = 1 << 22 # bytes
+NPY_HEADER = 128 # bytes, so that headers can be rewritten in place once the number of events is known
+
+def shards(db):
+    """
+    The (shard index, TDB, id offset) of each TDB in db, which may be a TDBSet.
+    """
+    if hasattr(db, 'shards'):
+        return [(s, shard, db.offsets[s]) for s, shard in enumerate(db.shards)]
+    return [(None, db, 0)]
+
+def npy_header(descr, count):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, count)
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', NPY_HEADER - 10) + header.ljust(NPY_HEADER - 11) + '\n'
+
+def lexicon(db, fieldish):
+    """
+    The values of a field back to back, and the offset of the value of each val in them,
+    with one more for where the last ends (see tdb_lexicon_read).
+    """
+    import numpy as np
+    field = db.field(fieldish)
+    if hasattr(db, 'shards'):
+        words = db.lexicon_map(field)[0]
+        offsets = np.zeros(len(words) + 1, np.uint64)
+        np.cumsum([len(w) for w in words], out=offsets[1:])
+        data = ''.join(words)
+        return offsets, np.frombuffer(data, np.uint8) if data else np.zeros(0, np.uint8)
+    offsets = np.empty(db.lexicon_size(field) + 1, np.uint64)
+    values = np.empty(lib.tdb_lexicon_read(db._db, field, ffi.NULL, ffi.NULL), np.uint8)
+    lib.tdb_lexicon_read(db._db, field, pointer(values, 'char *'), pointer(offsets))
+    return offsets, values
+
+def tsv(db, file, query=None, fields=None, cookies=False, expand=False, raw_timestamps=False,
+        batch=BATCH_SIZE, chunk=CHUNK_SIZE):
+    """
+    Write the events matching the query to file as tab separated values, the same as trpy match:
+    the id (or cookie), time and fields (all by default) of each event, one per line.
+    Events are decoded and formatted in C a batch at a time, and written in chunks of up to chunk bytes.
+    Returns the number of events written.
+    """
+    import numpy as np
+    fields = [db.field(f) for f in fields or db.fields[1:]]
+    cfields = ffi.new('tdb_field []', fields)
+    opts = ffi.new('tdb_tsv_opts *')
+    opts.fields, opts.num_fields = cfields, len(fields)
+    opts.cookies, opts.expand, opts.raw_timestamps = cookies, expand, raw_timestamps
+    buf, used = ffi.new('char []', chunk), 0
+    done, total = ffi.new('uint64_t *'), 0
+    for s, tdb, offset in shards(db):
+        if query and not possible(tdb, query):
+            continue
+        maps = None if expand or s is None else [np.asarray(m, np.uint64) for m in db.vals(s)]
+        opts.id_offset = offset
+        for b in tdb.match(query=query, batch=batch):
+            columns = [b[1 + f] if maps is None else maps[f - 1][b[1 + f]] for f in fields]
+            ids, times, ptrs = pointer(b[0]), pointer(b[1]), [pointer(c) for c in columns]
+            at, n = 0, len(b[0])
+            while at < n:
+                size = lib.tdb_tsv_format(tdb._db, opts, n - at, ids + at, times + at,
+                                          ffi.new('tdb_val *[]', [p + at for p in ptrs]),
+                                          buf + used, len(buf) - used, done)
+                used += size
+                at += done[0]
+                if at < n and used:
+                    file.write(ffi.buffer(buf, used)[:])
+                    used = 0
+                elif at < n:
+                    buf = ffi.new('char []', 2 * len(buf))
+            total += n
+    file.write(ffi.buffer(buf, used)[:])
+    return total
+
+def npy(db, path, query=None, fields=None, batch=BATCH_SIZE):
+    """
+    Write the events matching the query to the directory path, as one NPY file per column:
+    id.npy, time.npy and FIELD.npy for each field (all by default), with the trail ids, times and vals.
+    Each field also gets a lexicon sidecar, FIELD.lexicon.npz, with its values back to back (values)
+    and where the value of each val begins (offsets, with one more for where the last ends).
+    Events are decoded in C a batch at a time, and each column written a batch at a time.
+    Returns the number of events written.
+    """
+    import numpy as np
+    fields = [db.field(f) for f in fields or db.fields[1:]]
+    names = ['id', 'time'] + [db.field_name(f) for f in fields]
+    descr = np.dtype(np.uint64).str
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    files = [open(os.path.join(path, name + '.npy'), 'wb') for name in names]
+    for file in files:
+        file.write(npy_header(descr, 0))
+    total = 0
+    for b in db.match(query=query, batch=batch):
+        for file, column in izip(files, [b[0], b[1]] + [b[1 + f] for f in fields]):
+            column.tofile(file)
+        total += len(b[0])
+    for file in files:
+        file.seek(0)
+        file.write(npy_header(descr, total))
+        file.close()
+    for f in fields:
+        offsets, values = lexicon(db, f)
+        np.savez(os.path.join(path, db.field_name(f) + '.lexicon.npz'), offsets=offsets, values=values)
+    return total
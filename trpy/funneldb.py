@@ -1,15 +1,38 @@
 from .__trpy__ import ffi, lib
-from .cnf import Q, oneOf, noneOf, where, whereNot
+from .cnf import Q, Clause, Literal, oneOf, noneOf, where, whereNot
+from .traildb import pointer, timestamp, window
 
-from itertools import product
+from array import array
+from collections import OrderedDict
+from itertools import count, product
 from urllib import quote_plus, unquote_plus
+import os
+import sys
+
+FDB_VERSION = 1
+FDB_EZ_LAYERS = 64
+FDB_EZ_BUCKETS = {'hour': 3600, 'day': 86400, 'week': 604800}
+FDB_CACHE_LIMIT = 1 << 26 # bytes
+FDB_CACHE_ENTRY = 128 # approximate bytes per cache entry, not counting ids
+FDB_FILL_SIZE = 1 << 12 # elements to gather at first, if the size of a set is unknown
 
 FDB_DENSE   = 1
 FDB_SPARSE  = 2
+FDB_CHUNKED = 4
+FDB_INDEXED = 8
+FDB_SKETCHED = 16
 
 FDB_SIMPLE  = 1
 FDB_COMPLEX = 2
 
+FDB_NO_FUNNEL = 0xFFFFFFFF
+
+_fdb_serial = count()
+
+ENDIAN = '<' if sys.byteorder == 'little' else '>'
+MASK_TYPE = ENDIAN + 'u2'
+ELEM_DESCR = [('id', ENDIAN + 'u4'), ('mask', ENDIAN + 'u2'), ('', '|V2')]
+
 def keymap(num_keys, key_fields):
     combo = []
     for i, f in enumerate(key_fields):
@@ -33,17 +56,157 @@ def seqify(x):
     except KeyError, TypeError:
         return x,
 
+def masks(tdb, mask_field, params):
+    """
+    Set the mask field of the params, or the layers of several (or one with more than 16 values).
+    """
+    fields = map(tdb.field, mask_field if isinstance(mask_field, (list, tuple)) else [mask_field])
+    layers = []
+    for field in filter(None, fields):
+        mask_arity = tdb.lexicon_size(field)
+        if mask_arity < 1:
+            raise ValueError("Mask field has no values")
+        layers += [(field, base) for base in xrange(0, mask_arity, 16)]
+    if len(layers) > FDB_EZ_LAYERS:
+        raise ValueError("Mask fields have too many values")
+    if len(layers) > 1:
+        params[0].num_layers = len(layers)
+        for l, (field, base) in enumerate(layers):
+            params[0].layer_fields[l] = field
+            params[0].layer_bases[l] = base
+    else:
+        params[0].mask_field = layers[0][0] if layers else 0
+
+def time_buckets(tdb, width, params):
+    """
+    Set the time buckets of the params, to cover the TrailDB in buckets of width seconds
+    (or an 'hour', 'day' or 'week'), aligned to multiples of the width.
+    """
+    width = int(FDB_EZ_BUCKETS.get(width, width))
+    if width < 1:
+        raise ValueError("Bucket width must be positive")
+    tmin, tmax = tdb.time_range()
+    start = tmin - tmin % width
+    params[0].bucket_start = start
+    params[0].bucket_width = width
+    params[0].num_buckets = (tmax - start) // width + 1
+
+def time_key(tdb, key):
+    """
+    Split a time range off a key string, given as 'time=START:END' (either may be empty).
+    """
+    items, time = [], None
+    for item in filter(None, key.split(',')):
+        name, value = item.split('=', 1) if '=' in item else (item, '')
+        if unquote_plus(name) == tdb.fields[0]:
+            time = window(value)
+        else:
+            items.append(item)
+    return ','.join(items), time
+
+def cdict(cdata):
+    return dict((name, getattr(cdata, name)) for name, field in ffi.typeof(cdata).fields)
+
+def grow(cdata, size, n):
+    """
+    A new C array of size elements, starting with the first n of cdata.
+    """
+    new = ffi.new(ffi.typeof(cdata), size)
+    ffi.memmove(new, cdata, n * ffi.sizeof(ffi.typeof(cdata).item))
+    return new
+
 class FDBError(Exception):
     pass
 
+class FDBView(object):
+    """
+    Read-only memory of a FunnelDB exposed to NumPy (via the array interface).
+    Arrays made from a view keep it, and so the FunnelDB, alive.
+    """
+    def __init__(self, db, data, shape, typestr, descr=None):
+        self.db = db
+        self.__array_interface__ = {'version': 3,
+                                    'data': (int(ffi.cast('uintptr_t', data)), True),
+                                    'shape': shape,
+                                    'typestr': typestr,
+                                    'descr': descr or [('', typestr)]}
+
+class FDBCache(object):
+    """
+    An LRU cache of set query results, keyed by the canonical form of each set.
+    Holds parsed queries and counts, plus the ids of each set if ids is true.
+    The cache belongs to one FDB at a time: binding it to another clears it.
+    """
+    def __init__(self, limit=FDB_CACHE_LIMIT, ids=False):
+        self.limit = limit
+        self.ids = ids
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.owner = None
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def bind(self, owner):
+        if owner != self.owner:
+            self.clear()
+            self.owner = owner
+        return self
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get(self, key):
+        try:
+            value, nbytes = self.entries.pop(key)
+        except KeyError:
+            self.stats['misses'] += 1
+            return None
+        self.entries[key] = value, nbytes
+        self.stats['hits'] += 1
+        return value
+
+    def put(self, key, value, nbytes=0):
+        nbytes += FDB_CACHE_ENTRY
+        if nbytes > self.limit:
+            return value
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = value, nbytes
+        self.nbytes += nbytes
+        while self.nbytes > self.limit:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+            self.stats['evictions'] += 1
+        return value
+
 class FDB(object):
-    def __init__(self, tdb, _db):
+    def __init__(self, tdb, _db, cache=None, owner=None, stats=False, build=None):
         self._db = _db
         self.tdb = tdb
+        self.profiled = stats
+        self.build = build
+        self.owner = owner or ('fdb', next(_fdb_serial))
+        self._cache = cache.bind(self.owner) if cache is not None else None
         self.num_funnels = _db.num_funnels
         self.params = ffi.cast('fdb_ez *', _db.params)
         self.keymap = dict(keymap(self.params[0].num_keys, self.params[0].key_fields))
-        self.masked = tdb.fields[self.params[0].mask_field]
+        self.layers = [(self.params[0].layer_fields[l], self.params[0].layer_bases[l])
+                       for l in xrange(self.params[0].num_layers)]
+        if self.params[0].num_buckets:
+            self.bucketing = (self.params[0].bucket_start,
+                              self.params[0].bucket_width,
+                              self.params[0].num_buckets)
+        else:
+            self.bucketing = None
+        self.bucket_size = self.params[0].bucket_size if self.bucketing else self.num_funnels
+        self.layer_size = self.params[0].layer_size if self.layers else self.bucket_size
+        if self.layers:
+            self.masks = list(OrderedDict((tdb.fields[f], f) for f, base in self.layers))
+        else:
+            self.masks = [tdb.fields[self.params[0].mask_field]]
+        self.masked = self.masks[0]
 
     def __del__(self):
         lib.fdb_free(self._db)
@@ -54,6 +217,42 @@ class FDB(object):
     def __getitem__(self, id):
         return self.funnel(id)
 
+    @property
+    def stats(self):
+        """
+        The layout of the rows, and how long the build took if it was built here.
+        """
+        stats = ffi.new('fdb_stats *', self.build)
+        lib.fdb_get_stats(self._db, stats)
+        stats = cdict(stats[0])
+        if self._cache is not None:
+            stats['cache'] = dict(self._cache.stats, size=len(self._cache), bytes=self._cache.nbytes)
+        return stats
+
+    @property
+    def cache(self):
+        """
+        The result cache, if any, cleared first if another FDB has used it since.
+        """
+        return self._cache.bind(self.owner) if self._cache is not None else None
+
+    def row(self, id):
+        """
+        A zero-copy NumPy view of a stored row, or a copy if the row is chunked.
+        Dense rows are arrays of uint16 masks indexed by trail id,
+        others are arrays of (id uint32, mask uint16) records, in id order.
+        """
+        import numpy as np
+        funnel = ffi.new('fdb_funnel *')
+        data = lib.fdb_get_row(self._db, id, funnel)
+        if data == ffi.NULL:
+            raise IndexError("Invalid funnel id: %s" % id)
+        if funnel.flags & FDB_DENSE:
+            return np.asarray(FDBView(self, data, (funnel.length, ), MASK_TYPE))
+        if funnel.flags & FDB_SPARSE:
+            return np.asarray(FDBView(self, data, (funnel.length, ), '|V8', ELEM_DESCR))
+        return self.funnel(id).numpy(masks=True)
+
     def funnel(self, id, cnf=None):
         if id < 0 or id >= len(self):
             raise IndexError("Invalid funnel id: %s" % id)
@@ -76,19 +275,108 @@ class FDB(object):
         return key
 
     def keys(self, serialize=False):
+        for key, id in self.items(serialize=serialize):
+            yield key
+
+    def items(self, serialize=False):
+        """
+        Generate the (key, funnel id) pairs, in the same order as keys.
+        """
         tdb = self.tdb
-        for _, key in sorted((v, k) for k, v in self.keymap.items()):
+        O, F = self.params[0].key_offs, self.params[0].key_fields
+        for index, key in sorted((v, k) for k, v in self.keymap.items()):
             names = [quote_plus(tdb.fields[f]) for f in key]
-            for which in product(*(map(quote_plus, tdb.lexicon(f)) for f in key)):
+            order = list(F[index:index + len(key)])
+            offs = [O[index + order.index(f)] for f in key]
+            base = O[index - 1] if index else 0
+            for vals in product(*(xrange(1, tdb.lexicon_size(f)) for f in key)):
+                which = [quote_plus(tdb.lexicon_word(f, v)) for f, v in zip(key, vals)]
+                id = base + sum(v * o for v, o in zip(vals, offs))
                 if serialize:
-                    yield ','.join('%s=%s' % item for item in zip(names, which))
+                    yield ','.join('%s=%s' % item for item in zip(names, which)), id
                 else:
-                    yield dict(zip(names, which))
+                    yield dict(zip(names, which)), id
 
     def mask_val(self, value):
         field = self.params[0].mask_field
         return self.tdb.lexicon_val(field, value)
 
+    def mask_bit(self, term):
+        """
+        The (layer, bit) of a mask term: a value of the first mask field, 'field=value' or (field, value).
+        """
+        if not self.layers:
+            return 0, self.mask_val(term)
+        if isinstance(term, tuple):
+            name, value = term
+        else:
+            name, value = term.split('=', 1) if '=' in term else (None, term)
+            if name not in self.masks:
+                name, value = self.masked, term
+        field = self.tdb.field(name)
+        val = self.tdb.lexicon_val(field, value)
+        for layer, (f, base) in enumerate(self.layers):
+            if f == field and base <= val < base + 16:
+                return layer, val - base
+        raise KeyError("Not a mask field: '%s'" % name)
+
+    def mask_layer(self, q):
+        """
+        The layer which can answer the mask query alone, or None if it needs several.
+        """
+        if not self.layers:
+            return 0
+        literals = [l for c in q.clauses for l in c.literals]
+        layers = set(self.mask_bit(l.term)[0] for l in literals)
+        if not layers:
+            layers = set(self.sublayers(self.layers[0][0]))
+        if len(layers) != 1:
+            return None
+        layer = layers.pop()
+        if any(l.negated for l in literals) and len(self.sublayers(self.layers[layer][0])) > 1:
+            return None
+        return layer
+
+    def sublayers(self, field):
+        return [l for l, (f, base) in enumerate(self.layers) if f == field]
+
+    def mask_cnf(self, q):
+        return FDBCNF(q, lambda t: self.mask_bit(t)[1])
+
+    def mask_set(self, funnel_id, q, time=None):
+        """
+        The set of a row (by its funnel id in the first layer) filtered by a mask query, over a time range.
+        """
+        first, num = self.buckets(time)
+        if not num:
+            return FDBComplexSet(self, [], None)
+        funnel_id += first * self.bucket_size
+        layer = self.mask_layer(q)
+        if layer is not None:
+            return FDBSimpleSet(self, layer * self.layer_size + funnel_id, self.mask_cnf(q), num)
+        bits = sorted(set(self.mask_bit(l.term) for c in q.clauses for l in c.literals))
+        index = dict((b, n + 1) for n, b in enumerate(bits))
+        field = self.layers[0][0]
+        rows = [FDBSimpleSet(self, l * self.layer_size + funnel_id, None, num) for l in self.sublayers(field)]
+        sets = [rows[0] if len(rows) == 1 else self.any(*rows)]
+        sets += [FDBSimpleSet(self, l * self.layer_size + funnel_id, FDBCNF(where(b)), num) for l, b in bits]
+        return FDBComplexSet(self, sets, FDBCNF(q & where(None),
+                                                lambda t: index[self.mask_bit(t)] if t is not None else 0))
+
+    def buckets(self, time=None):
+        """
+        The first and number of whole buckets covering a [start, end) time range, either end open if None.
+        """
+        if not self.bucketing:
+            if time is not None:
+                raise FDBError("FunnelDB has no time buckets")
+            return 0, 1
+        start, width, num = self.bucketing
+        lo, hi = time or (None, None)
+        first = max(0, (timestamp(lo) - start) // width) if lo is not None else 0
+        last = min(num, -((start - timestamp(hi)) // width)) if hi is not None else num
+        return first, max(0, last - first)
+
     def any(self, *sets):
         """
         Create a disjunction which avoids the 64 term limitation for a CNF.
@@ -109,46 +397,109 @@ class FDB(object):
         """
         Select a single row (funnel) that can be used to build up complex sets.
         """
-        cnf = FDBCNF(kwds.pop(self.masked, Q([])), self.mask_val)
-        return self.funnel(self.funnel_id(kwds), cnf)
+        time = kwds.pop(self.tdb.fields[0], None)
+        q = kwds.pop(self.masked, Q([]))
+        for name in self.masks[1:]:
+            if name in kwds:
+                q &= Q([Clause([Literal((name, l.term), l.negated) for l in c.literals])
+                        for c in kwds.pop(name).clauses])
+        funnel_id = self.funnel_id(kwds)
+        if funnel_id < 0 or funnel_id >= self.layer_size:
+            raise IndexError("Invalid funnel id: %s" % funnel_id)
+        return self.mask_set(funnel_id, q, time)
 
     def query(self, query):
         """
         Create a complex set from a query string.
         """
-        return FDBSet.parse(self, query)
-
-    def family(self, queries):
+        cache = self.cache
+        if cache is None:
+            return FDBSet.parse(self, query)
+        set = cache.get(('query', query))
+        if set is None:
+            set = cache.put(('query', query), FDBSet.parse(self, query), len(query))
+        return set
+
+    def family(self, queries, time=None):
         """
-        Create a family from a list of mask query strings.
+        Create a family from a list of mask query strings, counting events in a time range if given.
         """
-        return FDBFamily.parse(self, queries)
+        return FDBFamily.parse(self, queries, time)
 
     @classmethod
-    def make(cls, tdb, keys=((),), mask_field=1):
-        if mask_field:
-            mask_arity = tdb.lexicon_size(mask_field)
-            if mask_arity < 1:
-                raise ValueError("Mask field has no values")
-            if mask_arity > 16:
-                raise ValueError("Mask field cardinality is too high")
+    def make(cls, tdb, keys=((),), mask_field=1, threads=1, single_pass=False, max_buffered=0,
+             buckets=None, index=False, sketch=0, cache=None, stats=False):
+        """
+        Build a FunnelDB with a row for every value of each group of key fields (see fdb_ez and fdb_opts).
+        """
         params = ffi.new('fdb_ez []', 1)
         params[0].num_keys = len(keys)
-        params[0].mask_field = mask_field or 0
+        masks(tdb, mask_field, params)
+        if buckets:
+            time_buckets(tdb, buckets, params)
         i = 0
         for group in keys:
             for k in seqify(group):
                 params[0].key_fields[i] = tdb.field(k)
                 i += 1
             i += 1
-        return cls(tdb, lib.fdb_easy(tdb._db, params))
+        opts = ffi.new('fdb_opts []', 1)
+        opts[0].num_threads = threads
+        opts[0].single_pass = single_pass
+        opts[0].max_buffered = max_buffered
+        opts[0].index = index
+        opts[0].sketch_size = sketch
+        opts[0].stats = build = ffi.new('fdb_stats *')
+        db = lib.fdb_easy(tdb._db, params, opts)
+        if not db:
+            raise FDBError("Could not build FunnelDB")
+        return cls(tdb, db, cache, stats=stats, build=cdict(build[0]))
 
     @classmethod
-    def load(cls, tdb, file):
+    def merge(cls, tdb, fdbs, index=False, sketch=0, cache=None, stats=False):
+        """
+        Merge FunnelDBs made from other TrailDBs (such as the history and a delta),
+        into one for tdb, which should hold the trails of them all, without scanning it.
+        Trails are matched up by cookie, and rows and mask bits by the values of their fields,
+        then each row is stored in its smallest form again.
+        Time buckets must have the same width, and are extended to cover tdb.
+        With index and sketch, rows are indexed and sketched again (see make).
+        """
+        if not fdbs:
+            raise FDBError("No FunnelDBs to merge")
+        first = fdbs[0].params[0]
+        params = ffi.new('fdb_ez []', 1)
+        params[0].num_keys = first.num_keys
+        ffi.memmove(params[0].key_fields, first.key_fields, ffi.sizeof(first.key_fields))
+        masks(tdb, list(OrderedDict((f, f) for f, base in fdbs[0].layers)) or first.mask_field, params)
+        if first.num_buckets:
+            time_buckets(tdb, first.bucket_width, params)
+        for fdb in fdbs:
+            if fdb.tdb.fields != tdb.fields:
+                raise FDBError("FunnelDB was made from a TrailDB with different fields")
+            if fdb.masks != fdbs[0].masks:
+                raise FDBError("FunnelDB was made with different mask fields")
+            if fdb.params[0].num_keys != first.num_keys or fdb.keymap != fdbs[0].keymap:
+                raise FDBError("FunnelDB was made with different keys")
+        opts = ffi.new('fdb_opts []', 1)
+        opts[0].index = index
+        opts[0].sketch_size = sketch
+        opts[0].stats = build = ffi.new('fdb_stats *')
+        db = lib.fdb_easy_merge(tdb._db, params,
+                                ffi.new('fdb *[]', [fdb._db for fdb in fdbs]),
+                                ffi.new('tdb *[]', [fdb.tdb._db for fdb in fdbs]),
+                                len(fdbs), opts)
+        if not db:
+            raise FDBError("Could not merge FunnelDBs")
+        return cls(tdb, db, cache, stats=stats, build=cdict(build[0]))
+
+    @classmethod
+    def load(cls, tdb, file, cache=None, stats=False):
         db = lib.fdb_load(file.fileno())
         if not db:
-            raise FDBError("Could not open %s" % path)
-        return cls(tdb, db)
+            raise FDBError("Could not open %s" % getattr(file, 'name', file))
+        st = os.fstat(file.fileno())
+        return cls(tdb, db, cache, ('file', st.st_dev, st.st_ino, st.st_size, st.st_mtime), stats=stats)
 
     def dump(self, file):
         lib.fdb_dump(self._db, file.fileno())
@@ -170,6 +521,15 @@ class FDBIter(object):
             raise StopIteration()
         return n.id, n.mask
 
+    def seek(self, id):
+        """
+        Skip ahead to the next element with an id of at least id.
+        """
+        n = lib.fdb_iter_seek(self._iter, id)
+        if not n:
+            raise StopIteration()
+        return n.id, n.mask
+
 class FDBCNF(object):
     def __init__(self, q, mapping=lambda t: t):
         self._cnf = ffi.new('fdb_cnf []', 1)
@@ -184,6 +544,7 @@ class FDBCNF(object):
                     self._clauses[n].nterms |= 1 << index
                 else:
                     self._clauses[n].terms |= 1 << index
+        self.key = tuple(sorted(set((c.terms, c.nterms) for c in self._clauses)))
 
 class FDBSet(object):
     def __and__(self, other):
@@ -207,11 +568,118 @@ class FDBSet(object):
     def __iter__(self):
         return FDBIter(self)
 
+    def profile(self):
+        self._stats = ffi.new('fdb_set_stats *') if self.db.profiled else None
+        self._set[0].stats = self._stats if self._stats is not None else ffi.NULL
+
+    @property
+    def stats(self):
+        """
+        The work done by iterators over the set (and its terms), if the FDB has stats.
+        """
+        if self._stats is None:
+            return None
+        stats = cdict(self._stats[0])
+        if isinstance(self, FDBComplexSet):
+            stats['terms'] = [s.stats for s in self.sets]
+        return stats
+
     def __len__(self):
+        cache = self.db.cache
+        if cache is not None:
+            count = cache.get(('len', self.key))
+            if count is not None:
+                return count
         count = ffi.new('fdb_eid []', 1)
         lib.fdb_count_set(self._set, count)
+        if cache is not None:
+            cache.put(('len', self.key), count[0])
         return count[0]
 
+    def estimate(self):
+        """
+        Estimate the size of the set from the sketches of its rows, without iterating over it.
+        Returns the estimate and its standard error, which is 0 if no sketched rows are involved.
+        """
+        cache = self.db.cache
+        if cache is not None:
+            estimate = cache.get(('estimate', self.key))
+            if estimate is not None:
+                return estimate
+        estimate, error = ffi.new('double []', 1), ffi.new('double []', 1)
+        if lib.fdb_estimate_set(self._set, estimate, error):
+            raise MemoryError("Could not sample set")
+        if cache is not None:
+            cache.put(('estimate', self.key), (estimate[0], error[0]))
+        return estimate[0], error[0]
+
+    def ids(self):
+        """
+        The ids in the set, as an array, kept in the cache if it holds ids.
+        """
+        cache = self.db.cache
+        if cache is not None and cache.ids:
+            ids = cache.get(('ids', self.key))
+            if ids is None:
+                ids = self.fill_array()
+                cache.put(('ids', self.key), ids, len(ids) * ids.itemsize)
+                cache.put(('len', self.key), len(ids))
+            return ids
+        return self.fill_array()
+
+    def fill(self, size, ids, masks=ffi.NULL):
+        """
+        Copy up to size ids (and masks) of the set into C arrays, returning how many were copied.
+        """
+        it = FDBIter(self)
+        return lib.fdb_iter_fill(it._iter, size, ids, masks)
+
+    def bound(self):
+        """
+        An upper bound on the size of the set, known without iterating over it, or None.
+        """
+        cache = self.db.cache
+        return cache.get(('len', self.key)) if cache is not None else None
+
+    def gather(self, masks=False):
+        """
+        Copy all the ids (and masks) of the set into C arrays, in a single pass over it.
+        The arrays start at the bound of the set (if any), and grow while it has more.
+        Returns the arrays and the number of elements copied.
+        """
+        it, n = FDBIter(self), 0
+        bound = self.bound()
+        size = FDB_FILL_SIZE if bound is None else bound
+        ids = ffi.new('fdb_eid []', size or 1)
+        bits = ffi.new('fdb_mask []', size or 1) if masks else None
+        while True:
+            n += lib.fdb_iter_fill(it._iter, size - n, ids + n, bits + n if masks else ffi.NULL)
+            if n < size or bound is not None:
+                return ids, bits, n
+            size *= 2
+            ids = grow(ids, size, n)
+            bits = grow(bits, size, n) if masks else None
+
+    def fill_array(self):
+        ids, bits, n = self.gather()
+        out = array('I')
+        out.fromstring(ffi.buffer(ids, n * ffi.sizeof('fdb_eid'))[:])
+        return out
+
+    def numpy(self, masks=False):
+        """
+        Copy the ids of the set into a NumPy array, in a single pass over it (see gather).
+        With masks, return an array of (id, mask) records instead, like a sparse row.
+        """
+        import numpy as np
+        ids, bits, n = self.gather(masks)
+        ids = np.frombuffer(ffi.buffer(ids, n * ffi.sizeof('fdb_eid')), np.uint32)
+        if not masks:
+            return ids.copy()
+        out = np.zeros(n, np.dtype(ELEM_DESCR))
+        out['id'], out['mask'] = ids, np.frombuffer(ffi.buffer(bits, n * ffi.sizeof('fdb_mask')), np.uint16)
+        return out
+
     def trails(self, **kwds):
         for id, mask in self:
             yield id, self.db.tdb.trail(id, **kwds)
@@ -221,21 +689,45 @@ class FDBSet(object):
         return FDBComplexSet.parse(db, string)
 
 class FDBSimpleSet(FDBSet):
-    def __init__(self, db, funnel_id, cnf=None):
+    def __init__(self, db, funnel_id, cnf=None, rows=1):
         self._set = ffi.new('fdb_set []', 1)
         self._set[0].flags = FDB_SIMPLE
         self._set[0].simple.db = db._db
         self._set[0].simple.funnel_id = funnel_id
         self._set[0].simple.cnf = cnf._cnf if cnf else ffi.NULL
+        self._set[0].simple.num_rows = rows
+        self._set[0].simple.stride = db.bucket_size
         self.db = db
         self.funnel_id = funnel_id
         self.cnf = cnf
+        self.rows = rows
+        self.key = funnel_id, rows, cnf.key if cnf else None
+        self.profile()
+
+    def bound(self):
+        bound = FDBSet.bound(self)
+        if bound is None:
+            funnel, bound = ffi.new('fdb_funnel *'), 0
+            for r in xrange(self.rows):
+                if lib.fdb_get_row(self.db._db, self.funnel_id + r * self.db.bucket_size, funnel):
+                    bound += funnel.length
+        return bound
+
+    def view(self):
+        """
+        A zero-copy view of the row if the set is unfiltered (see FDB.row),
+        otherwise (or for a union of rows) a copy of the (id, mask) records of the set.
+        """
+        if self.rows == 1 and (self.cnf is None or not self.cnf.key):
+            return self.db.row(self.funnel_id)
+        return self.numpy(masks=True)
 
     @classmethod
     def parse(cls, db, string):
         try:
             key, mask = string.split('/') if '/' in string else (string, '')
-            return cls(db, db.funnel_id(key), FDBCNF(Q.parse(mask, ext=True), db.mask_val))
+            key, time = time_key(db.tdb, key)
+            return db.mask_set(db.funnel_id(key), Q.parse(mask, ext=True), time)
         except KeyError:
             return FDBComplexSet(db, [], None)
 
@@ -250,6 +742,8 @@ class FDBComplexSet(FDBSet):
         self.db = db
         self.sets = sets
         self.cnf = cnf
+        self.key = tuple(s.key for s in sets), cnf.key if cnf else None
+        self.profile()
 
     @classmethod
     def parse(cls, db, string):
@@ -258,23 +752,109 @@ class FDBComplexSet(FDBSet):
                            r'FDBSimpleSet.parse(db, """\1""".strip())', string))
 
 class FDBFamily(object):
-    def __init__(self, db, cnfs):
+    def __init__(self, db, cnfs, layer=0, time=None):
+        first, rows = db.buckets(time)
         self._family = ffi.new('fdb_family []', 1)
         self._family[0].db = db._db
         self._family[0].num_sets = len(cnfs)
         self._family[0].cnfs = self._cnfs = ffi.new('fdb_cnf *[]', [c._cnf for c in cnfs])
+        self._family[0].num_rows = rows
+        self._family[0].stride = db.bucket_size
         self._counts = ffi.new('fdb_eid []', len(cnfs))
         self.db = db
         self.cnfs = cnfs
+        self.rows = rows
+        self.offset = first * db.bucket_size + layer * db.layer_size
 
     def counts(self, key):
+        if not self.rows:
+            return (0, ) * len(self.cnfs)
         try:
-            self._family[0].funnel_id = self.db.funnel_id(key)
+            self._family[0].funnel_id = self.db.funnel_id(key) + self.offset
             lib.fdb_count_family(self._family, self._counts)
             return tuple(self._counts)
         except KeyError:
             return (0, ) * len(self.cnfs)
 
+    def counts_all(self, keys=None):
+        """
+        Count the family on many rows in one call, given by keys (or funnel ids).
+        If no keys are given, count every row in the DB.
+        Returns a 2-D NumPy array with a row of counts per key.
+        """
+        import numpy as np
+        if keys is None:
+            self._family[0].funnel_id = self.offset
+            ids, num = ffi.NULL, self.db.layer_size
+        else:
+            ids = ffi.new('fdb_fid []', [self.funnel_id(key) for key in keys])
+            num = len(ids)
+        counts = np.zeros((num, len(self.cnfs)), np.uint32)
+        if self.rows:
+            lib.fdb_count_families(self._family, ids, num, pointer(counts, 'fdb_eid *'))
+        return counts
+
+    def funnel_id(self, key):
+        try:
+            return self.db.funnel_id(key) + self.offset
+        except KeyError:
+            return FDB_NO_FUNNEL
+
     @classmethod
-    def parse(cls, db, strings):
-        return cls(db, [FDBCNF(Q.parse(s, ext=True), db.mask_val) for s in strings])
\ No newline at end of file
+    def parse(cls, db, strings, time=None):
+        if db.layers:
+            return FDBLayeredFamily(db, [Q.parse(s, ext=True) for s in strings], time)
+        return cls(db, [FDBCNF(Q.parse(s, ext=True), db.mask_val) for s in strings], time=time)
+
+class FDBLayeredFamily(object):
+    """
+    A family over a FunnelDB with several mask layers.
+    Queries answered by a single layer are counted together as a family on that layer,
+    the others are counted as sets, one row at a time.
+    """
+    def __init__(self, db, queries, time=None):
+        groups = OrderedDict()
+        self.db = db
+        self.queries = queries
+        self.time = time
+        self.spanning = []
+        for n, q in enumerate(queries):
+            layer = db.mask_layer(q)
+            if layer is None:
+                self.spanning.append((n, q))
+            else:
+                groups.setdefault(layer, []).append((n, q))
+        self.families = [([n for n, q in group], FDBFamily(db, [db.mask_cnf(q) for n, q in group], layer, time))
+                         for layer, group in groups.items()]
+
+    def counts(self, key):
+        try:
+            funnel_id = self.db.funnel_id(key)
+        except KeyError:
+            return (0, ) * len(self.queries)
+        counts = [0] * len(self.queries)
+        for ns, family in self.families:
+            for n, count in zip(ns, family.counts(funnel_id)):
+                counts[n] = count
+        for n, q in self.spanning:
+            counts[n] = len(self.db.mask_set(funnel_id, q, self.time))
+        return tuple(counts)
+
+    def counts_all(self, keys=None):
+        """
+        Count the family on many rows, like FDBFamily.counts_all.
+        """
+        import numpy as np
+        keys = xrange(self.db.layer_size) if keys is None else list(keys)
+        counts = np.zeros((len(keys), len(self.queries)), np.uint32)
+        for ns, family in self.families:
+            counts[:, ns] = family.counts_all(keys)
+        if self.spanning:
+            for k, key in enumerate(keys):
+                try:
+                    funnel_id = self.db.funnel_id(key)
+                except KeyError:
+                    continue
+                for n, q in self.spanning:
+                    counts[k, n] = len(self.db.mask_set(funnel_id, q, self.time))
+        return counts
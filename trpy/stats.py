@@ -0,0 +1,14 @@
+import sys
+
+def pstats(stats, prefix=''):
+    """
+    Write the counters of a stats dict to stderr, one per line, named by their path through nested dicts and lists.
+    """
+    for key, value in sorted(stats.items()):
+        if isinstance(value, dict):
+            pstats(value, prefix + key + '.')
+        elif isinstance(value, list):
+            for n, item in enumerate(value):
+                pstats(item, '%s%s.%d.' % (prefix, key, n))
+        else:
+            sys.stderr.write('%-30s %12s\n' % (prefix + key, value))
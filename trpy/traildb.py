@@ -1,9 +1,18 @@
 from .__trpy__ import ffi, lib
 
-from collections import namedtuple
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
 from datetime import datetime
+from heapq import merge
+from itertools import islice, izip
+from multiprocessing import Pool, cpu_count
 from time import mktime
 
+BATCH_SIZE = 65536
+LEXICON_LIMIT = 1 << 24 # bytes
+COOKIE_LIMIT = 1 << 16 # entries
+NEVER = 18446744073709551615L # UINT64_MAX
+
 def item_is32(item): return not (item & 128)
 def item_field32(item): return item & 127
 def item_val32(item): return (item >> 8) & 4294967295L # UINT32_MAX
@@ -30,9 +39,75 @@ def raw_cookie(cookie):
         return ffi.cast('uint8_t *', ffi.from_buffer(cookie.decode('hex')))
     return cookie
 
-def events(cursor, evify):
+def timestamp(time):
+    if isinstance(time, datetime):
+        return int(mktime(time.timetuple()))
+    return time
+
+def window(value):
+    """
+    The [start, end) of a time range, given as 'START:END' or (start, end), either may be empty or None.
+    """
+    if isinstance(value, basestring):
+        value = value.split(':', 1) if ':' in value else (value, '')
+    start, end = [None if t in ('', None) else int(timestamp(t)) for t in value]
+    return start or 0, NEVER if end is None else end
+
+def pointer(array, ctype='uint64_t *'):
+    return ffi.cast(ctype, array.ctypes.data)
+
+def remember(cache, key, value, limit):
+    cache[key] = value
+    if len(cache) > limit:
+        cache.popitem(last=False)
+    return value
+
+def ranges(num_trails, num_shards):
+    return [(i * num_trails // num_shards, (i + 1) * num_trails // num_shards)
+            for i in xrange(num_shards)]
+
+def shard(job):
+    path, fun, query, start, stop, kwds = job
+    return fun(TDB(path).match(query=query, start=start, stop=stop, **kwds))
+
+def indexed(job):
+    n, job = job
+    return n, shard(job)
+
+def trails(iter):
+    return [(id, map(tuple, trail)) for id, trail in iter]
+
+def combine(key, a, b):
+    if a is None or b is None:
+        return b if a is None else a
+    if key == 'first_seen':
+        return min(a, b)
+    if key == 'last_seen':
+        return max(a, b)
+    return a + b
+
+def possible(db, query):
+    """
+    Whether the query could match any event in db: no clause may need only values it lacks,
+    or times outside of its time range.
+    """
+    tmin, tmax = db.time_range()
+    def lacks(literal):
+        field, value = db.field(literal.term[0]), literal.term[1]
+        if literal.negated:
+            return False
+        if field == 0:
+            start, end = window(value)
+            return start > tmax or end <= tmin
+        return not lib.tdb_get_item(db._db, field, value, len(value))
+    for clause in query.clauses:
+        if all(lacks(l) for l in clause.literals):
+            return False
+    return True
+
+def events(cursor, evify, next=lib.tdb_cursor_next):
     while True:
-        ev = lib.tdb_cursor_next(cursor)
+        ev = next(cursor)
         if not ev:
             break
         yield evify(ev.timestamp, (ev.items[i] for i in xrange(ev.num_items)))
@@ -58,21 +133,72 @@ class TDBCons(object):
 
         self.path = path
         self.ofields = ofields
+        self._buffers = {}
 
     def __del__(self):
         if hasattr(self, '_cons'):
             lib.tdb_cons_close(self._cons)
 
-    def add(self, cookie, timestamp, values=()):
-        if isinstance(timestamp, datetime):
-            timestamp = int(mktime(timestamp.timetuple()))
+    def add(self, cookie, time, values=()):
         a = [ffi.new('char []', v) for v in values]
         b = ffi.new('char *[]', a)
         l = ffi.new('uint64_t []', [len(v) for v in values])
-        f = lib.tdb_cons_add(self._cons, raw_cookie(cookie), timestamp, b, l)
+        f = lib.tdb_cons_add(self._cons, raw_cookie(cookie), timestamp(time), b, l)
         if f:
             raise TDBError("Too many values: %s" % values[f])
 
+    def add_many(self, cookies, times, columns=()):
+        """
+        Add events given as parallel sequences of cookies, timestamps, and values (one per field).
+        """
+        self.add_packed(cookies, times, [v for vs in izip(*columns) for v in vs] if columns else [])
+
+    def add_rows(self, rows, batch=BATCH_SIZE):
+        """
+        Add an iterable of (cookie, timestamp, values) rows, batch rows at a time.
+        """
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, batch))
+            if not chunk:
+                break
+            cookies, times, values = zip(*chunk)
+            self.add_packed(cookies, times, [v for vs in values for v in vs])
+
+    def add_packed(self, cookies, times, values):
+        """
+        Add events whose values are flattened into a single sequence (one per field per event).
+        The buffers passed to C are reused between calls, and only grow.
+        """
+        n, m = len(cookies), len(self.ofields)
+        if len(values) != n * m:
+            raise TDBError("Wrong number of values: %d (expected %d)" % (len(values), n * m))
+        uuids = ''.join(cookie if isinstance(cookie, basestring) else hex_cookie(cookie)
+                        for cookie in cookies).decode('hex')
+        data = ''.join(values)
+        stamps = self._buffer('stamps', 'uint64_t', n)
+        stamps[0:n] = [timestamp(t) for t in times]
+        lengths = self._buffer('lengths', 'uint64_t', n * m)
+        lengths[0:n * m] = [len(v) for v in values]
+        added = self._buffer('added', 'uint64_t', 1)
+        e = lib.tdb_cons_add_many(self._cons, n, m, ffi.from_buffer(uuids), stamps,
+                                  ffi.from_buffer(data), lengths, added)
+        if e:
+            raise TDBError("Failed to add event %d" % added[0], e)
+
+    def load(self, file, batch=BATCH_SIZE, **fmtparams):
+        """
+        Stream rows of cookie, timestamp, values from a CSV file (see csv.reader for fmtparams).
+        """
+        import csv
+        self.add_rows(((r[0], int(r[1]), r[2:]) for r in csv.reader(file, **fmtparams)), batch=batch)
+
+    def _buffer(self, name, ctype, size):
+        buf = self._buffers.get(name)
+        if buf is None or len(buf) < size:
+            buf = self._buffers[name] = ffi.new('%s []' % ctype, max(size, 2 * len(buf) if buf is not None else 1))
+        return buf
+
     def append(self, db):
         f = lib.tdb_cons_append(self._cons, db._db)
         if f < 0:
@@ -87,19 +213,27 @@ class TDBCons(object):
         return TDB(self.path)
 
 class TDB(object):
-    def __init__(self, path):
+    def __init__(self, path, lexicon_limit=LEXICON_LIMIT, stats=False):
         d = self._db = lib.tdb_init()
         e = lib.tdb_open(d, path)
         if e:
             raise TDBError("Could not open %s" % path, e)
 
+        self.path = path
         self.num_trails = lib.tdb_num_trails(d)
         self.num_events = lib.tdb_num_events(d)
         self.num_fields = lib.tdb_num_fields(d)
         self.fields = [ffi.string(lib.tdb_get_field_name(d, i)) for i in xrange(self.num_fields)]
 
         self._evcls = namedtuple('event', self.fields, rename=True)
+        self._bacls = namedtuple('batch', ['id'] + self.fields, rename=True)
         self._ui64p = ffi.new('uint64_t []', 1)
+        self._lexicons = {}
+        self._cookies = OrderedDict()
+        self._trail_ids = OrderedDict()
+        self.lexicon_limit = lexicon_limit
+        self.cookie_limit = COOKIE_LIMIT
+        self.stats = {'trails': 0, 'matched': 0, 'events': 0} if stats else None
 
     def __del__(self):
         if hasattr(self, '_db'):
@@ -123,17 +257,142 @@ class TDB(object):
     def __len__(self):
         return self.num_trails
 
-    def evifier(self, expand=False):
+    def evifier(self, expand=False, vals=None):
+        """
+        Make a function to decode events, with values expanded to strings,
+        or with vals translated through a list per field (see TDBSet), if given.
+        """
         if expand:
-            return lambda t, items: self._evcls(t, *(self.item_value(i) for i in items))
+            lexicons = [self.lexicon_cache(f) for f in xrange(1, self.num_fields)]
+            evify = lambda t, items: self._evcls(t, *(l[item_val(i)] for l, i in izip(lexicons, items)))
+        elif vals:
+            evify = lambda t, items: self._evcls(t, *(m[item_val(i)] for m, i in izip(vals, items)))
         else:
-            return lambda t, items: self._evcls(t, *(item_val(i) for i in items))
-
-    def match(self, query=None, **kwds):
+            evify = lambda t, items: self._evcls(t, *(item_val(i) for i in items))
+        if self.stats is not None:
+            return self.counter(evify)
+        return evify
+
+    def counter(self, evify):
+        """
+        Wrap evify to count the events decoded in stats.
+        """
+        stats = self.stats
+        def counted(t, items):
+            stats['events'] += 1
+            return evify(t, items)
+        return counted
+
+    def batchifier(self):
+        return lambda ids, times, vals: self._bacls(ids, times, *vals)
+
+    def match(self, query=None, batch=None, processes=None, **kwds):
+        """
+        Iterate over (id, events) for each trail matching the query.
+        If batch is given, iterate over columnar batches of up to that many events instead.
+        If processes is given, scan shards of the trails in that many worker processes.
+        If lazy, each trail is an iterator over its events, valid until the next trail.
+        """
+        if processes:
+            return self.pmatch(query=query, processes=processes, **kwds)
+        if batch:
+            return TDBIter(self, query=query, **kwds).batches(batch)
         return TDBIter(self, query=query, **kwds)
 
-    def trail(self, id, **kwds):
-        return TDBCursor(self, **kwds).at(id).events()
+    def pmatch(self, query=None, processes=None, shards=None, ordered=True, **kwds):
+        """
+        Like match, but each shard of the trails is scanned by a worker process.
+        Unless ordered, trails are yielded in whichever order the shards finish.
+        """
+        evmake = self._evcls._make
+        for found in self.map(trails, query=query, processes=processes,
+                              shards=shards or 16 * (processes or cpu_count()),
+                              ordered=ordered, **kwds):
+            for id, trail in found:
+                yield id, [evmake(e) for e in trail]
+
+    def map(self, fun, query=None, processes=None, shards=None, ordered=True, **kwds):
+        """
+        Call fun on a TDBIter over each contiguous shard of trail ids, in worker processes.
+        Each worker opens the TDB itself, fun and its results must be picklable.
+        Results are yielded per shard, in shard order unless ordered is false.
+        """
+        pool = Pool(processes)
+        jobs = [(self.path, fun, query, start, stop, kwds)
+                for start, stop in ranges(self.num_trails, shards or processes or cpu_count())]
+        try:
+            for result in (pool.imap if ordered else pool.imap_unordered)(shard, jobs):
+                yield result
+        finally:
+            pool.terminate()
+
+    def mapreduce(self, mapper, reducer, query=None, **kwds):
+        """
+        Reduce the results of map, the reducer should not care about the order of shards.
+        """
+        return reduce(reducer, self.map(mapper, query=query, ordered=False, **kwds))
+
+    def aggregate(self, field=None, query=None, values=False, trails=False, seen=False, lengths=0, times=None):
+        """
+        Aggregate the events matching the query in C, in a single pass without decoding them.
+        Always counts the trails with any matching events (num_trails) and the events (num_events).
+        Per val of the field, as lists indexed by val, if requested:
+         the number of events (values), the number of distinct trails (trails),
+         and the first and last times seen (first_seen and last_seen, None if never seen).
+        The number of trails of each length, up to lengths (the last counting longer ones too).
+        The number of events in each bucket, given times as (start, width, number of buckets).
+        """
+        if field is None and (values or trails or seen):
+            raise TDBError("Aggregating values, trails or seen needs a field")
+        iter = TDBIter(self, query=query)
+        agg = ffi.new('tdb_agg *')
+        arrays = {}
+        def array(key, name, size):
+            arrays[key] = ffi.new('uint64_t []', size)
+            setattr(agg, name, arrays[key])
+        if field is not None:
+            agg.field = self.field(field)
+            size = self.lexicon_size(field)
+            if values:
+                array('values', 'value_events', size)
+            if trails:
+                array('trails', 'value_trails', size)
+            if seen:
+                array('first_seen', 'first_seen', size)
+                array('last_seen', 'last_seen', size)
+        if lengths:
+            array('lengths', 'lengths', lengths)
+            agg.num_lengths = lengths
+        if times:
+            agg.time_start, agg.time_width, agg.num_times = times
+            array('times', 'times', agg.num_times)
+        e = lib.tdb_aggregate(iter._iter, agg)
+        if e:
+            raise TDBError("Failed to aggregate", e)
+        result = dict((key, list(a)) for key, a in arrays.items())
+        result.update(num_trails=agg.num_trails, num_events=agg.num_events)
+        if seen:
+            first, last = result['first_seen'], result['last_seen']
+            result['first_seen'] = [None if t == NEVER else t for t in first]
+            result['last_seen'] = [None if t == NEVER else u for t, u in izip(first, last)]
+        if self.stats is not None:
+            iter.tally(agg.num_trails)
+            self.stats['events'] += agg.num_events
+        return result
+
+    def trail(self, id, batch=None, lazy=False, **kwds):
+        """
+        Get the events of a trail, by id or cookie.
+        If lazy, return an iterator which decodes the events as they are consumed.
+        """
+        if isinstance(id, basestring):
+            id = self.cookie_id(id)
+        cursor = TDBCursor(self, **kwds).at(id)
+        if batch:
+            return cursor.batches(batch)
+        if lazy:
+            return iter(cursor)
+        return cursor.events()
 
     def field(self, fieldish):
         if isinstance(fieldish, basestring):
@@ -152,8 +411,13 @@ class TDB(object):
             raise IndexError("No such field: '%s'" % fieldish)
 
     def lexicon(self, fieldish):
+        return self.lexicon_cache(fieldish).words()
+
+    def lexicon_cache(self, fieldish):
         field = self.field(fieldish)
-        return [self.lexicon_word(field, i) for i in xrange(1, self.lexicon_size(field))]
+        if field not in self._lexicons:
+            self._lexicons[field] = TDBLexicon(self, field, limit=self.lexicon_limit)
+        return self._lexicons[field]
 
     def lexicon_size(self, fieldish):
         field = self.field(fieldish)
@@ -161,11 +425,7 @@ class TDB(object):
         return value
 
     def lexicon_word(self, fieldish, val):
-        field = self.field(fieldish)
-        value = lib.tdb_get_value(self._db, field, val, self._ui64p)
-        if value is None:
-            raise IndexError("Field '%s' has no such value: '%s'", (self.field_name(fieldish), val))
-        return ffi.string(value, self._ui64p[0])
+        return self.lexicon_cache(fieldish)[val]
 
     def lexicon_val(self, fieldish, value):
         return item_val(self.item(fieldish, value))
@@ -178,32 +438,394 @@ class TDB(object):
         return item
 
     def item_value(self, item):
-        value = lib.tdb_get_item_value(self._db, item, self._ui64p)
-        if value is None:
+        try:
+            return self.lexicon_cache(item_field(item))[item_val(item)]
+        except (IndexError, KeyError):
             raise ValueError("Bad item")
-        return ffi.string(value, self._ui64p[0])
 
     def cookie(self, id):
+        """
+        The cookie of a trail id, remembering the last cookie_limit looked up.
+        """
+        if id in self._cookies:
+            return self._cookies[id]
         cookie = lib.tdb_get_uuid(self._db, id)
         if cookie:
-            return hex_cookie(cookie)
+            return remember(self._cookies, id, hex_cookie(cookie), self.cookie_limit)
         raise IndexError("Cookie id out of range")
 
     def cookie_id(self, cookie):
+        """
+        The trail id of a cookie, remembering the last cookie_limit (hex) cookies looked up.
+        """
+        if isinstance(cookie, basestring) and cookie in self._trail_ids:
+            return self._trail_ids[cookie]
         if lib.tdb_get_trail_id(self._db, raw_cookie(cookie), self._ui64p):
             raise IndexError("UUID '%s' not found" % cookie)
+        if isinstance(cookie, basestring):
+            return remember(self._trail_ids, cookie, self._ui64p[0], self.cookie_limit)
         return self._ui64p[0]
 
+    def cookies(self, ids):
+        """
+        The cookies of many trail ids (a list or NumPy array) at once, looked up in one C call.
+        """
+        if hasattr(ids, 'dtype'):
+            import numpy as np
+            ids = np.ascontiguousarray(ids, np.uint64)
+            cids = pointer(ids)
+        else:
+            ids = list(ids)
+            cids = ffi.new('uint64_t []', ids)
+        uuids = ffi.new('uint8_t []', 16 * len(ids) or 1)
+        n = lib.tdb_get_uuids(self._db, cids, len(ids), uuids)
+        if n < len(ids):
+            raise IndexError("Cookie id out of range: %s" % ids[n])
+        data = ffi.buffer(uuids, 16 * n)[:].encode('hex')
+        return [data[i:i + 32] for i in xrange(0, 32 * n, 32)]
+
+    def cookie_ids(self, cookies):
+        """
+        The trail ids of many (hex) cookies at once, looked up in one C call, None for those not found.
+        """
+        cookies = list(cookies)
+        data = ''.join(cookies).decode('hex')
+        if len(data) != 16 * len(cookies):
+            raise ValueError("Cookies must be 16 bytes each")
+        ids = ffi.new('uint64_t []', len(cookies) or 1)
+        lib.tdb_get_trail_ids(self._db, ffi.cast('uint8_t *', ffi.from_buffer(data)), len(cookies), ids)
+        return [None if id == NEVER else id for id in ids[0:len(cookies)]]
+
     def time_range(self):
         tmin = lib.tdb_min_timestamp(self._db)
         tmax = lib.tdb_max_timestamp(self._db)
         return tmin, tmax
 
+class TDBSet(object):
+    """
+    Many TDB shards (with the same fields) viewed as one, without merging them.
+    Trail ids are global: the ids of each shard follow on from those of the shards before it.
+    Vals are global too, numbered in the order values are first seen across the shards,
+    so events and batches from every shard can be compared (unless expanded anyway).
+    A cookie may have a trail in several shards: trail(cookie) merges them by time.
+    """
+    def __init__(self, paths, lexicon_limit=LEXICON_LIMIT, stats=False):
+        self.shards = [TDB(path, lexicon_limit=lexicon_limit, stats=stats) for path in paths]
+        if not self.shards:
+            raise TDBError("No shards given")
+        first = self.shards[0]
+        for db in self.shards[1:]:
+            if db.fields != first.fields:
+                raise TDBError("Shards have different fields: %s" % db.path)
+        self.paths = list(paths)
+        self.offsets = [0]
+        for db in self.shards:
+            self.offsets.append(self.offsets[-1] + db.num_trails)
+        self.num_trails = self.offsets[-1]
+        self.num_events = sum(db.num_events for db in self.shards)
+        self.num_fields = first.num_fields
+        self.fields = first.fields
+        self._bacls = first._bacls
+        self._lexicons = {}
+
+    def __contains__(self, cookieish):
+        try:
+            self[cookieish]
+            return True
+        except IndexError:
+            return False
+
+    def __getitem__(self, cookieish):
+        return self.trail(cookieish)
+
+    def __iter__(self):
+        return iter(self.match())
+
+    def __len__(self):
+        return self.num_trails
+
+    @property
+    def stats(self):
+        if self.shards[0].stats is None:
+            return None
+        return dict((k, sum(db.stats[k] for db in self.shards)) for k in self.shards[0].stats)
+
+    def locate(self, id):
+        """
+        The (shard index, trail id within the shard) of a global trail id.
+        """
+        if id < 0 or id >= self.num_trails:
+            raise IndexError("Cookie id out of range")
+        s = bisect_right(self.offsets, id) - 1
+        return s, id - self.offsets[s]
+
+    def vals(self, s):
+        """
+        The lists translating the vals of shard s to global vals, one per field.
+        """
+        return [self.lexicon_map(f)[2][s] for f in xrange(1, self.num_fields)]
+
+    def match(self, query=None, batch=None, processes=None, **kwds):
+        """
+        Iterate over (id, events) for each trail matching the query, shard by shard.
+        Shards which cannot match the query are skipped, without being scanned.
+        If batch is given, iterate over columnar batches of up to that many events instead.
+        If processes is given, scan the shards in that many worker processes.
+        """
+        shards = [s for s, db in enumerate(self.shards) if not query or possible(db, query)]
+        if processes:
+            return self.pmatch(shards, query=query, processes=processes, **kwds)
+        if batch:
+            return self.batches(shards, query=query, batch=batch, **kwds)
+        return self.smatch(shards, query=query, **kwds)
+
+    def smatch(self, shards, query=None, expand=False, **kwds):
+        for s in shards:
+            offset, vals = self.offsets[s], None if expand else self.vals(s)
+            for id, trail in self.shards[s].match(query=query, expand=expand, vals=vals, **kwds):
+                yield offset + id, trail
+
+    def pmatch(self, shards, query=None, processes=None, ordered=True, expand=False, **kwds):
+        """
+        Like match, but each shard is scanned by a worker process.
+        Unless ordered, trails are yielded in whichever order the shards finish.
+        """
+        pool = Pool(processes)
+        jobs = [(self.paths[s], trails, query, 0, None,
+                 dict(kwds, expand=expand, vals=None if expand else self.vals(s))) for s in shards]
+        try:
+            for s, found in (pool.imap if ordered else pool.imap_unordered)(indexed, enumerate(jobs)):
+                offset, evmake = self.offsets[shards[s]], self.shards[shards[s]]._evcls._make
+                for id, trail in found:
+                    yield offset + id, [evmake(e) for e in trail]
+        finally:
+            pool.terminate()
+
+    def batches(self, shards, query=None, batch=BATCH_SIZE, **kwds):
+        import numpy as np
+        for s in shards:
+            offset = self.offsets[s]
+            vals = [np.asarray(m, np.uint64) for m in self.vals(s)]
+            for b in self.shards[s].match(query=query, batch=batch, **kwds):
+                yield self._bacls(b[0] + offset, b[1], *(m[v] for m, v in izip(vals, b[2:])))
+
+    def aggregate(self, field=None, query=None, values=False, trails=False, seen=False, lengths=0, times=None):
+        """
+        Aggregate each shard which could match the query (see TDB.aggregate), and combine them.
+        The lists per val are indexed by global val.
+        """
+        if field is None and (values or trails or seen):
+            raise TDBError("Aggregating values, trails or seen needs a field")
+        size = self.lexicon_size(field) if field is not None else 0
+        result = {'num_trails': 0, 'num_events': 0}
+        if field is not None:
+            if values:
+                result['values'] = [0] * size
+            if trails:
+                result['trails'] = [0] * size
+            if seen:
+                result['first_seen'] = [None] * size
+                result['last_seen'] = [None] * size
+        if lengths:
+            result['lengths'] = [0] * lengths
+        if times:
+            result['times'] = [0] * times[2]
+        for s, db in enumerate(self.shards):
+            if query and not possible(db, query):
+                continue
+            vals = self.lexicon_map(field)[2][s] if field is not None else None
+            part = db.aggregate(field, query=query, values=values, trails=trails, seen=seen,
+                                lengths=lengths, times=times)
+            for key, total in result.items():
+                if key in ('num_trails', 'num_events'):
+                    result[key] += part[key]
+                elif key in ('lengths', 'times'):
+                    for i, x in enumerate(part[key]):
+                        total[i] += x
+                else:
+                    for val, x in izip(vals, part[key]):
+                        total[val] = combine(key, total[val], x)
+        return result
+
+    def trail(self, id, lazy=False, expand=False, **kwds):
+        """
+        Get the events of a trail by global id, or of every trail of a cookie, merged by time.
+        If lazy, return an iterator which decodes the events as they are consumed.
+        """
+        if isinstance(id, basestring):
+            found = self.find(id)
+            if not found:
+                raise IndexError("UUID '%s' not found" % id)
+        else:
+            found = [self.locate(id)]
+        trails = [self.shards[s].trail(i, lazy=True, expand=expand, vals=None if expand else self.vals(s), **kwds)
+                  for s, i in found]
+        events = trails[0] if len(trails) == 1 else merge(*trails)
+        return events if lazy else list(events)
+
+    def field(self, fieldish):
+        return self.shards[0].field(fieldish)
+
+    def field_name(self, fieldish):
+        return self.shards[0].field_name(fieldish)
+
+    def lexicon_map(self, fieldish):
+        """
+        The global (words, vals, shard vals) of a field:
+        the values in global val order, the global val of each value,
+        and the global val of each val of every shard.
+        """
+        field = self.field(fieldish)
+        if field not in self._lexicons:
+            vals, maps = {}, []
+            for db in self.shards:
+                lexicon = db.lexicon_cache(field)
+                values = lexicon.values if lexicon.values is not None else lexicon.read()
+                maps.append([vals.setdefault(v, len(vals)) for v in values])
+            words = sorted(vals, key=vals.get)
+            self._lexicons[field] = words, vals, maps
+        return self._lexicons[field]
+
+    def lexicon(self, fieldish):
+        return self.lexicon_map(fieldish)[0][1:]
+
+    def lexicon_size(self, fieldish):
+        return len(self.lexicon_map(fieldish)[0])
+
+    def lexicon_word(self, fieldish, val):
+        return self.lexicon_map(fieldish)[0][val]
+
+    def lexicon_val(self, fieldish, value):
+        try:
+            return self.lexicon_map(fieldish)[1][value]
+        except KeyError:
+            raise KeyError("Field '%s' has no such value: '%s'" % (self.field_name(fieldish), value))
+
+    def cookie(self, id):
+        s, i = self.locate(id)
+        return self.shards[s].cookie(i)
+
+    def cookie_id(self, cookie):
+        """
+        The global id of the first trail of the cookie.
+        """
+        ids = self.trail_ids(cookie)
+        if not ids:
+            raise IndexError("UUID '%s' not found" % cookie)
+        return ids[0]
+
+    def cookies(self, ids):
+        """
+        The cookies of many global trail ids at once, looked up in one C call per shard.
+        """
+        cookies, shards = [None] * len(ids), {}
+        for n, id in enumerate(ids):
+            s, i = self.locate(id)
+            shards.setdefault(s, ([], []))
+            shards[s][0].append(n)
+            shards[s][1].append(i)
+        for s, (ns, found) in shards.items():
+            for n, cookie in izip(ns, self.shards[s].cookies(found)):
+                cookies[n] = cookie
+        return cookies
+
+    def cookie_ids(self, cookies):
+        """
+        The global ids of the first trails of many (hex) cookies at once, None for those not found.
+        """
+        cookies = list(cookies)
+        ids, left = [None] * len(cookies), range(len(cookies))
+        for s, db in enumerate(self.shards):
+            if not left:
+                break
+            found = db.cookie_ids(cookies[n] for n in left)
+            for n, id in izip(left, found):
+                if id is not None:
+                    ids[n] = self.offsets[s] + id
+            left = [n for n, id in izip(left, found) if id is None]
+        return ids
+
+    def trail_ids(self, cookie):
+        """
+        The global ids of the trails of the cookie, one per shard it appears in.
+        """
+        return [self.offsets[s] + i for s, i in self.find(cookie)]
+
+    def find(self, cookie):
+        """
+        The (shard index, trail id within the shard) of each trail of the cookie.
+        """
+        found = []
+        for s, db in enumerate(self.shards):
+            try:
+                found.append((s, db.cookie_id(cookie)))
+            except IndexError:
+                pass
+        return found
+
+    def time_range(self):
+        ranges = [db.time_range() for db in self.shards]
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+class TDBLexicon(object):
+    """
+    The decoded values of a field, indexed by val.
+    If all the values fit within limit bytes, they are decoded at once in bulk.
+    Otherwise values are decoded on demand, forgetting the oldest past the limit.
+    """
+    def __init__(self, db, field, limit=LEXICON_LIMIT):
+        self.db = db
+        self.field = field
+        self.limit = limit
+        self.size = db.lexicon_size(field)
+        self.nbytes = lib.tdb_lexicon_read(db._db, field, ffi.NULL, ffi.NULL)
+        self.values = self.read() if self.nbytes <= limit else None
+        self.cache = OrderedDict()
+        self.cached = 0
+
+    def __getitem__(self, val):
+        if self.values is not None:
+            return self.values[val]
+        try:
+            return self.cache[val]
+        except KeyError:
+            value = self.cache[val] = self.word(val)
+            self.cached += len(value)
+            while self.cached > self.limit:
+                self.cached -= len(self.cache.popitem(last=False)[1])
+            return value
+
+    def __len__(self):
+        return self.size
+
+    def read(self):
+        buf = ffi.new('char []', self.nbytes or 1)
+        offs = ffi.new('uint64_t []', self.size + 1)
+        lib.tdb_lexicon_read(self.db._db, self.field, buf, offs)
+        data, offs = ffi.buffer(buf, self.nbytes)[:], list(offs)
+        return [data[a:b] for a, b in izip(offs, offs[1:])]
+
+    def word(self, val):
+        value = lib.tdb_get_value(self.db._db, self.field, val, self.db._ui64p)
+        if value == ffi.NULL:
+            raise IndexError("Field '%s' has no such value: '%s'" % (self.db.field_name(self.field), val))
+        return ffi.string(value, self.db._ui64p[0])
+
+    def words(self):
+        return (self.values if self.values is not None else self.read())[1:]
+
 class TDBIter(object):
-    def __init__(self, db, query=None, **kwds):
+    def __init__(self, db, query=None, start=0, stop=None, lazy=False, **kwds):
         self.filter = TDBFilter(db, query) if query else None
-        self._iter = lib.tdb_iter_new(db._db, self.filter._filter if query else ffi.NULL)
+        self._iter = lib.tdb_iter_new(db._db, self.filter._filter if self.filter else ffi.NULL)
+        if start or stop is not None:
+            lib.tdb_iter_range(self._iter, start, db.num_trails if stop is None else stop)
+        if self.filter:
+            lib.tdb_iter_window(self._iter, *self.filter.window)
         self.evify = db.evifier(**kwds)
+        self.lazy = lazy
+        self.db = db
+        self.visited = self._iter.start
 
     def __del__(self):
         if hasattr(self, '_iter'):
@@ -214,14 +836,58 @@ class TDBIter(object):
 
     def next(self):
         i = lib.tdb_iter_next(self._iter)
+        if self.db.stats is not None:
+            self.tally(1 if i else 0)
         if not i:
             raise StopIteration()
-        return i.marker - 1, list(events(i.cursor, self.evify))
+        if self.lazy:
+            return i.marker - 1, self.stream(i.marker)
+        return i.marker - 1, list(events(i, self.evify, lib.tdb_iter_event))
+
+    def tally(self, matched):
+        """
+        Add the trails visited since the last tally to the stats of the db.
+        """
+        visited = min(self._iter.marker, self._iter.stop)
+        self.db.stats['trails'] += visited - self.visited
+        self.db.stats['matched'] += matched
+        self.visited = visited
+
+    def stream(self, marker):
+        """
+        Yield the events of the current trail, stopping once the iterator moves on.
+        """
+        iter, evify = self._iter, self.evify
+        while iter.marker == marker:
+            ev = lib.tdb_iter_event(iter)
+            if not ev:
+                break
+            yield evify(ev.timestamp, (ev.items[i] for i in xrange(ev.num_items)))
+
+    def batches(self, size=BATCH_SIZE):
+        """
+        Decode the remaining events in C, as batches of NumPy arrays (one per column).
+        Each batch has an array of trail ids, timestamps and vals for every field.
+        """
+        import numpy as np
+        batchify = self.db.batchifier()
+        while True:
+            ids = np.empty(size, np.uint64)
+            times = np.empty(size, np.uint64)
+            vals = np.empty((self.db.num_fields - 1, size), np.uint64)
+            n = lib.tdb_iter_batch(self._iter, size, pointer(ids), pointer(times), pointer(vals))
+            if self.db.stats is not None:
+                self.tally(0)
+                self.db.stats['events'] += n
+            if not n:
+                break
+            yield batchify(ids[:n], times[:n], vals[:, :n])
 
 class TDBCursor(object):
     def __init__(self, db, **kwds):
         self._cursor = lib.tdb_cursor_new(db._db)
         self.evify = db.evifier(**kwds)
+        self.db = db
 
     def __del__(self):
         if hasattr(self, '_cursor'):
@@ -231,19 +897,58 @@ class TDBCursor(object):
         e = lib.tdb_get_trail(self._cursor, trail_id)
         if e:
             raise TDBError("Failed to get trail", e)
+        if self.db.stats is not None:
+            self.db.stats['trails'] += 1
+        self.trail_id = trail_id
         return self
 
+    def __iter__(self):
+        for event in events(self._cursor, self.evify):
+            yield event
+
     def events(self):
         return list(events(self._cursor, self.evify))
 
+    def batches(self, size=BATCH_SIZE):
+        """
+        Decode the rest of the trail in C, as batches of NumPy arrays (one per column).
+        """
+        import numpy as np
+        batchify = self.db.batchifier()
+        while True:
+            times = np.empty(size, np.uint64)
+            vals = np.empty((self.db.num_fields - 1, size), np.uint64)
+            n = lib.tdb_cursor_batch(self._cursor, size, pointer(times), pointer(vals), size)
+            if self.db.stats is not None:
+                self.db.stats['events'] += n
+            if not n:
+                break
+            yield batchify(np.full(n, self.trail_id, np.uint64), times[:n], vals[:, :n])
+
 class TDBFilter(object):
+    """
+    The event filter of a query, applied in C.
+    Clauses of just a time range (e.g. 'time=START:END') are taken out as the window of times to keep:
+    the events of a trail are decoded up to the end of the window (those before it are dropped),
+    and nothing is decoded if the whole TDB misses it. Time ranges may not be negated or or-ed.
+    """
     def __init__(self, db, query):
-        self._filter = lib.tdb_event_filter_new()
-        for i, clause in enumerate(query.clauses):
-            if i > 0:
+        self.window = 0, NEVER
+        self._filter = ffi.NULL
+        for clause in query.clauses:
+            times = [l for l in clause.literals if db.field(l.term[0]) == 0]
+            if times:
+                if len(clause.literals) > 1 or times[0].negated:
+                    raise TDBError("Time ranges must be and-ed with the rest of the query: %s" % clause)
+                start, end = window(times[0].term[1])
+                self.window = max(self.window[0], start), min(self.window[1], end)
+                continue
+            if self._filter:
                 e = lib.tdb_event_filter_new_clause(self._filter)
                 if e:
                     raise TDBError("Failed to create clause", e)
+            else:
+                self._filter = lib.tdb_event_filter_new()
             for literal in clause.literals:
                 fieldish, value = literal.term
                 field = db.field(fieldish)
@@ -253,5 +958,5 @@ class TDBFilter(object):
                     raise TDBError("Failed to add term", e)
 
     def __del__(self):
-        if hasattr(self, '_filter'):
+        if getattr(self, '_filter', None):
             lib.tdb_event_filter_free(self._filter)